@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+# Attention shared by model1, model2, model3 and model6.
+# Each model keeps its own attention layer (and parameter names) but the
+# matmul -> mask -> softmax -> matmul part goes through scaled_dot_product,
+# which dispatches to the backend selected with the attention_backend config key.
+
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+
+ATTENTION_BACKENDS = {}
+
+# Number of queries and of keys processed together by the chunked backend. See configure_attention
+ATTENTION_CHUNK_SIZE = 128
+
+
+def register_attention_backend(name: str):
+    def register(function):
+        ATTENTION_BACKENDS[name] = function
+        return function
+
+    return register
+
+
+@register_attention_backend("naive")
+def naive_attention(query: Tensor, key: Tensor, value: Tensor, mask: Tensor = None, dropout: nn.Dropout = None, is_causal: bool = False):
+    # Reference implementation. The full (..., QueryLen, KeyLen) scores are materialized and returned
+    d_k = query.shape[-1]
+    attention_scores = (query @ key.transpose(-2, -1)) / math.sqrt(d_k)
+    if is_causal:
+        causal = torch.ones(query.shape[-2], key.shape[-2], dtype=torch.bool, device=query.device).tril()
+        attention_scores = attention_scores.masked_fill(~causal, -1e9)
+    if mask is not None:
+        if mask.is_floating_point():
+            # Additive mask (model6): 0 or NEG_INFTY
+            attention_scores = attention_scores + mask
+        else:
+            # Replace all the value for which mask == 0 with -1e9 (minus infinity)
+            attention_scores = attention_scores.masked_fill(mask == 0, -1e9)
+    # fp32 softmax, also under bf16 autocast
+    attention_scores = attention_scores.float().softmax(dim=-1)
+    if dropout is not None:
+        attention_scores = dropout(attention_scores)
+    return attention_scores @ value, attention_scores
+
+
+@register_attention_backend("sdpa")
+def sdpa_attention(query: Tensor, key: Tensor, value: Tensor, mask: Tensor = None, dropout: nn.Dropout = None, is_causal: bool = False):
+    # torch.nn.functional.scaled_dot_product_attention picks the fastest kernel available (flash/memory
+    # efficient on cpu). The scores are not materialized, hence not returned.
+    mask = additive_mask(mask, query.dtype)
+    key, value = expand_kv(query, key, value)
+    dropout_p = dropout.p if dropout is not None and dropout.training else 0.0
+    return F.scaled_dot_product_attention(query, key, value, attn_mask=mask, dropout_p=dropout_p, is_causal=is_causal), None
+
+
+@register_attention_backend("chunked")
+def chunked_attention(query: Tensor, key: Tensor, value: Tensor, mask: Tensor = None, dropout: nn.Dropout = None, is_causal: bool = False):
+    # Online softmax over chunks of ATTENTION_CHUNK_SIZE queries and keys: only (chunk, chunk) scores exist at
+    # any time, in forward and in backward (the scores are recomputed per chunk). Pure pytorch, runs on cpu.
+    mask = additive_mask(mask, torch.float32)
+    key, value = expand_kv(query, key, value)
+    dropout_p = dropout.p if dropout is not None and dropout.training else 0.0
+    # The dropout of each chunk is drawn from its own seed, so the backward pass can replay it
+    seed = int(torch.randint(2**62, (1,))) if dropout_p > 0 else 0
+    # The running max/sum of the online softmax are kept in fp32, also under bf16 autocast
+    with torch.autocast(device_type=query.device.type, enabled=False):
+        output = ChunkedAttention.apply(query.float(), key.float(), value.float(), mask, dropout_p, is_causal, ATTENTION_CHUNK_SIZE, seed)
+    return output, None
+
+
+def additive_mask(mask: Tensor, dtype) -> Tensor:
+    # JEB: A boolean mask would use -inf. Rows without any visible key (e.g. the padding rows of the
+    # model2/model3 target masks) would then be NaN, so the -1e9 of the naive version is kept.
+    if mask is None or mask.is_floating_point():
+        return mask
+    return torch.zeros(mask.shape, dtype=dtype, device=mask.device).masked_fill(mask == 0, -1e9)
+
+
+def expand_kv(query: Tensor, key: Tensor, value: Tensor) -> tuple[Tensor, Tensor]:
+    # The beam search of model1 broadcasts the keys/values of a sentence over its beams
+    if key.shape[:-2] != query.shape[:-2]:
+        key = key.expand(*query.shape[:-2], *key.shape[-2:])
+        value = value.expand(*query.shape[:-2], *value.shape[-2:])
+    return key, value
+
+
+class ChunkedAttention(torch.autograd.Function):
+    """Memory efficient attention (online softmax). Neither forward nor backward keep the (QueryLen, KeyLen) scores.
+    forward saves the inputs, the output and the logsumexp of each row. backward recomputes the scores chunk by chunk."""
+
+    @staticmethod
+    def chunks(length: int, chunk_size: int):
+        return [(start, min(start + chunk_size, length)) for start in range(0, length, chunk_size)]
+
+    @staticmethod
+    def scores(query: Tensor, key: Tensor, mask: Tensor, is_causal: bool, rows: tuple, cols: tuple) -> Tensor:
+        # Masked scores of the query chunk rows against the key chunk cols
+        (qs, qe), (ks, ke) = rows, cols
+        scores = (query @ key.transpose(-2, -1)) / math.sqrt(query.shape[-1])
+        if mask is not None:
+            # A dimension of size 1 is broadcast, not sliced
+            mask_rows = slice(qs, qe) if mask.shape[-2] > 1 else slice(None)
+            mask_cols = slice(ks, ke) if mask.shape[-1] > 1 else slice(None)
+            scores = scores + mask[..., mask_rows, mask_cols]
+        if is_causal and ke - 1 > qs:
+            future = torch.arange(ks, ke, device=query.device)[None, :] > torch.arange(qs, qe, device=query.device)[:, None]
+            scores = scores.masked_fill(future, -1e9)
+        return scores
+
+    @staticmethod
+    def dropout_scale(shape, dtype, device, dropout_p: float, seed: int) -> Tensor:
+        generator = torch.Generator(device=device)
+        generator.manual_seed(seed)
+        keep = torch.rand(shape, generator=generator, dtype=dtype, device=device) >= dropout_p
+        return keep.to(dtype) / (1 - dropout_p)
+
+    @staticmethod
+    def forward(ctx, query, key, value, mask, dropout_p: float, is_causal: bool, chunk_size: int, seed: int):
+        q_chunks = ChunkedAttention.chunks(query.shape[-2], chunk_size)
+        k_chunks = ChunkedAttention.chunks(key.shape[-2], chunk_size)
+        out = torch.empty_like(query)
+        logsumexp = torch.empty(query.shape[:-1], dtype=query.dtype, device=query.device)
+        for i, (qs, qe) in enumerate(q_chunks):
+            q = query[..., qs:qe, :]
+            row_max = torch.full((*q.shape[:-1], 1), float("-inf"), dtype=query.dtype, device=query.device)
+            row_sum = torch.zeros_like(row_max)
+            acc = torch.zeros_like(q)
+            for j, (ks, ke) in enumerate(k_chunks):
+                if is_causal and ks >= qe:
+                    # Every key of the chunk is in the future
+                    break
+                scores = ChunkedAttention.scores(q, key[..., ks:ke, :], mask, is_causal, (qs, qe), (ks, ke))
+                new_max = torch.maximum(row_max, scores.amax(dim=-1, keepdim=True))
+                probs = torch.exp(scores - new_max)
+                # Rescale what was accumulated with the previous maximum
+                correction = torch.exp(row_max - new_max)
+                row_sum = row_sum * correction + probs.sum(dim=-1, keepdim=True)
+                if dropout_p > 0:
+                    probs = probs * ChunkedAttention.dropout_scale(probs.shape, probs.dtype, probs.device, dropout_p, seed + i * len(k_chunks) + j)
+                acc = acc * correction + probs @ value[..., ks:ke, :]
+                row_max = new_max
+            out[..., qs:qe, :] = acc / row_sum
+            logsumexp[..., qs:qe] = (row_max + torch.log(row_sum)).squeeze(-1)
+        ctx.save_for_backward(query, key, value, mask, out, logsumexp)
+        ctx.dropout_p, ctx.is_causal, ctx.chunk_size, ctx.seed = dropout_p, is_causal, chunk_size, seed
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        query, key, value, mask, out, logsumexp = ctx.saved_tensors
+        dropout_p, is_causal, seed = ctx.dropout_p, ctx.is_causal, ctx.seed
+        q_chunks = ChunkedAttention.chunks(query.shape[-2], ctx.chunk_size)
+        k_chunks = ChunkedAttention.chunks(key.shape[-2], ctx.chunk_size)
+        scale = 1 / math.sqrt(query.shape[-1])
+        # (dO * O).sum() is the sum over the row of P * dP. Valid with dropout too
+        delta = (grad_out * out).sum(dim=-1, keepdim=True)
+        grad_query = torch.zeros_like(query)
+        grad_key = torch.zeros(key.shape, dtype=key.dtype, device=key.device)
+        grad_value = torch.zeros(value.shape, dtype=value.dtype, device=value.device)
+        for i, (qs, qe) in enumerate(q_chunks):
+            q = query[..., qs:qe, :]
+            do = grad_out[..., qs:qe, :]
+            for j, (ks, ke) in enumerate(k_chunks):
+                if is_causal and ks >= qe:
+                    break
+                k = key[..., ks:ke, :]
+                v = value[..., ks:ke, :]
+                # Recompute the probabilities of the chunk from the saved logsumexp
+                probs = torch.exp(ChunkedAttention.scores(q, k, mask, is_causal, (qs, qe), (ks, ke)) - logsumexp[..., qs:qe, None])
+                grad_probs = do @ v.transpose(-2, -1)
+                if dropout_p > 0:
+                    dropout_scale = ChunkedAttention.dropout_scale(probs.shape, probs.dtype, probs.device, dropout_p, seed + i * len(k_chunks) + j)
+                    grad_value[..., ks:ke, :] += (probs * dropout_scale).transpose(-2, -1) @ do
+                    grad_probs = grad_probs * dropout_scale
+                else:
+                    grad_value[..., ks:ke, :] += probs.transpose(-2, -1) @ do
+                grad_scores = probs * (grad_probs - delta[..., qs:qe, :])
+                grad_query[..., qs:qe, :] += (grad_scores @ k) * scale
+                grad_key[..., ks:ke, :] += (grad_scores.transpose(-2, -1) @ q) * scale
+        return grad_query, grad_key, grad_value, None, None, None, None, None
+
+
+def get_attention_backend(name: str):
+    if name not in ATTENTION_BACKENDS:
+        raise ValueError(f"{name} attention backend is not supported. Possible values: {', '.join(ATTENTION_BACKENDS)}")
+    return ATTENTION_BACKENDS[name]
+
+
+def scaled_dot_product(
+    query: Tensor, key: Tensor, value: Tensor, mask: Tensor = None, dropout: nn.Dropout = None, causal: bool = False, backend: str = "naive"
+) -> tuple[Tensor, Tensor]:
+    # query (..., QueryLen, d_k), key and value (..., KeyLen, d_k). Returns the (..., QueryLen, d_k) output and
+    # the attention scores (None when the backend does not compute them).
+    # mask broadcasts to (..., QueryLen, KeyLen). Either 0 for the hidden positions (int or bool), or additive (float).
+    # causal tells that mask is the causal mask of a self attention, possibly combined with the padding of the target
+    # (model1 and model6). When the queries and the keys are the same positions, the mask is then replaced by is_causal:
+    # the padding of the target only hides keys which are already in the future of every real position.
+    # Never set causal for a padding-only mask (model2 and model3): is_causal would hide the future and show the padding.
+    # JEB: Incremental decoding (QueryLen < KeyLen) keeps the mask.
+    is_causal = causal and backend != "naive" and query.shape[-2] == key.shape[-2]
+    if is_causal:
+        mask = None
+    return get_attention_backend(backend)(query, key, value, mask, dropout, is_causal)
+
+
+class FusableQKV:
+    """Mixin for the attention layers of model1, model2 and model3.
+    The query, key and value projections are three nn.Linear named by qkv_names, or a single w_qkv
+    nn.Linear once fuse_qkv has been called. Checkpoints are converted while loading, in both directions."""
+
+    qkv_names = ("w_q", "w_k", "w_v")
+
+    def is_fused(self) -> bool:
+        return "w_qkv" in self._modules
+
+    def fuse_qkv(self):
+        if self.is_fused():
+            return
+        linears = [getattr(self, name) for name in self.qkv_names]
+        weight = linears[0].weight
+        bias = linears[0].bias is not None
+        fused = nn.Linear(linears[0].in_features, 3 * linears[0].out_features, bias=bias, device=weight.device, dtype=weight.dtype)
+        with torch.no_grad():
+            fused.weight.copy_(torch.cat([linear.weight for linear in linears], dim=0))
+            if bias:
+                fused.bias.copy_(torch.cat([linear.bias for linear in linears], dim=0))
+        for name in self.qkv_names:
+            delattr(self, name)
+        self.w_qkv = fused
+
+    def project_q(self, q: Tensor) -> Tensor:
+        if not self.is_fused():
+            return getattr(self, self.qkv_names[0])(q)
+        return self.project_slice(q, 0, 1)
+
+    def project_kv(self, k: Tensor, v: Tensor) -> tuple[Tensor, Tensor]:
+        if not self.is_fused():
+            return getattr(self, self.qkv_names[1])(k), getattr(self, self.qkv_names[2])(v)
+        if k is v:
+            return self.project_slice(k, 1, 3).chunk(2, dim=-1)
+        return self.project_slice(k, 1, 2), self.project_slice(v, 2, 3)
+
+    def project_qkv(self, q: Tensor, k: Tensor, v: Tensor) -> tuple[Tensor, Tensor, Tensor]:
+        # (bs, SeqLen, d_model) --> 3 x (bs, SeqLen, d_model)
+        if self.is_fused() and q is k and k is v:
+            # Self attention: a single matmul
+            return self.w_qkv(q).chunk(3, dim=-1)
+        return (self.project_q(q), *self.project_kv(k, v))
+
+    def project_slice(self, x: Tensor, start: int, end: int) -> Tensor:
+        # Apply the rows [start, end) (in units of d_model) of w_qkv
+        size = self.w_qkv.out_features // 3
+        weight = self.w_qkv.weight
+        if not isinstance(weight, Tensor):
+            # Dynamically quantized nn.Linear: no weight tensor to slice
+            return self.w_qkv(x)[..., start * size : end * size]
+        bias = self.w_qkv.bias
+        return F.linear(x, weight[start * size : end * size], None if bias is None else bias[start * size : end * size])
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        names = [f"{prefix}{name}" for name in self.qkv_names]
+        for param in ("weight", "bias"):
+            if self.is_fused() and f"{names[0]}.{param}" in state_dict:
+                state_dict[f"{prefix}w_qkv.{param}"] = torch.cat([state_dict.pop(f"{name}.{param}") for name in names], dim=0)
+            elif not self.is_fused() and f"{prefix}w_qkv.{param}" in state_dict:
+                for name, chunk in zip(names, state_dict.pop(f"{prefix}w_qkv.{param}").chunk(3, dim=0)):
+                    state_dict[f"{name}.{param}"] = chunk
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+def configure_attention(model: nn.Module, backend: str = "naive", fused_qkv: bool = False, chunk_size: int = None) -> nn.Module:
+    # Select the attention backend of every attention layer of model and optionally fuse their projections.
+    # To be called right after the model is built, before the weights are loaded and the optimizer is created.
+    # chunk_size sets the chunk size of the chunked backend.
+    global ATTENTION_CHUNK_SIZE
+    get_attention_backend(backend)
+    if chunk_size:
+        ATTENTION_CHUNK_SIZE = chunk_size
+    for module in model.modules():
+        if hasattr(module, "attention_backend"):
+            module.attention_backend = backend
+        if fused_qkv and isinstance(module, FusableQKV):
+            module.fuse_qkv()
+    return model
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+# Length bucketing for Dataset1, Dataset2 and Dataset3.
+# The datasets pad every example to seq_len. BucketBatchSampler groups examples of similar length and
+# DynamicPaddingCollate cuts the padding of each batch down to its longest example, rounded up to a
+# multiple of 8 for the matmuls: a batch of short sentences no longer pays the (seq_len, seq_len) attention.
+
+import math
+
+import torch
+from torch.utils.data import DataLoader, Dataset, Sampler, default_collate
+
+
+def round_up(length: int, multiple: int) -> int:
+    return multiple * math.ceil(length / multiple)
+
+
+class BucketBatchSampler(Sampler):
+    """Batches of indices of examples of similar length.
+    Each epoch, the indices are shuffled and cut in pools of batch_size * pool_batches examples. Each pool is
+    sorted by length and cut in batches, then the batches of every pool are shuffled together.
+    With max_tokens, a batch is also closed before its size x padded length exceeds max_tokens."""
+
+    def __init__(self, lengths: list[int], batch_size: int, max_tokens: int = None, pad_multiple: int = 8, pool_batches: int = 100, seed: int = 0):
+        # lengths[i] is the padded length example i needs (the longest of its source and target sequences)
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.pad_multiple = pad_multiple
+        self.pool_batches = pool_batches
+        self.seed = seed
+        self.epoch = 0
+        # Batches of the current epoch. Kept until the next epoch so that __len__ is stable during the iteration
+        self.batches = None
+        self.iterated = False
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        self.batches = None
+        self.iterated = False
+
+    def make_batches(self, epoch: int) -> list[list[int]]:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        indices = torch.randperm(len(self.lengths), generator=generator).tolist()
+        pool_size = self.batch_size * self.pool_batches
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = sorted(indices[start : start + pool_size], key=lambda index: self.lengths[index])
+            batch = []
+            for index in pool:
+                # The pool is sorted: the new example is the longest of the batch
+                padded_len = round_up(self.lengths[index], self.pad_multiple)
+                full = len(batch) == self.batch_size or (self.max_tokens is not None and padded_len * (len(batch) + 1) > self.max_tokens)
+                if batch and full:
+                    batches.append(batch)
+                    batch = []
+                batch.append(index)
+            if batch:
+                batches.append(batch)
+        order = torch.randperm(len(batches), generator=generator).tolist()
+        return [batches[i] for i in order]
+
+    def epoch_batches(self) -> list[list[int]]:
+        if self.batches is None:
+            self.batches = self.make_batches(self.epoch)
+        return self.batches
+
+    def __iter__(self):
+        if self.iterated:
+            # No set_epoch since the previous epoch: the next epoch gets new pools and a new order
+            self.set_epoch(self.epoch + 1)
+        self.iterated = True
+        return iter(self.epoch_batches())
+
+    def __len__(self):
+        # With max_tokens, the number of batches changes from one epoch to the other
+        return len(self.epoch_batches())
+
+
+class DynamicPaddingCollate:
+    """collate_fn cutting the seq_len padding of a batch of Dataset1/2/3 examples down to the longest example of
+    the batch, rounded up to a multiple of pad_multiple. Every dimension of size seq_len is cut: the token tensors
+    and the masks."""
+
+    def __init__(self, seq_len: int, pad_id: int, token_keys: tuple, pad_multiple: int = 8):
+        self.seq_len = seq_len
+        self.pad_id = pad_id
+        # token_keys are the (SeqLen) token tensors of an example, e.g. encoder_input, decoder_input and label
+        self.token_keys = token_keys
+        self.pad_multiple = pad_multiple
+
+    def __call__(self, examples: list[dict]) -> dict:
+        batch = default_collate(examples)
+        # The padding is only at the end of the sequences
+        max_len = max(int((batch[key] != self.pad_id).sum(dim=1).max()) for key in self.token_keys)
+        length = min(self.seq_len, round_up(max_len, self.pad_multiple))
+        for key, value in batch.items():
+            if isinstance(value, torch.Tensor):
+                batch[key] = value[(slice(None),) + tuple(slice(0, length) if size == self.seq_len else slice(None) for size in value.shape[1:])]
+        return batch
+
+
+def get_train_dataloader(config: dict, train_ds: Dataset, lengths: list[int], token_keys: tuple) -> DataLoader:
+    # Length bucketed and dynamically padded batches when bucket_batches is set, the original padding to seq_len otherwise
+    if not config.get("bucket_batches", False):
+        return DataLoader(train_ds, batch_size=config["batch_size"], shuffle=True)
+    seed = config.get("bucket_seed", None)
+    if seed is None:
+        seed = int(torch.randint(2**31, ()).item())
+    sampler = BucketBatchSampler(lengths, config["batch_size"], max_tokens=config.get("max_tokens", None), seed=seed)
+    collate_fn = DynamicPaddingCollate(config["seq_len"], int(train_ds.pad_token), token_keys)
+    return DataLoader(train_ds, batch_sampler=sampler, collate_fn=collate_fn)
+
+
+def set_epoch(dataloader: DataLoader, epoch: int):
+    # The bucketed batches are drawn from the epoch number: a run resumed with preload does not replay the first epoch
+    if isinstance(dataloader.batch_sampler, BucketBatchSampler):
+        dataloader.batch_sampler.set_epoch(epoch)
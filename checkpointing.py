@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+# Activation checkpointing for the encoder/decoder stacks of model1, model2, model3 and model6.
+# The activations of a checkpointed module are not kept for the backward pass. They are recomputed
+# during backward from the module inputs: less memory, one more forward of the module per step.
+
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+# full: every encoder/decoder layer. attention: only the attention layers (the (SeqLen, SeqLen) scores).
+# ffn: only the feed forward layers (the (SeqLen, d_ff) hidden activations)
+CHECKPOINT_POLICIES = ("full", "attention", "ffn")
+
+
+def configure_checkpointing(model: nn.Module, policy: str, layers: tuple, feed_forwards: tuple) -> nn.Module:
+    # layers and feed_forwards are the encoder/decoder layer classes and the feed forward classes of the model.
+    # The attention layers are the modules with an attention_backend. See attention.configure_attention
+    if not policy:
+        return model
+    if policy not in CHECKPOINT_POLICIES:
+        raise ValueError(f"{policy} checkpoint policy is not supported. Possible values: {', '.join(CHECKPOINT_POLICIES)}")
+    for module in model.modules():
+        if policy == "full":
+            selected = isinstance(module, layers)
+        elif policy == "attention":
+            selected = hasattr(module, "attention_backend")
+        else:
+            selected = isinstance(module, feed_forwards)
+        if selected:
+            module.forward = checkpointed_forward(module.forward)
+    return model
+
+
+def checkpointed_forward(forward):
+    def call(*args, **kwargs):
+        if not torch.is_grad_enabled():
+            # Evaluation and decoding: nothing is kept for backward anyway
+            return forward(*args, **kwargs)
+        # Non reentrant: works with inputs which do not require grad (the first layer) and keyword arguments.
+        # The RNG state is restored before the recomputation, so the dropout masks are the same
+        return checkpoint(forward, *args, use_reentrant=False, **kwargs)
+
+    return call
@@ -32,6 +32,37 @@ def get_default_config() -> dict:
         "tokenizer_file": "tokenizer_{0}",
         "experiment_name": "runs/tmodel",
         "alt_model": "model8",  # Possible values: None, model1, model2
+        "val_batch_size": 1,  # Added for model1 batched decoding
+        "max_len_factor": None,  # Decoding stops at max_len_factor * source length. None means seq_len
+        "beam_size": 1,  # 1 means greedy decoding. Used by model1
+        "length_penalty": 0.6,  # Beam search length normalization
+        "quantize": None,  # Possible values: None, int8. Dynamic quantization of the nn.Linear for cpu inference
+        "draft_model_folder": None,  # Added for model8 speculative decoding. Folder of a smaller model8
+        "num_draft_tokens": 4,  # Number of tokens proposed by the draft model at each step
+        "num_samples": 1,  # Added for model8. Number of samples generated together
+        "temperature": 1.0,  # Sampling temperature. 0 means greedy
+        "top_k": None,  # Only sample among the top_k most likely tokens
+        "top_p": None,  # Nucleus sampling threshold
+        "stop_strings": None,  # List of strings which stop the generation of a sample. Or one list per sample
+        "num_workers": 0,  # Added for model6. DataLoader workers tokenizing the training batches
+        "mask_form": "float",  # Added for model6. Possible values: float, bool, key_padding. See Dataset6.create_masks
+        "attention_backend": "naive",  # model1, model2, model3 and model6. Possible values: naive, sdpa, chunked
+        "attention_chunk_size": 128,  # Queries/keys processed together by the chunked attention backend
+        "fast_norm": False,  # model1, model3 and model6. Normalization layers computed with F.layer_norm
+        "compile": None,  # torch.compile mode. Possible values: None, default, reduce-overhead, max-autotune
+        "precision": "fp32",  # Training precision. Possible values: fp32, bf16 (autocast, the weights stay fp32)
+        "grad_accum_steps": 1,  # Number of batches accumulated before each optimizer step
+        "tokens_per_update": None,  # Alternative to grad_accum_steps. Step once that many real (non PAD) tokens are accumulated
+        "checkpoint_layers": None,  # model1, model2, model3 and model6 activation checkpointing. Possible values: None, full, attention, ffn
+        "bucket_batches": False,  # Dataset1/2/3. Batches of similar lengths, padded to the longest example instead of seq_len
+        "max_tokens": None,  # With bucket_batches. Maximum batch size x padded length of a batch
+        "bucket_seed": None,  # With bucket_batches. Seed of the batch order. None draws it from the torch RNG
+        "seq_len_percentile": None,  # Dataset1/2/3. seq_len picked as that percentile of the pair lengths, e.g. 99.9. Longer pairs are dropped
+        "token_cache": False,  # Dataset1/2/3. Tokenize the dataset once into memory mapped files of the model folder
+        "fused_qkv": False,  # model1, model2 and model3. One nn.Linear for the query, key and value projections
+        "kv_cache_stride": None,  # Use the model8 K/V cache. Tokens generated before each rebuild. 1 matches generate, larger is faster
+        "attention_window": None,  # Added for model8. Sliding window attention. None means full causal attention
+        "position_encoding": "learned",  # model8. Possible values: learned, rotary. rotary + attention_window lifts the block_size limit
     }
 
 
@@ -56,6 +87,9 @@ def get_config(filename: Optional[str] = None, modelfolder: Optional[str] = None
         print(f"Loading config from {config_path}")
         with open(config_path, "r") as yamlFile:
             configdict = yaml.safe_load(yamlFile)
+            if modelfolder:
+                # The folder was explicitly provided. It may not follow the get_model_folder naming
+                configdict["model_folder"] = modelfolder
             return configdict
 
 
@@ -85,6 +119,8 @@ def get_console_width():
 
 
 def get_model_folder(config: dict):
+    if config.get("model_folder", None):
+        return config["model_folder"]
     if config["alt_model"]:
         return f"{config['datasource']}_{config['lang_src']}_{config['lang_tgt']}_{config['alt_model']}"
     else:
@@ -97,6 +133,13 @@ def get_weights_file_path(config: dict, epoch: str):
     return str(Path(".") / model_folder / model_filename)
 
 
+def get_quantized_weights_file_path(model_filename: str, quantize: str) -> str:
+    # The quantized model is cached beside the float checkpoint. The prefix keeps it out of
+    # the model_basename glob used by latest_weights_file_path
+    model_path = Path(model_filename)
+    return str(model_path.with_name(f"{quantize}_{model_path.name}"))
+
+
 def get_best_model_params_path(config: dict):
     model_folder = get_model_folder(config)
     model_filename = "best_model_params.pt"
@@ -16,12 +16,24 @@ from tokenizers.trainers import WordLevelTrainer
 from tokenizers.pre_tokenizers import Whitespace
 
 from pathlib import Path
+from bucketing import get_train_dataloader
+from length_stats import apply_seq_len, filter_pairs, get_length_stats, load_length_stats
+from token_cache import TokenCache, get_token_cache
 from config import EOS, SOS, PAD, UNK
 
 
 class Dataset1(Dataset):
 
-    def __init__(self, ds: Dataset, tokenizer_src: Tokenizer, tokenizer_tgt: Tokenizer, src_lang: str, tgt_lang: str, seq_len: int) -> None:
+    def __init__(
+        self,
+        ds: Dataset,
+        tokenizer_src: Tokenizer,
+        tokenizer_tgt: Tokenizer,
+        src_lang: str,
+        tgt_lang: str,
+        seq_len: int,
+        token_ids: TokenCache = None,
+    ) -> None:
         super().__init__()
 
         self.ds = ds
@@ -30,6 +42,8 @@ class Dataset1(Dataset):
         self.src_lang = src_lang
         self.tgt_lang = tgt_lang
         self.seq_len = seq_len
+        # Pre-tokenized pairs. See token_cache.get_token_cache
+        self.token_ids = token_ids
 
         # JEB: Big difference between video and source code.
         # DIFF1: tensor instead of Tensor
@@ -50,8 +64,11 @@ class Dataset1(Dataset):
         tgt_text = src_target_pair["translation"][self.tgt_lang]
 
         # Transform the text into tokens
-        enc_input_tokens = self.tokenizer_src.encode(src_text).ids
-        dec_input_tokens = self.tokenizer_tgt.encode(tgt_text).ids
+        if self.token_ids is not None:
+            enc_input_tokens, dec_input_tokens = self.token_ids[idx]
+        else:
+            enc_input_tokens = self.tokenizer_src.encode(src_text).ids
+            dec_input_tokens = self.tokenizer_tgt.encode(tgt_text).ids
 
         # need to pad the sentence to sequence lenght.
         # minus two because we add start and end
@@ -70,7 +87,7 @@ class Dataset1(Dataset):
         encoder_input = torch.cat(
             [
                 self.sos_token,
-                torch.tensor(enc_input_tokens, dtype=torch.int64),
+                torch.as_tensor(enc_input_tokens, dtype=torch.int64),
                 self.eos_token,
                 torch.tensor([self.pad_token] * enc_num_padding_tokens, dtype=torch.int64),
             ],
@@ -82,7 +99,7 @@ class Dataset1(Dataset):
         decoder_input = torch.cat(
             [
                 self.sos_token,
-                torch.tensor(dec_input_tokens, dtype=torch.int64),
+                torch.as_tensor(dec_input_tokens, dtype=torch.int64),
                 torch.tensor([self.pad_token] * dec_num_padding_tokens, dtype=torch.int64),
             ],
             dim=0,
@@ -92,7 +109,7 @@ class Dataset1(Dataset):
         # The ouput of the decoder will not include the start_token but will include the end_token
         label = torch.cat(
             [
-                torch.tensor(dec_input_tokens, dtype=torch.int64),
+                torch.as_tensor(dec_input_tokens, dtype=torch.int64),
                 self.eos_token,
                 torch.tensor([self.pad_token] * dec_num_padding_tokens, dtype=torch.int64),
             ],
@@ -176,23 +193,33 @@ def get_ds1(config: dict, model_folder: str) -> Tuple[DataLoader, DataLoader, To
     val_ds_size = len(ds_raw) - train_ds_size
     train_ds_raw, val_ds_raw = random_split(ds_raw, [train_ds_size, val_ds_size])
 
-    train_ds = Dataset1(train_ds_raw, tokenizer_src, tokenizer_tgt, config["lang_src"], config["lang_tgt"], config["seq_len"])
-    val_ds = Dataset1(val_ds_raw, tokenizer_src, tokenizer_tgt, config["lang_src"], config["lang_tgt"], config["seq_len"])
+    def get_texts(item) -> Tuple[str, str]:
+        return item["translation"][config["lang_src"]], item["translation"][config["lang_tgt"]]
 
-    max_len_src = 0
-    max_len_tgt = 0
+    # Tokenized once into the model folder when token_cache is set
+    token_ids = None
+    if config.get("token_cache", False):
+        token_ids = get_token_cache(config, model_folder, ds_raw, tokenizer_src, tokenizer_tgt, get_texts)
 
-    for item in ds_raw:
-        src_ids = tokenizer_src.encode(item["translation"][config["lang_src"]]).ids
-        tgt_ids = tokenizer_tgt.encode(item["translation"][config["lang_tgt"]]).ids
-        max_len_src = max(max_len_src, len(src_ids))
-        max_len_tgt = max(max_len_tgt, len(tgt_ids))
+    # Stored with the tokenizers. Picks seq_len with seq_len_percentile and drops the pairs longer than seq_len
+    stats = get_length_stats(config, model_folder, ds_raw, tokenizer_src, tokenizer_tgt, get_texts, token_ids)
+    seq_len = apply_seq_len(config, stats)
+    train_ds_raw = filter_pairs(train_ds_raw, stats, seq_len)
+    val_ds_raw = filter_pairs(val_ds_raw, stats, seq_len)
 
-    print(f"Max length of source sentence: {max_len_src}")
-    print(f"Max length of target sentence: {max_len_tgt}")
+    train_ids = None
+    val_ids = None
+    if token_ids is not None:
+        train_ids = token_ids.subset(train_ds_raw.indices)
+        val_ids = token_ids.subset(val_ds_raw.indices)
 
-    train_dataloader = DataLoader(train_ds, batch_size=config["batch_size"], shuffle=True)
-    val_dataloader = DataLoader(val_ds, batch_size=1, shuffle=True)
+    train_ds = Dataset1(train_ds_raw, tokenizer_src, tokenizer_tgt, config["lang_src"], config["lang_tgt"], config["seq_len"], train_ids)
+    val_ds = Dataset1(val_ds_raw, tokenizer_src, tokenizer_tgt, config["lang_src"], config["lang_tgt"], config["seq_len"], val_ids)
+
+    # See bucketing.get_train_dataloader
+    train_dataloader = get_train_dataloader(config, train_ds, stats.pair_lengths[train_ds_raw.indices].tolist(), ("encoder_input", "decoder_input", "label"))
+    # Validation decodes the whole batch at once. See Transformer1.batch_greedy_decode
+    val_dataloader = DataLoader(val_ds, batch_size=config.get("val_batch_size", 1), shuffle=True)
 
     return train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt
 
@@ -202,6 +229,8 @@ def get_testing_ds1(config: dict, model_folder: str, sentence: str) -> Tuple[str
     # build tokenizers
     tokenizer_src = get_tokenizer1(config, model_folder, config["lang_src"])
     tokenizer_tgt = get_tokenizer1(config, model_folder, config["lang_tgt"])
+    # Same seq_len as the training. See length_stats.apply_seq_len
+    apply_seq_len(config, load_length_stats(config, model_folder), verbose=False)
 
     # keep 90% for training and 10% for validation
     label = None
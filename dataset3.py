@@ -16,6 +16,9 @@ from tokenizers.trainers import WordLevelTrainer
 from tokenizers.pre_tokenizers import Whitespace
 
 from pathlib import Path
+from bucketing import get_train_dataloader
+from length_stats import apply_seq_len, filter_pairs, get_length_stats, load_length_stats
+from token_cache import TokenCache, get_token_cache
 from config import EOS, SOS, PAD, UNK
 
 
@@ -27,7 +30,7 @@ def nopeak_mask(size: int) -> Tensor:
 
 class Dataset3(Dataset):
 
-    def __init__(self, ds, t_src: Tokenizer, t_trg: Tokenizer, src_lang: str, tgt_lang: str, seq_len: int) -> None:
+    def __init__(self, ds, t_src: Tokenizer, t_trg: Tokenizer, src_lang: str, tgt_lang: str, seq_len: int, token_ids: TokenCache = None) -> None:
         super().__init__()
 
         self.ds = ds
@@ -36,6 +39,8 @@ class Dataset3(Dataset):
         self.src_lang = src_lang
         self.tgt_lang = tgt_lang
         self.seq_len = seq_len
+        # Pre-tokenized pairs. See token_cache.get_token_cache
+        self.token_ids = token_ids
 
         self.sos_token = torch.tensor([t_trg.token_to_id(SOS)], dtype=torch.int64)
         self.eos_token = torch.tensor([t_trg.token_to_id(EOS)], dtype=torch.int64)
@@ -50,8 +55,11 @@ class Dataset3(Dataset):
         tgt_text = src_target_pair[self.tgt_lang]
 
         # Transform the text into tokens
-        enc_input_tokens = self.t_src.encode(src_text).ids
-        dec_input_tokens = self.t_trg.encode(tgt_text).ids
+        if self.token_ids is not None:
+            enc_input_tokens, dec_input_tokens = self.token_ids[idx]
+        else:
+            enc_input_tokens = self.t_src.encode(src_text).ids
+            dec_input_tokens = self.t_trg.encode(tgt_text).ids
 
         # need to pad the sentence to sequence lenght.
         # minus two because we add start and end
@@ -72,7 +80,7 @@ class Dataset3(Dataset):
         encoder_input = torch.cat(
             [
                 self.sos_token,
-                torch.tensor(enc_input_tokens, dtype=torch.int64),
+                torch.as_tensor(enc_input_tokens, dtype=torch.int64),
                 self.eos_token,
                 torch.tensor([self.pad_token] * enc_num_padding_tokens, dtype=torch.int64),
             ],
@@ -85,7 +93,7 @@ class Dataset3(Dataset):
         decoder_input = torch.cat(
             [
                 self.sos_token,
-                torch.tensor(dec_input_tokens, dtype=torch.int64),
+                torch.as_tensor(dec_input_tokens, dtype=torch.int64),
                 torch.tensor([self.pad_token] * dec_num_padding_tokens, dtype=torch.int64),
             ],
             dim=0,
@@ -94,7 +102,7 @@ class Dataset3(Dataset):
         # Add EOS to label
         label = torch.cat(
             [
-                torch.tensor(dec_input_tokens, dtype=torch.int64),
+                torch.as_tensor(dec_input_tokens, dtype=torch.int64),
                 self.eos_token,
                 torch.tensor([self.pad_token] * dec_num_padding_tokens, dtype=torch.int64),
             ],
@@ -189,22 +197,31 @@ def get_ds3(config: dict, model_folder: str) -> Tuple[DataLoader, DataLoader, To
     val_ds_size = len(ds_raw) - train_ds_size
     train_ds_raw, val_ds_raw = random_split(ds_raw, [train_ds_size, val_ds_size])
 
-    train_ds = Dataset3(train_ds_raw, tokenizer_src, tokenizer_tgt, config["lang_src"], config["lang_tgt"], config["seq_len"])
-    val_ds = Dataset3(val_ds_raw, tokenizer_src, tokenizer_tgt, config["lang_src"], config["lang_tgt"], config["seq_len"])
+    def get_texts(item) -> Tuple[str, str]:
+        return item[config["lang_src"]], item[config["lang_tgt"]]
+
+    # Tokenized once into the model folder when token_cache is set
+    token_ids = None
+    if config.get("token_cache", False):
+        token_ids = get_token_cache(config, model_folder, ds_raw, tokenizer_src, tokenizer_tgt, get_texts)
 
-    max_len_src = 0
-    max_len_tgt = 0
+    # Stored with the tokenizers. Picks seq_len with seq_len_percentile and drops the pairs longer than seq_len
+    stats = get_length_stats(config, model_folder, ds_raw, tokenizer_src, tokenizer_tgt, get_texts, token_ids)
+    seq_len = apply_seq_len(config, stats)
+    train_ds_raw = filter_pairs(train_ds_raw, stats, seq_len)
+    val_ds_raw = filter_pairs(val_ds_raw, stats, seq_len)
 
-    for item in ds_raw:
-        src_ids = tokenizer_src.encode(item[config["lang_src"]]).ids
-        tgt_ids = tokenizer_tgt.encode(item[config["lang_tgt"]]).ids
-        max_len_src = max(max_len_src, len(src_ids))
-        max_len_tgt = max(max_len_tgt, len(tgt_ids))
+    train_ids = None
+    val_ids = None
+    if token_ids is not None:
+        train_ids = token_ids.subset(train_ds_raw.indices)
+        val_ids = token_ids.subset(val_ds_raw.indices)
 
-    print(f"Max length of source sentence: {max_len_src}")
-    print(f"Max length of target sentence: {max_len_tgt}")
+    train_ds = Dataset3(train_ds_raw, tokenizer_src, tokenizer_tgt, config["lang_src"], config["lang_tgt"], config["seq_len"], train_ids)
+    val_ds = Dataset3(val_ds_raw, tokenizer_src, tokenizer_tgt, config["lang_src"], config["lang_tgt"], config["seq_len"], val_ids)
 
-    train_dataloader = DataLoader(train_ds, batch_size=config["batch_size"], shuffle=True)
+    # See bucketing.get_train_dataloader
+    train_dataloader = get_train_dataloader(config, train_ds, stats.pair_lengths[train_ds_raw.indices].tolist(), ("src", "trg", "label"))
     val_dataloader = DataLoader(val_ds, batch_size=1, shuffle=True)
 
     return train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt
@@ -215,6 +232,8 @@ def get_testing_ds3(config: dict, model_folder: str, sentence: str) -> Tuple[str
     # build tokenizers
     tokenizer_src = get_tokenizer3(config, model_folder, config["lang_src"])
     tokenizer_tgt = get_tokenizer3(config, model_folder, config["lang_tgt"])
+    # Same seq_len as the training. See length_stats.apply_seq_len
+    apply_seq_len(config, load_length_stats(config, model_folder), verbose=False)
 
     # keep 90% for training and 10% for validation
     label = ""
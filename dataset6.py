@@ -231,6 +231,76 @@ english_vocabulary = [
 NEG_INFTY = -1e9
 
 
+class CharLookup6:
+    # JEB: model6 tokenizes character per character. The char -> index mapping is precompiled into a
+    # table indexed by the unicode code point, so a whole batch is encoded with a few numpy operations
+    # instead of one dict lookup per character.
+
+    def __init__(
+        self, language_to_index: dict, max_sequence_length: int, start_token: str = START_TOKEN, end_token: str = END_TOKEN, padding_token: str = PADDING_TOKEN
+    ):
+        self.max_sequence_length = max_sequence_length
+        self.start_idx = language_to_index[start_token]
+        self.end_idx = language_to_index[end_token]
+        self.padding_idx = language_to_index[padding_token]
+        # Unknown characters are mapped to UNK when the vocabulary has one
+        self.unk_idx = language_to_index.get(UNK, -1)
+        chars = {token: index for token, index in language_to_index.items() if len(token) == 1}
+        self.table = np.full(max((ord(char) for char in chars), default=0) + 1, self.unk_idx, dtype=np.int64)
+        for char, index in chars.items():
+            self.table[ord(char)] = index
+
+    # encode returns a (bs, pad_to) int64 Tensor. pad_to defaults to max_sequence_length
+    def encode(self, batched_sentences: tuple[str], start_token: bool, end_token: bool, pad_to: int = None) -> Tensor:
+        pad_to = pad_to or self.max_sequence_length
+        batch_size = len(batched_sentences)
+        lengths = np.array([len(sentence) for sentence in batched_sentences], dtype=np.int64)
+        offset = 1 if start_token else 0
+        if batch_size > 0 and lengths.max() + offset + (1 if end_token else 0) > pad_to:
+            raise ValueError("Sentence is too long")
+
+        # Code points of every character of the batch, in one array
+        codes = np.frombuffer("".join(batched_sentences).encode("utf-32-le"), dtype=np.uint32).astype(np.int64)
+        ids = np.full(codes.shape, self.unk_idx, dtype=np.int64)
+        known = codes < len(self.table)
+        ids[known] = self.table[codes[known]]
+        if (ids < 0).any():
+            raise ValueError("Unknown character")
+
+        tokens = np.full((batch_size, pad_to), self.padding_idx, dtype=np.int64)
+        columns = np.arange(pad_to)[None, :]
+        # The characters fill the cells [offset, offset + length) of each row, in row major order
+        tokens[(columns >= offset) & (columns < offset + lengths[:, None])] = ids
+        if start_token:
+            tokens[:, 0] = self.start_idx
+        if end_token:
+            tokens[np.arange(batch_size), offset + lengths] = self.end_idx
+        return torch.from_numpy(tokens)
+
+
+class Collate6:
+    # Tokenize the batch in the DataLoader (possibly in its workers) rather than in the training loop
+
+    def __init__(self, src_lookup: CharLookup6, tgt_lookup: CharLookup6):
+        self.src_lookup = src_lookup
+        self.tgt_lookup = tgt_lookup
+
+    def __call__(self, batch: list[Tuple[str, str]]) -> dict:
+        src_text, tgt_text = zip(*batch)
+        return {
+            "src_text": src_text,
+            "tgt_text": tgt_text,
+            # During training, model6 does not add sos/eos to the encoder input
+            "encoder_input": self.src_lookup.encode(src_text, start_token=False, end_token=False),  # (bs, SeqLen)
+            # During training, model6 DOES add sos and eos to the decoder input
+            "decoder_input": self.tgt_lookup.encode(tgt_text, start_token=True, end_token=True),  # (bs, SeqLen)
+            "label": self.tgt_lookup.encode(tgt_text, start_token=False, end_token=True),  # (bs, SeqLen)
+            # Number of characters of each sentence. See Dataset6.create_masks_from_lengths
+            "src_len": torch.tensor([len(sentence) for sentence in src_text]),  # (bs,)
+            "tgt_len": torch.tensor([len(sentence) for sentence in tgt_text]),  # (bs,)
+        }
+
+
 class Dataset6Tmp(Dataset):
 
     def __init__(self, src_sentences: list[str], tgt_sentences: list[str]):
@@ -286,52 +356,47 @@ class Dataset6(Dataset):
         return self.ds[idx]
 
     @staticmethod
-    def create_masks(eng_batch: tuple[str], kn_batch: tuple[str], seq_len: int) -> Tuple[Tensor, Tensor, Tensor]:
-        batch_size = len(eng_batch)
-        # Create a tensor (SeqLen, SeqLen). Cell above the diagonals are set to True, cell bellow to 0.
-        look_ahead_mask = torch.full([seq_len, seq_len], True)  # (SeqLen, SeqLen)
-        look_ahead_mask = torch.triu(look_ahead_mask, diagonal=1)  # (SeqLen, SeqLen)
-        # Create three tensors (bs, SeqLen, SeqLen)
-        # (bs, SeqLen, SeqLen) filled with False
-        encoder_padding_mask = torch.full([batch_size, seq_len, seq_len], False)
-        decoder_padding_mask_self_attention = torch.full([batch_size, seq_len, seq_len], False)  # (bs, SeqLen, SeqLen) filled with False
-        decoder_padding_mask_cross_attention = torch.full([batch_size, seq_len, seq_len], False)  # (bs, SeqLen, SeqLen) filled with False
-
-        for idx in range(batch_size):
-            # each sentence is tokenize character per character
-            # Hence the number of token to build the mask is the length of the sentence
-            eng_sentence_length, kn_sentence_length = len(eng_batch[idx]), len(kn_batch[idx])
-            eng_chars_to_padding_mask = np.arange(eng_sentence_length + 1, seq_len)  # [56,57,....80]
-            kn_chars_to_padding_mask = np.arange(kn_sentence_length + 1, seq_len)  # [21,22,23...80]
-            # keep the top-left quadrant of the matrix. Assign the three other quadant to True
-            encoder_padding_mask[idx, :, eng_chars_to_padding_mask] = True  # set the right columns to True
-            encoder_padding_mask[idx, eng_chars_to_padding_mask, :] = True  # set the bottom rows to True
-            # keep the top-left quadrant of the matrix. Assign the three other quadant to True
-            # set the right columns to True
-            decoder_padding_mask_self_attention[idx, :, kn_chars_to_padding_mask] = True
-            decoder_padding_mask_self_attention[idx, kn_chars_to_padding_mask, :] = True  # set the bottom rows to True
-            # keep the top-left quadrant of the matrix. Assign the three other quadant to True
-            decoder_padding_mask_cross_attention[idx, :, eng_chars_to_padding_mask] = True  # set the right columns to True
-            decoder_padding_mask_cross_attention[idx, kn_chars_to_padding_mask, :] = True  # set the bottom rows to True
-
-        # The sensor has the shape (bs, SeqLen, SeqLen)
-        # In each element/matrix of the batch, (SeqLen, SeqLen matrix the top-left quadrant is set to 0 and the other 3 quadrant to -inf
-        # In each element/matrix of the batch, the "size of the quadrant" in each matrix dependent on the length of the src sentence.
-        encoder_self_attention_mask = torch.where(encoder_padding_mask, NEG_INFTY, 0)  # (bs, SeqLen, SeqLen)
-
-        # The sensor has the shape (bs, SeqLen, SeqLen)
-        # In each element/matrix of the batch, (SeqLen, SeqLen matrix the top-left quadrant is set to 0 and the other 3 quadrant to -inf
-        # In each element/matrix of the batch, the "size of the quadrant" in each matrix dependent on the length of the tgt sentence.
-        # Finally any cell above the diagonal will be set to -inf and the one bellow to 0
-        # JEB: Understand the +, looks like on each cell bellow the diagonal mix between 0 (int) and bolean (False)
-        decoder_self_attention_mask = torch.where(look_ahead_mask + decoder_padding_mask_self_attention, NEG_INFTY, 0)  # (bs, SeqLen, SeqLen)
-        # JEB: Seems to be working
-        # print(decoder_self_attention_mask[0])
-
-        # The sensor has the shape (bs, SeqLen, SeqLen)
-        # In each element/matrix of the batch, (SeqLen, SeqLen matrix the top-left quadrant is set to 0 and the other 3 quadrant to -inf
-        # In each element/matrix of the batch, the "size of the quadrant" in each matrix dependent on the length of the tgt sentence.
-        decoder_cross_attention_mask = torch.where(decoder_padding_mask_cross_attention, NEG_INFTY, 0)  # (bs, SeqLen, SeqLen)
+    def create_masks(eng_batch: tuple[str], kn_batch: tuple[str], seq_len: int, device=None, form: str = "float") -> Tuple[Tensor, Tensor, Tensor]:
+        # each sentence is tokenize character per character
+        # Hence the number of token to build the mask is the length of the sentence
+        eng_lengths = torch.tensor([len(sentence) for sentence in eng_batch])
+        kn_lengths = torch.tensor([len(sentence) for sentence in kn_batch])
+        return Dataset6.create_masks_from_lengths(eng_lengths, kn_lengths, seq_len, device, form)
+
+    @staticmethod
+    def create_masks_from_lengths(src_lengths: Tensor, tgt_lengths: Tensor, seq_len: int, device=None, form: str = "float") -> Tuple[Tensor, Tensor, Tensor]:
+        # src_lengths and tgt_lengths are (bs,) tensors with the number of characters of each sentence.
+        # The masks are built on device with broadcast comparisons.
+        # form "float": (bs, SeqLen, SeqLen) tensors, NEG_INFTY for the masked cells, 0 otherwise
+        # form "bool": the same (bs, SeqLen, SeqLen) masks, True for the masked cells
+        # form "key_padding": compact boolean masks which scaled_dot_product broadcasts. Only the padding
+        #   columns (keys) are masked, the padding rows (queries) are not: their outputs are never used.
+        #   encoder (bs, 1, SeqLen), decoder self attention (1, SeqLen, SeqLen), cross attention (bs, 1, SeqLen)
+        positions = torch.arange(seq_len, device=device)
+        # JEB: As in the original code, the first padding position (index length) is not masked
+        src_padding = positions[None, :] > src_lengths.to(device)[:, None]  # (bs, SeqLen)
+        tgt_padding = positions[None, :] > tgt_lengths.to(device)[:, None]  # (bs, SeqLen)
+        # Create a tensor (SeqLen, SeqLen). Cell above the diagonals are set to True, cell bellow to False.
+        look_ahead_mask = torch.triu(torch.ones(seq_len, seq_len, dtype=torch.bool, device=device), diagonal=1)
+
+        if form == "key_padding":
+            return src_padding[:, None, :], look_ahead_mask[None, :, :], src_padding[:, None, :]
+
+        # keep the top-left quadrant of the matrix. Assign the three other quadant to True
+        encoder_padding_mask = src_padding[:, None, :] | src_padding[:, :, None]  # (bs, SeqLen, SeqLen)
+        # Finally any cell above the diagonal is masked too
+        decoder_padding_mask_self_attention = look_ahead_mask | tgt_padding[:, None, :] | tgt_padding[:, :, None]  # (bs, SeqLen, SeqLen)
+        # The columns follow the source, the rows follow the target
+        decoder_padding_mask_cross_attention = src_padding[:, None, :] | tgt_padding[:, :, None]  # (bs, SeqLen, SeqLen)
+        if form == "bool":
+            return encoder_padding_mask, decoder_padding_mask_self_attention, decoder_padding_mask_cross_attention
+        if form != "float":
+            raise ValueError(f"{form} mask form is not supported")
+
+        # In each element/matrix of the batch, the masked cells are set to -inf and the other ones to 0
+        encoder_self_attention_mask = torch.where(encoder_padding_mask, NEG_INFTY, 0.0)  # (bs, SeqLen, SeqLen)
+        decoder_self_attention_mask = torch.where(decoder_padding_mask_self_attention, NEG_INFTY, 0.0)  # (bs, SeqLen, SeqLen)
+        decoder_cross_attention_mask = torch.where(decoder_padding_mask_cross_attention, NEG_INFTY, 0.0)  # (bs, SeqLen, SeqLen)
         return encoder_self_attention_mask, decoder_self_attention_mask, decoder_cross_attention_mask
 
 
@@ -420,7 +485,9 @@ def get_ds6(config: dict, model_folder: str) -> Tuple[DataLoader, DataLoader, in
     train_ds = Dataset6(train_ds_raw)
     val_ds = Dataset6(val_ds_raw)
 
-    train_dataloader = DataLoader(train_ds, config["batch_size"])
+    # The training batches are tokenized by the collate function
+    collate_fn = Collate6(CharLookup6(tokenizer_src.get_vocab(), config["seq_len"]), CharLookup6(tokenizer_tgt.get_vocab(), config["seq_len"]))
+    train_dataloader = DataLoader(train_ds, config["batch_size"], collate_fn=collate_fn, num_workers=config.get("num_workers", 0))
     val_dataloader = DataLoader(val_ds, 1)
 
     # return train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt
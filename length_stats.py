@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# Length statistics of the pairs of Dataset1, Dataset2 and Dataset3.
+# The source and target lengths are computed once, stored next to the tokenizer files and reused to pick seq_len
+# and to drop the pairs longer than seq_len before the training, instead of "Sentence is too long" in the middle of an epoch.
+
+import json
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+from torch.utils.data import Subset
+from tokenizers import Tokenizer
+
+from bucketing import round_up
+from token_cache import ENCODE_BATCH_SIZE, TokenCache, token_cache_key
+
+# Percentiles printed by LengthStats.summary
+SUMMARY_PERCENTILES = (50, 90, 99, 99.9)
+
+
+class LengthStats:
+    """Token counts of the source and target sentences of every pair of a dataset."""
+
+    def __init__(self, src_lengths: np.ndarray, tgt_lengths: np.ndarray):
+        self.src_lengths = np.asarray(src_lengths, dtype=np.int64)
+        self.tgt_lengths = np.asarray(tgt_lengths, dtype=np.int64)
+        # Padded length needed by each pair: sos + eos on the source, sos or eos on the target
+        self.pair_lengths = np.maximum(self.src_lengths + 2, self.tgt_lengths + 1)
+
+    @staticmethod
+    def histogram(lengths: np.ndarray) -> dict:
+        values, counts = np.unique(lengths, return_counts=True)
+        return {int(value): int(count) for value, count in zip(values, counts)}
+
+    def percentile(self, q: float) -> int:
+        # Smallest length covering q% of the pairs
+        return int(np.percentile(self.pair_lengths, q, method="higher"))
+
+    def coverage(self, seq_len: int) -> float:
+        return 100.0 * float((self.pair_lengths <= seq_len).mean())
+
+    def summary(self, seq_len: int) -> str:
+        percentiles = ", ".join(f"p{q}: {self.percentile(q)}" for q in SUMMARY_PERCENTILES)
+        return (
+            f"Max length of source sentence: {self.src_lengths.max()}\n"
+            f"Max length of target sentence: {self.tgt_lengths.max()}\n"
+            f"Pair lengths {percentiles}, max: {self.pair_lengths.max()}. seq_len {seq_len} covers {self.coverage(seq_len):.2f}% of the pairs"
+        )
+
+
+def length_stats_path(config: dict, model_folder: str) -> Path:
+    return Path(model_folder + "/" + config["tokenizer_file"].format("lengths") + ".json")
+
+
+def encoded_lengths(tokenizer: Tokenizer, sentences: list[str]) -> np.ndarray:
+    lengths = []
+    for start in range(0, len(sentences), ENCODE_BATCH_SIZE):
+        lengths.extend(len(encoding.ids) for encoding in tokenizer.encode_batch(sentences[start : start + ENCODE_BATCH_SIZE]))
+    return np.asarray(lengths, dtype=np.int64)
+
+
+def get_length_stats(
+    config: dict,
+    model_folder: str,
+    ds_raw,
+    tokenizer_src: Tokenizer,
+    tokenizer_tgt: Tokenizer,
+    get_texts: Callable[[dict], Tuple[str, str]],
+    token_ids: TokenCache = None,
+) -> LengthStats:
+    # Recomputed when the dataset or the tokenizers change. Same key as the token cache
+    key = token_cache_key(ds_raw, tokenizer_src, tokenizer_tgt, config["lang_src"], config["lang_tgt"])
+    path = length_stats_path(config, model_folder)
+    if path.exists():
+        with open(path) as f:
+            saved = json.load(f)
+        if saved["key"] == key:
+            return LengthStats(saved["src_lengths"], saved["tgt_lengths"])
+
+    if token_ids is not None:
+        # The offsets of the token cache already give the lengths
+        stats = LengthStats(token_ids.src_lengths(), token_ids.tgt_lengths())
+    else:
+        sources, targets = zip(*(get_texts(item) for item in ds_raw))
+        stats = LengthStats(encoded_lengths(tokenizer_src, list(sources)), encoded_lengths(tokenizer_tgt, list(targets)))
+
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "key": key,
+                "src_histogram": LengthStats.histogram(stats.src_lengths),
+                "tgt_histogram": LengthStats.histogram(stats.tgt_lengths),
+                "pair_histogram": LengthStats.histogram(stats.pair_lengths),
+                "src_lengths": stats.src_lengths.tolist(),
+                "tgt_lengths": stats.tgt_lengths.tolist(),
+            },
+            f,
+        )
+    return stats
+
+
+def load_length_stats(config: dict, model_folder: str) -> Optional[LengthStats]:
+    # Saved by get_length_stats during the training. None when the model was trained without it
+    path = length_stats_path(config, model_folder)
+    if not path.exists():
+        return None
+    with open(path) as f:
+        saved = json.load(f)
+    return LengthStats(saved["src_lengths"], saved["tgt_lengths"])
+
+
+def apply_seq_len(config: dict, stats: Optional[LengthStats], verbose: bool = True) -> int:
+    # With seq_len_percentile, seq_len becomes that percentile of the pair lengths, rounded up to a multiple of 8.
+    # Also used at translation time so the model is rebuilt with the seq_len it was trained with
+    percentile = config.get("seq_len_percentile", None)
+    if stats is not None:
+        if percentile is not None:
+            config["seq_len"] = round_up(stats.percentile(percentile), 8)
+        if verbose:
+            print(stats.summary(config["seq_len"]))
+    return config["seq_len"]
+
+
+def filter_pairs(subset: Subset, stats: LengthStats, seq_len: int) -> Subset:
+    # Drops the pairs which do not fit in seq_len from a random_split subset
+    kept = [i for i in subset.indices if stats.pair_lengths[i] <= seq_len]
+    if len(kept) < len(subset.indices):
+        print(f"Dropped {len(subset.indices) - len(kept)} of {len(subset.indices)} pairs longer than seq_len {seq_len}")
+    return Subset(subset.dataset, kept)
@@ -6,7 +6,9 @@ import torch.nn as nn
 import math
 from torch import Tensor
 
+from attention import FusableQKV, naive_attention, scaled_dot_product
 from dataset1 import translation_mask, casual_mask
+from normalization import std_layer_norm
 
 # Layer normalization. Minute 14:00. Each sentence is made of many words
 # For each sentence compute the mean and variance for each item/sentence
@@ -25,8 +27,12 @@ class LayerNormalization(nn.Module):
         # Parameter is learnable. Multiplied
         # JEB: Need to undertand why bias is set to 0 and alpha to 1
         self.bias = nn.Parameter(torch.zeros(features))
+        # Use the fused F.layer_norm kernel. See normalization.configure_norms
+        self.fast_norm = False
 
     def forward(self, x) -> Tensor:
+        if self.fast_norm:
+            return std_layer_norm(x, self.alpha, self.bias, self.eps)
         # usually the mean cancels the dimension to which it is applied
         # x: (bs, SeqLen, hidden_size)
         # Keep the dimension for broadcasting
@@ -36,6 +42,15 @@ class LayerNormalization(nn.Module):
         # eps is to prevent dividing by zero or when std is very small
         return self.alpha * (x - mean) / (std + self.eps) + self.bias
 
+    def to_layer_norm(self) -> nn.LayerNorm:
+        # Equivalent nn.LayerNorm. The unbiased std is folded into the weight. See normalization.std_layer_norm
+        n = self.alpha.shape[-1]
+        layer_norm = nn.LayerNorm(n, eps=self.eps * self.eps * (n - 1) / n, device=self.alpha.device, dtype=self.alpha.dtype)
+        with torch.no_grad():
+            layer_norm.weight.copy_(self.alpha * math.sqrt((n - 1) / n))
+            layer_norm.bias.copy_(self.bias)
+        return layer_norm
+
 
 # Feed foward: Fully connected layer. Two matrices which are multiplied with the relu in between
 class FeedForwardBlock(nn.Module):
@@ -99,10 +114,11 @@ class PositionalEncoding(nn.Module):
         # we want the tensor to be saved with the model but not as parameter
         self.register_buffer("pe", pe)
 
-    def forward(self, x) -> Tensor:
+    def forward(self, x, start: int = 0) -> Tensor:
         # we need to the positional encoding to every word in the sentence
         # that self.pe is fixed and does not need to be learned, hence requires_grad set to False
-        x = x + (self.pe[:, : x.shape[1], :]).requires_grad_(False)
+        # start is used by the incremental decoder which only embeds the newest position
+        x = x + (self.pe[:, start : start + x.shape[1], :]).requires_grad_(False)
         return self.dropout(x)
 
 
@@ -132,9 +148,10 @@ class ResidualConnection(nn.Module):
 # We also have to account for the batch dimension if you have more than one sentence.
 
 
-class MultiHeadAttentionBlock(nn.Module):
+class MultiHeadAttentionBlock(FusableQKV, nn.Module):
+    qkv_names = ("w_q", "w_k", "w_v")
 
-    def __init__(self, d_model: int, h: int, dropout: float) -> None:
+    def __init__(self, d_model: int, h: int, dropout: float, causal: bool = False) -> None:
         super().__init__()
         self.d_model = d_model  # Embedding vector size
         self.h = h  # Number of heads
@@ -148,32 +165,30 @@ class MultiHeadAttentionBlock(nn.Module):
         self.w_o = nn.Linear(d_model, d_model, bias=False)  # (h * dv * dk)
         self.dropout = nn.Dropout(dropout)
 
+        # See attention.scaled_dot_product. causal is True for the self attention of the decoder
+        self.causal = causal
+        self.attention_backend = "naive"
+
+        # K/V cache used by the incremental decoder. See init_cache and precompute_kv
+        self.cache_k = None
+        self.cache_v = None
+        self.cache_len = 0
+
     @staticmethod
     def attention(query, key, value, mask, dropout: nn.Dropout):
-        d_k = query.shape[-1]
-
-        # (Batch, h, Seq_Len, d_k) --> (Batch, h, Seq_Len, Seq_Len)
-        # we transpose the last two dimension. key is ...Seq_Len, d_k so it becomes...d_k, Seq_Len
-        attention_scores = (query @ key.transpose(-2, -1)) / math.sqrt(d_k)
-        if mask is not None:
-            # Replace all the value for which mask == 0 with -1e9 (minus infinity)
-            # Some words will not be able to see future words...or padding values
-            attention_scores.masked_fill(mask == 0, -1e9)
-        attention_scores = attention_scores.softmax(dim=-1)  # (Batch, h, Seq_Len, Seq_Len)
-        if dropout is not None:
-            attention_scores = dropout(attention_scores)
-
-        # (batch, h, seq_len, seq_len) --> (batch, h, seq_len, d_k)
+        # (Batch, h, Seq_Len, d_k) --> (Batch, h, Seq_Len, Seq_Len) --> (batch, h, seq_len, d_k)
+        # Replace all the value for which mask == 0 with -1e9 (minus infinity)
+        # Some words will not be able to see future words...or padding values
         # We return a tuple....attention_scores is mainly used for visualizing
-        return (attention_scores @ value), attention_scores
+        # JEB: The implementation is now shared with the other models. See attention.naive_attention
+        return naive_attention(query, key, value, mask, dropout)
 
     def forward(self, q, k, v, mask) -> Tensor:
         # mask avoid that some word interact with some other workds
         # we need to put a value very small to the matrix before we apply
         # the soft max. e to the power of infinity will be very small.
-        query = self.w_q(q)  # (bs, SeqLen, d_model) --> (bs, SeqLen, d_model)
-        key = self.w_k(k)  # (bs, SeqLen, d_model) --> (bs, SeqLen, d_model)
-        value = self.w_v(v)  # (bs, SeqLen, d_model) --> (bs, SeqLen, d_model)
+        # (bs, SeqLen, d_model) --> (bs, SeqLen, d_model). One matmul when the projections are fused
+        query, key, value = self.project_qkv(q, k, v)
 
         # Batch dimension is preserved, Seuence dimension is preserved,
         # We want the h dimension to be the second dimension hence we invoke the transpose method.
@@ -182,7 +197,7 @@ class MultiHeadAttentionBlock(nn.Module):
         key = key.view(key.shape[0], key.shape[1], self.h, self.d_k).transpose(1, 2)
         value = value.view(value.shape[0], value.shape[1], self.h, self.d_k).transpose(1, 2)
 
-        x, self.attention_scores = MultiHeadAttentionBlock.attention(query, key, value, mask, self.dropout)
+        x, self.attention_scores = scaled_dot_product(query, key, value, mask, self.dropout, self.causal, self.attention_backend)
 
         # (Batch, h, Seq_Len, d_K) --> (Batch, Sql_Len, h, d_K) -->  (bs, SeqLen, d_model
         # Pytorch needs the memory to be continguouos to create a view
@@ -191,6 +206,71 @@ class MultiHeadAttentionBlock(nn.Module):
         # (bs, SeqLen, d_model) --> (Batch, Sql_Len, d_model)
         return self.w_o(x)
 
+    def split_heads(self, x: Tensor) -> Tensor:
+        # (bs, SeqLen, d_model) --> (bs, SeqLen, h, d_k) --> (Batch, h, Seq_Len, d_k)
+        return x.view(x.shape[0], x.shape[1], self.h, self.d_k).transpose(1, 2)
+
+    def init_cache(self, batch_size: int, max_len: int, device, dtype) -> None:
+        # Self attention cache. Preallocated for max_len positions and filled one step at a time
+        self.cache_k = torch.empty(batch_size, self.h, max_len, self.d_k, device=device, dtype=dtype)
+        self.cache_v = torch.empty(batch_size, self.h, max_len, self.d_k, device=device, dtype=dtype)
+        self.cache_len = 0
+
+    def precompute_kv(self, k: Tensor, v: Tensor) -> None:
+        # Cross attention cache. The encoder output does not change during decoding,
+        # so its keys and values are projected only once per source
+        key, value = self.project_kv(k, v)
+        self.cache_k = self.split_heads(key)
+        self.cache_v = self.split_heads(value)
+        self.cache_len = k.shape[1]
+
+    def reorder_cache(self, index: Tensor) -> None:
+        # Keep (and reorder) only the rows listed in index along the batch dimension
+        if self.cache_k is not None:
+            self.cache_k = self.cache_k.index_select(0, index)
+            self.cache_v = self.cache_v.index_select(0, index)
+
+    def clear_cache(self) -> None:
+        self.cache_k = None
+        self.cache_v = None
+        self.cache_len = 0
+
+    def forward_step(self, q: Tensor, mask, append: bool) -> Tensor:
+        # Incremental version of forward. Only the new positions q are projected.
+        # When append is True (self attention), their keys and values are written into the cache first.
+        # q shape is (bs, NewLen, d_model). Output shape is (bs, NewLen, d_model)
+        if append:
+            query, key, value = self.project_qkv(q, q, q)
+            start = self.cache_len
+            self.cache_k[:, :, start : start + q.shape[1]] = self.split_heads(key)
+            self.cache_v[:, :, start : start + q.shape[1]] = self.split_heads(value)
+            self.cache_len = start + q.shape[1]
+        else:
+            query = self.project_q(q)
+        query = self.split_heads(query)
+        key = self.cache_k[:, :, : self.cache_len]
+        value = self.cache_v[:, :, : self.cache_len]
+
+        group = query.shape[0] // key.shape[0]
+        if group > 1:
+            # Beam search: the cache holds one row per sentence and the queries one row per beam.
+            # The beams of a sentence share its keys and values through broadcasting instead of copies.
+            # (bs * beam, h, NewLen, d_k) --> (bs, beam, h, NewLen, d_k)
+            query = query.view(key.shape[0], group, *query.shape[1:])
+            key = key.unsqueeze(1)
+            value = value.unsqueeze(1)
+            if mask is not None:
+                mask = mask.unsqueeze(1)
+
+        x, self.attention_scores = scaled_dot_product(query, key, value, mask, self.dropout, self.causal, self.attention_backend)
+
+        if group > 1:
+            # (bs, beam, h, NewLen, d_k) --> (bs * beam, h, NewLen, d_k)
+            x = x.flatten(0, 1)
+
+        x = x.transpose(1, 2).contiguous().view(x.shape[0], -1, self.h * self.d_k)
+        return self.w_o(x)
+
 
 class EncoderBlock(nn.Module):
 
@@ -256,6 +336,30 @@ class DecoderBlock(nn.Module):
         x = self.residual_connections[2](x, self.feed_forward_block)
         return x
 
+    def init_cache(self, encoder_output: Tensor, max_len: int, beam_size: int = 1) -> None:
+        # The self attention cache has one row per beam, the cross attention cache one row per sentence
+        self.self_attention_block.init_cache(encoder_output.shape[0] * beam_size, max_len, encoder_output.device, encoder_output.dtype)
+        self.cross_attention_block.precompute_kv(encoder_output, encoder_output)
+
+    def reorder_cache(self, index: Tensor, cross_index: Tensor = None) -> None:
+        # The cross attention cache is only reordered when cross_index is provided.
+        # During beam search the beams are reordered at each step but the sentences are not.
+        self.self_attention_block.reorder_cache(index)
+        if cross_index is not None:
+            self.cross_attention_block.reorder_cache(cross_index)
+
+    def clear_cache(self) -> None:
+        self.self_attention_block.clear_cache()
+        self.cross_attention_block.clear_cache()
+
+    # forward_step only processes the new positions. Previous positions are read from the cache
+    def forward_step(self, x, src_mask: Tensor) -> Tensor:
+        # The new positions can see all the cached positions, hence no causal mask is needed
+        x = self.residual_connections[0](x, lambda x: self.self_attention_block.forward_step(x, None, append=True))
+        x = self.residual_connections[1](x, lambda x: self.cross_attention_block.forward_step(x, src_mask, append=False))
+        x = self.residual_connections[2](x, self.feed_forward_block)
+        return x
+
 
 class Decoder(nn.Module):
 
@@ -275,6 +379,12 @@ class Decoder(nn.Module):
             x = layer(x, encoder_output, src_mask, tgt_mask)
         return self.norm(x)
 
+    def forward_step(self, x, src_mask: Tensor) -> Tensor:
+        # x shape is (bs, NewLen, d_model)
+        for layer in self.layers:
+            x = layer.forward_step(x, src_mask)
+        return self.norm(x)
+
 
 class ProjectionLayer(nn.Module):
 
@@ -332,12 +442,242 @@ class Transformer1(nn.Module):
     def project(self, x: Tensor) -> Tensor:
         return self.projection_layer(x)
 
-    def greedy_decode(self, source: Tensor, source_mask: Tensor, eos_idx: int, sos_idx: int, max_len: int, device):
+    def init_decode_cache(self, encoder_output: Tensor, max_len: int, beam_size: int = 1) -> None:
+        # Allocate the self attention caches and project the encoder output once for every decoder layer
+        for layer in self.decoder.layers:
+            layer.init_cache(encoder_output, max_len, beam_size)
+
+    def reorder_decode_cache(self, index: Tensor, cross_index: Tensor = None) -> None:
+        for layer in self.decoder.layers:
+            layer.reorder_cache(index, cross_index)
+
+    def clear_decode_cache(self) -> None:
+        for layer in self.decoder.layers:
+            layer.clear_cache()
+
+    def decode_step(self, src_mask: Tensor, tgt: Tensor, start: int) -> Tensor:
+        # tgt contains only the new tokens (bs, NewLen). start is the position of the first one.
+        # init_decode_cache must have been called before the first step.
+        # (bs, NewLen, d_model)
+        tgt = self.tgt_embed(tgt)
+        tgt = self.tgt_pos(tgt, start)
+        return self.decoder.forward_step(tgt, src_mask)
+
+    def greedy_decode(self, source: Tensor, source_mask: Tensor, eos_idx: int, sos_idx: int, max_len: int, device, use_cache: bool = True):
 
         # Precompute the encoder output and reuse it for every step
         # source is (1, SeqLen, d_model) and source_mask (1, SeqLen, d_model)
         encoder_output = self.encode(source, source_mask)
 
+        if not use_cache:
+            return self.greedy_decode_nocache(encoder_output, source, source_mask, eos_idx, sos_idx, max_len, device)
+
+        # The output is written into a preallocated buffer instead of growing it with torch.cat
+        # decoder_input is (1, max_len) and starts with sos.
+        decoder_input = torch.empty(1, max_len).fill_(sos_idx).type_as(source).to(device)
+        self.init_decode_cache(encoder_output, max_len)
+
+        # Generate the translation word by word. Only the last token goes through the decoder
+        cur_len = 1
+        while cur_len < max_len:
+            # out has the shape (1, 1, d_model)
+            out = self.decode_step(source_mask, decoder_input[:, cur_len - 1 : cur_len], cur_len - 1)
+
+            # project next token. prob is of shape (1, Vocab_Size)
+            prob = self.project(out[:, -1])
+
+            # Select the token with the max probability (because it is a greedy search)
+            _, next_word = torch.max(prob, dim=1)
+            decoder_input[:, cur_len] = next_word
+            cur_len += 1
+
+            # break if we predict the end of sentence token
+            if next_word.item() == eos_idx:
+                break
+
+        self.clear_decode_cache()
+
+        # We return a Tensor of shape (CurDecLen)
+        return decoder_input[0, :cur_len]
+
+    def batch_greedy_decode(
+        self,
+        source: Tensor,
+        source_mask: Tensor,
+        eos_idx: int,
+        sos_idx: int,
+        max_len: int,
+        device,
+        max_len_factor: float = None,
+        max_len_offset: int = 10,
+    ) -> list[Tensor]:
+        # source is (bs, SeqLen) and source_mask (bs, 1, 1, SeqLen)
+        # Every row is decoded in parallel. Rows which produced eos (or reached their own max length)
+        # are removed from the active batch, so the work shrinks as the sentences finish.
+        # Each row stops at min(max_len, max_len_factor * source_length + max_len_offset) when max_len_factor is set.
+        batch_size = source.size(0)
+        encoder_output = self.encode(source, source_mask)
+
+        # Per row maximum length (including sos)
+        row_max_len = torch.full((batch_size,), max_len, dtype=torch.long, device=device)
+        if max_len_factor is not None:
+            src_len = source_mask.reshape(batch_size, -1).sum(dim=-1)
+            row_max_len = torch.clamp(torch.ceil(src_len * max_len_factor).long() + max_len_offset, min=2, max=max_len)
+        lengths = row_max_len.clone()
+
+        # Preallocated output buffer. decoder_input is (bs, max_len) and starts with sos.
+        decoder_input = torch.empty(batch_size, max_len).fill_(sos_idx).type_as(source).to(device)
+        # No row can go further than the longest row max length. No need to allocate more cache than that.
+        max_len = int(row_max_len.max())
+        self.init_decode_cache(encoder_output, max_len)
+
+        # active contains the indexes in the original batch of the rows still being decoded
+        active = torch.arange(batch_size, device=device)
+        active_mask = source_mask
+        active_max_len = row_max_len
+        last_word = decoder_input[:, :1]
+
+        cur_len = 1
+        while cur_len < max_len:
+            # out has the shape (Active, 1, d_model)
+            out = self.decode_step(active_mask, last_word, cur_len - 1)
+            prob = self.project(out[:, -1])
+            _, next_word = torch.max(prob, dim=1)
+            decoder_input[active, cur_len] = next_word
+            cur_len += 1
+
+            finished = (next_word == eos_idx) | (active_max_len <= cur_len)
+            # Only one host synchronisation per step for the whole batch
+            if finished.any():
+                lengths[active[finished]] = cur_len
+                keep = (~finished).nonzero().squeeze(1)
+                if keep.numel() == 0:
+                    break
+                active = active[keep]
+                active_mask = active_mask.index_select(0, keep)
+                active_max_len = active_max_len[keep]
+                next_word = next_word[keep]
+                self.reorder_decode_cache(keep, keep)
+            last_word = next_word.unsqueeze(1)
+
+        self.clear_decode_cache()
+
+        # We return a list of Tensor of shape (CurDecLen), one per row
+        lengths = lengths.tolist()
+        return [decoder_input[i, : lengths[i]] for i in range(batch_size)]
+
+    def beam_search_decode(
+        self,
+        source: Tensor,
+        source_mask: Tensor,
+        eos_idx: int,
+        sos_idx: int,
+        max_len: int,
+        device,
+        beam_size: int = 4,
+        length_penalty: float = 0.6,
+        max_len_factor: float = None,
+        max_len_offset: int = 10,
+    ) -> list[Tensor]:
+        # source is (bs, SeqLen) and source_mask (bs, 1, 1, SeqLen)
+        # The beams are flattened into the batch dimension: one decode_step advances every hypothesis
+        # of every sentence. The encoder output is shared by the beams of a sentence, not copied.
+        # Hypotheses are ranked with the GNMT length normalization: score / ((5 + len) / 6) ** length_penalty
+        batch_size = source.size(0)
+        encoder_output = self.encode(source, source_mask)
+
+        # Per sentence maximum length (including sos). See batch_greedy_decode
+        row_max_len = torch.full((batch_size,), max_len, dtype=torch.long, device=device)
+        if max_len_factor is not None:
+            src_len = source_mask.reshape(batch_size, -1).sum(dim=-1)
+            row_max_len = torch.clamp(torch.ceil(src_len * max_len_factor).long() + max_len_offset, min=2, max=max_len)
+        max_len = int(row_max_len.max())
+
+        self.init_decode_cache(encoder_output, max_len, beam_size)
+
+        def normalize(scores: Tensor, lengths: Tensor) -> Tensor:
+            return scores / ((5.0 + lengths) / 6.0) ** length_penalty
+
+        # active contains the indexes in the original batch of the sentences still being decoded
+        # All the other tensors only contain the active sentences. A is the number of active sentences.
+        active = torch.arange(batch_size, device=device)
+        active_mask = source_mask
+        active_max_len = row_max_len
+        # (A * beam, max_len) tokens of every hypothesis, starting with sos
+        tokens = torch.empty(batch_size * beam_size, max_len).fill_(sos_idx).type_as(source).to(device)
+        # (A, beam) cumulated log probabilities. Only the first beam is alive at the first step.
+        scores = torch.full((batch_size, beam_size), float("-inf"), device=device)
+        scores[:, 0] = 0.0
+        # (A, beam) number of generated tokens, and whether the hypothesis already produced eos
+        lengths = torch.zeros(batch_size, beam_size, dtype=torch.long, device=device)
+        finished = torch.zeros(batch_size, beam_size, dtype=torch.bool, device=device)
+
+        results = [None] * batch_size
+        cur_len = 1
+        while True:
+            num_active = active.size(0)
+            # out has the shape (A * beam, 1, d_model)
+            out = self.decode_step(active_mask, tokens[:, cur_len - 1 : cur_len], cur_len - 1)
+            log_probs = torch.log_softmax(self.project(out[:, -1]), dim=-1)  # (A * beam, Vocab_Size)
+            vocab_size = log_probs.size(-1)
+
+            # A finished hypothesis can only be extended with eos, at no cost. It keeps its score and length.
+            eos_only = torch.full((vocab_size,), float("-inf"), device=device)
+            eos_only[eos_idx] = 0.0
+            log_probs = torch.where(finished.view(-1, 1), eos_only, log_probs)
+
+            # (A, beam, Vocab_Size) candidates
+            cand_scores = scores.unsqueeze(-1) + log_probs.view(num_active, beam_size, vocab_size)
+            cand_lengths = lengths + (~finished).long()
+            cand_norm = normalize(cand_scores, cand_lengths.unsqueeze(-1))
+
+            # Keep the best beam_size candidates of each sentence
+            _, top_idx = cand_norm.view(num_active, -1).topk(beam_size, dim=-1)  # (A, beam)
+            beam_idx = torch.div(top_idx, vocab_size, rounding_mode="floor")
+            next_word = top_idx % vocab_size
+
+            scores = cand_scores.view(num_active, -1).gather(1, top_idx)
+            lengths = cand_lengths.gather(1, beam_idx)
+            finished = finished.gather(1, beam_idx) | (next_word == eos_idx)
+
+            # Reorder the hypotheses (and their caches) according to their parent beam
+            parent = (torch.arange(num_active, device=device) * beam_size).unsqueeze(1) + beam_idx
+            parent = parent.view(-1)
+            tokens = tokens.index_select(0, parent)
+            tokens[:, cur_len] = next_word.view(-1)
+            self.reorder_decode_cache(parent)
+            cur_len += 1
+
+            # A sentence is done when all its beams finished or when it reached its max length
+            done = finished.all(dim=1) | (active_max_len <= cur_len)
+            if done.any():
+                best = normalize(scores, lengths.float()).argmax(dim=1)
+                for row in done.nonzero().squeeze(1).tolist():
+                    hyp = row * beam_size + best[row].item()
+                    # sos + generated tokens (eos included)
+                    results[active[row].item()] = tokens[hyp, : lengths[row, best[row]].item() + 1]
+
+                keep = (~done).nonzero().squeeze(1)
+                if keep.numel() == 0:
+                    break
+                keep_rows = ((keep * beam_size).unsqueeze(1) + torch.arange(beam_size, device=device)).view(-1)
+                active = active[keep]
+                active_mask = active_mask.index_select(0, keep)
+                active_max_len = active_max_len[keep]
+                scores = scores[keep]
+                lengths = lengths[keep]
+                finished = finished[keep]
+                tokens = tokens.index_select(0, keep_rows)
+                self.reorder_decode_cache(keep_rows, keep)
+
+        self.clear_decode_cache()
+
+        # We return a list of Tensor of shape (CurDecLen), one per sentence
+        return results
+
+    def greedy_decode_nocache(self, encoder_output: Tensor, source: Tensor, source_mask: Tensor, eos_idx: int, sos_idx: int, max_len: int, device):
+        # Reference implementation. The whole decoder_input goes through the decoder at every step
+
         # Initialize the decoder input with the sos token
         # target is (1, 1) and contains sos.
         decoder_input = torch.empty(1, 1).fill_(sos_idx).type_as(source).to(device)
@@ -416,7 +756,7 @@ def build_transformer1(
     # Create the decoder blocks
     decoder_blocks = []
     for _ in range(N):
-        decoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
+        decoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout, causal=True)
         decoder_cross_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
         decoder_feed_forward_block = FeedForwardBlock(d_model, d_ff, dropout)
         decoder_block = DecoderBlock(d_model, decoder_self_attention_block, decoder_cross_attention_block, decoder_feed_forward_block, dropout)
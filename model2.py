@@ -8,8 +8,12 @@ import torch.utils.data as data
 from torch import Tensor
 import math
 
+from attention import FusableQKV, scaled_dot_product
+
+
+class MultiHeadAttention(FusableQKV, nn.Module):
+    qkv_names = ("W_q", "W_k", "W_v")
 
-class MultiHeadAttention(nn.Module):
     def __init__(self, d_model: int, num_heads: int):
         super(MultiHeadAttention, self).__init__()
         assert d_model % num_heads == 0, "d_model must be divisible by num_heads"
@@ -23,21 +27,19 @@ class MultiHeadAttention(nn.Module):
         self.W_v = nn.Linear(d_model, d_model)
         self.W_o = nn.Linear(d_model, d_model)
 
+        self.attention_backend = "naive"
+
     def scaled_dot_product_attention(self, Q, K, V, mask=None):
-        # (Batch, h, Seq_Len, d_k) --> (Batch, h, Seq_Len, Seq_Len)
-        # we transpose the last two dimension. key is ...Seq_Len, d_k so it becomes...d_k, Seq_Len
-        attn_scores = torch.matmul(Q, K.transpose(-2, -1)) / math.sqrt(self.d_k)
+        # (Batch, h, Seq_Len, d_k) --> (Batch, h, Seq_Len, Seq_Len) --> (batch, h, seq_len, d_k)
+        # Replace all the value for which mask == 0 with -1e9 (minus infinity)
+        # Some words will not be able to see future words...or padding values
+        # JEB: This was in model3
         if mask is not None:
-            # Replace all the value for which mask == 0 with -1e9 (minus infinity)
-            # Some words will not be able to see future words...or padding values
-            # JEB: This was in model3
             mask = mask.unsqueeze(1)
-            attn_scores = attn_scores.masked_fill(mask == 0, -1e9)
-        attn_probs = torch.softmax(attn_scores, dim=-1)  # (Batch, h, Seq_Len, Seq_Len)
-
-        # (batch, h, seq_len, seq_len) --> (batch, h, seq_len, d_k)
         # Unlike model.py we do not return a tupple
-        output = torch.matmul(attn_probs, V)
+        # JEB: The implementation is shared with the other models. See attention.scaled_dot_product
+        # Never causal: the masks of Dataset2 are padding masks only
+        output, _ = scaled_dot_product(Q, K, V, mask, None, False, self.attention_backend)
         return output
 
     def split_heads(self, x):
@@ -49,9 +51,8 @@ class MultiHeadAttention(nn.Module):
         return x.transpose(1, 2).contiguous().view(batch_size, seq_length, self.d_model)
 
     def forward(self, Q, K, V, mask=None):
-        Q = self.split_heads(self.W_q(Q))
-        K = self.split_heads(self.W_k(K))
-        V = self.split_heads(self.W_v(V))
+        # One matmul when the projections are fused
+        Q, K, V = (self.split_heads(x) for x in self.project_qkv(Q, K, V))
 
         attn_output = self.scaled_dot_product_attention(Q, K, V, mask)
         output = self.W_o(self.combine_heads(attn_output))
@@ -119,6 +120,7 @@ class EncoderLayer(nn.Module):
 class DecoderLayer(nn.Module):
     def __init__(self, d_model: int, num_heads: int, d_ff: int, dropout: float):
         super(DecoderLayer, self).__init__()
+        # JEB: Not causal. The tgt_mask is only a padding mask (the nopeak_mask is commented out in Dataset2.generate_mask)
         self.self_attn = MultiHeadAttention(d_model, num_heads)
         self.cross_attn = MultiHeadAttention(d_model, num_heads)
         self.feed_forward = PositionWiseFeedForward(d_model, d_ff)
@@ -8,6 +8,9 @@ import torch.nn.functional as F
 import math
 import copy
 
+from attention import FusableQKV, scaled_dot_product
+from normalization import std_layer_norm
+
 
 class Norm(nn.Module):
     def __init__(self, d_model: int, eps=1e-6):
@@ -20,11 +23,23 @@ class Norm(nn.Module):
         self.bias = nn.Parameter(torch.zeros(self.size))
 
         self.eps = eps
+        # Use the fused F.layer_norm kernel. See normalization.configure_norms
+        self.fast_norm = False
 
     def forward(self, x):
+        if self.fast_norm:
+            return std_layer_norm(x, self.alpha, self.bias, self.eps)
         norm = self.alpha * (x - x.mean(dim=-1, keepdim=True)) / (x.std(dim=-1, keepdim=True) + self.eps) + self.bias
         return norm
 
+    def to_layer_norm(self) -> nn.LayerNorm:
+        # Equivalent nn.LayerNorm. The unbiased std is folded into the weight. See normalization.std_layer_norm
+        layer_norm = nn.LayerNorm(self.size, eps=self.eps * self.eps * (self.size - 1) / self.size, device=self.alpha.device, dtype=self.alpha.dtype)
+        with torch.no_grad():
+            layer_norm.weight.copy_(self.alpha * math.sqrt((self.size - 1) / self.size))
+            layer_norm.bias.copy_(self.bias)
+        return layer_norm
+
 
 class FeedForward(nn.Module):
     def __init__(self, d_model: int, d_ff: int = 2048, dropout=0.1):
@@ -59,11 +74,13 @@ class PositionalEncoder(nn.Module):
         self.dropout = nn.Dropout(dropout)
         # create constant 'pe' matrix with values dependant on
         # pos and i
+        # JEB: Used to be a python double loop over max_seq_len x d_model. Same formula, computed
+        # in float64 like math.sin/math.cos, for the whole table at once.
+        pos = torch.arange(max_seq_len, dtype=torch.float64).unsqueeze(1)  # (SeqLen, 1)
+        i = torch.arange(0, d_model, 2, dtype=torch.float64)  # (d_model / 2)
         pe = torch.zeros(max_seq_len, d_model)
-        for pos in range(max_seq_len):
-            for i in range(0, d_model, 2):
-                pe[pos, i] = math.sin(pos / (10000 ** ((2 * i) / d_model)))
-                pe[pos, i + 1] = math.cos(pos / (10000 ** ((2 * (i + 1)) / d_model)))
+        pe[:, 0::2] = torch.sin(pos / (10000 ** ((2 * i) / d_model))).float()
+        pe[:, 1::2] = torch.cos(pos / (10000 ** ((2 * (i + 1)) / d_model))).float()
         pe = pe.unsqueeze(0)
         self.register_buffer("pe", pe)
 
@@ -79,7 +96,9 @@ class PositionalEncoder(nn.Module):
         return self.dropout(x)
 
 
-class MultiHeadAttention(nn.Module):
+class MultiHeadAttention(FusableQKV, nn.Module):
+    qkv_names = ("q_linear", "k_linear", "v_linear")
+
     def __init__(self, heads, d_model, dropout=0.1):
         super().__init__()
 
@@ -94,30 +113,28 @@ class MultiHeadAttention(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.out = nn.Linear(d_model, d_model)
 
-    @staticmethod
-    def attention(q, k, v, d_k, mask=None, dropout=None):
-        scores = torch.matmul(q, k.transpose(-2, -1)) / math.sqrt(d_k)
+        self.attention_backend = "naive"
 
+    @staticmethod
+    def attention(q, k, v, d_k, mask=None, dropout=None, backend="naive"):
+        # d_k is the last dimension of q
         if mask is not None:
             # JEB: Need to check. DataSet1 and DataSet3 are computing the mask differently
             mask = mask.unsqueeze(1)
-            scores = scores.masked_fill(mask == 0, -1e9)
-
-        scores = F.softmax(scores, dim=-1)
-
-        if dropout is not None:
-            scores = dropout(scores)
 
-        output = torch.matmul(scores, v)
+        # JEB: The implementation is shared with the other models. See attention.scaled_dot_product
+        # Never causal: the masks of Dataset3 are padding masks only
+        output, _ = scaled_dot_product(q, k, v, mask, dropout, False, backend)
         return output
 
     def forward(self, q, k, v, mask=None):
         bs = q.size(0)
 
-        # perform linear operation and split into N heads
-        k = self.k_linear(k).view(bs, -1, self.h, self.d_k)
-        q = self.q_linear(q).view(bs, -1, self.h, self.d_k)
-        v = self.v_linear(v).view(bs, -1, self.h, self.d_k)
+        # perform linear operation and split into N heads. One matmul when the projections are fused
+        q, k, v = self.project_qkv(q, k, v)
+        k = k.reshape(bs, -1, self.h, self.d_k)
+        q = q.reshape(bs, -1, self.h, self.d_k)
+        v = v.reshape(bs, -1, self.h, self.d_k)
 
         # transpose to get dimensions bs * N * sl * d_model
         k = k.transpose(1, 2)
@@ -125,7 +142,7 @@ class MultiHeadAttention(nn.Module):
         v = v.transpose(1, 2)
 
         # calculate attention using function we will define next
-        scores = MultiHeadAttention.attention(q, k, v, self.d_k, mask, self.dropout)
+        scores = MultiHeadAttention.attention(q, k, v, self.d_k, mask, self.dropout, self.attention_backend)
         # concatenate heads and put through final linear layer
         concat = scores.transpose(1, 2).contiguous().view(bs, -1, self.d_model)
         output = self.out(concat)
@@ -187,6 +204,7 @@ class DecoderLayer(nn.Module):
         self.dropout_2 = nn.Dropout(dropout)
         self.dropout_3 = nn.Dropout(dropout)
 
+        # JEB: Not causal. The trg_mask is only a padding mask. See Dataset3.__getitem__
         self.attn_1 = MultiHeadAttention(heads, d_model, dropout=dropout)
         self.attn_2 = MultiHeadAttention(heads, d_model, dropout=dropout)
         self.ff = FeedForward(d_model, dropout=dropout)
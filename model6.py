@@ -3,23 +3,25 @@
 
 import numpy as np
 import torch
-import math
 from torch import nn
 import torch.nn.functional as F
 from torch import Tensor
 
-from dataset6 import Dataset6
-from config import SOS, EOS, PAD, UNK, get_device
+from attention import scaled_dot_product as shared_scaled_dot_product
+from dataset6 import CharLookup6, Dataset6
+from config import SOS, EOS, PAD, UNK
 
 
-def scaled_dot_product(q: Tensor, k: Tensor, v: Tensor, mask: Tensor = None):
-    d_k = q.size()[-1]
-    scaled = torch.matmul(q, k.transpose(-1, -2)) / math.sqrt(d_k)
+def scaled_dot_product(q: Tensor, k: Tensor, v: Tensor, mask: Tensor = None, causal: bool = False, backend: str = "naive"):
     if mask is not None:
-        scaled = scaled.permute(1, 0, 2, 3) + mask
-        scaled = scaled.permute(1, 0, 2, 3)
-    attention = F.softmax(scaled, dim=-1)
-    values = torch.matmul(attention, v)
+        # mask is (bs, SeqLen, SeqLen) or any shape broadcasting to it, e.g. (bs, 1, SeqLen).
+        # Either additive (0 / NEG_INFTY) or boolean (True for the masked cells). See Dataset6.create_masks
+        # The same mask applies to every head
+        if mask.dtype == torch.bool:
+            mask = ~mask
+        mask = mask.unsqueeze(1)
+    # JEB: The implementation is shared with the other models. See attention.scaled_dot_product
+    values, attention = shared_scaled_dot_product(q, k, v, mask, None, causal, backend)
     return values, attention
 
 
@@ -28,8 +30,8 @@ class PositionalEncoding(nn.Module):
         super().__init__()
         self.max_sequence_length: int = max_sequence_length
         self.d_model: int = d_model
-
-    def forward(self) -> Tensor:
+        # JEB: The table used to be recomputed at every forward. It is now computed once and follows
+        # the module to its device. Not saved with the weights (persistent=False).
         even_i = torch.arange(0, self.d_model, 2).float()
         denominator = torch.pow(10000, even_i / self.d_model)
         position = torch.arange(self.max_sequence_length).reshape(self.max_sequence_length, 1)
@@ -37,7 +39,10 @@ class PositionalEncoding(nn.Module):
         odd_PE = torch.cos(position / denominator)
         stacked = torch.stack([even_PE, odd_PE], dim=2)
         PE = torch.flatten(stacked, start_dim=1, end_dim=2)
-        return PE
+        self.register_buffer("PE", PE, persistent=False)  # (max_sequence_length, d_model)
+
+    def forward(self) -> Tensor:
+        return self.PE
 
 
 class SentenceEmbedding(nn.Module):
@@ -54,44 +59,48 @@ class SentenceEmbedding(nn.Module):
         self.START_TOKEN: int = START_TOKEN
         self.END_TOKEN: int = END_TOKEN
         self.PADDING_TOKEN: int = PADDING_TOKEN
+        self.char_lookup = CharLookup6(language_to_index, max_sequence_length, START_TOKEN, END_TOKEN, PADDING_TOKEN)
 
-    def batch_tokenize(self, batched_sentences: tuple[str], start_token: bool, end_token: bool):
-
-        def tokenize(sentence: str, start_token: bool, end_token: bool) -> Tensor:
-            # JEB: This tokenize function assumes that each caractere is a token.
-            # The tokens are only 1 character long.
-            sentence_word_indicies = [self.language_to_index[token] for token in list(sentence)]
-            if start_token:
-                sentence_word_indicies.insert(0, self.language_to_index[self.START_TOKEN])
-            if end_token:
-                sentence_word_indicies.append(self.language_to_index[self.END_TOKEN])
-            for _ in range(len(sentence_word_indicies), self.max_sequence_length):
-                sentence_word_indicies.append(self.language_to_index[self.PADDING_TOKEN])
-            return torch.tensor(sentence_word_indicies)
-
-        tokenized_sentences = []
-        for sentence_num in range(len(batched_sentences)):
-            tokenized_sentences.append(tokenize(batched_sentences[sentence_num], start_token, end_token))
-        tokenized = torch.stack(tokenized_sentences)
-        return tokenized.to(get_device())
+    def batch_tokenize(self, batched_sentences: tuple[str], start_token: bool, end_token: bool, pad_to: int = None):
+        # JEB: This tokenize function assumes that each caractere is a token.
+        # The tokens are only 1 character long. pad_to defaults to max_sequence_length
+        tokenized = self.char_lookup.encode(batched_sentences, start_token, end_token, pad_to)
+        return tokenized.to(self.embedding.weight.device)
 
     # fowards returns a (bs, SeqLen, d_model) tensor
-    def forward(self, batched_sentences: tuple[str], start_token: bool, end_token: bool) -> Tensor:  # sentence
-        x = self.batch_tokenize(batched_sentences, start_token, end_token)
+    # batched_sentences is either the tuple of sentences or the (bs, SeqLen) tensor of their token indices.
+    # start_token, end_token and pad_to are only used to tokenize the sentences.
+    def forward(self, batched_sentences: tuple[str] | Tensor, start_token: bool, end_token: bool, pad_to: int = None) -> Tensor:  # sentence
+        if isinstance(batched_sentences, Tensor):
+            x = batched_sentences
+        else:
+            x = self.batch_tokenize(batched_sentences, start_token, end_token, pad_to)
         x = self.embedding(x)
-        pos = self.position_encoder().to(get_device())
-        x = self.dropout(x + pos)
+        pos = self.position_encoder()
+        x = self.dropout(x + pos[: x.size(1)])
         return x
 
+    # forward_step returns a (bs, T, d_model) tensor for the token indices (bs, T) at positions start...start+T-1
+    def forward_step(self, tokens: Tensor, start: int) -> Tensor:
+        x = self.embedding(tokens)
+        pos = self.position_encoder()[start : start + tokens.size(1)]
+        return self.dropout(x + pos)
+
 
 class MultiHeadAttention(nn.Module):
-    def __init__(self, d_model: int, num_heads: int):
+    def __init__(self, d_model: int, num_heads: int, causal: bool = False):
         super().__init__()
         self.d_model: int = d_model
         self.num_heads: int = num_heads
         self.head_dim: int = d_model // num_heads
         self.qkv_layer = nn.Linear(d_model, 3 * d_model)
         self.linear_layer = nn.Linear(d_model, d_model)
+        # See attention.scaled_dot_product. causal is True for the self attention of the decoder
+        self.causal = causal
+        self.attention_backend = "naive"
+        # Keys and values of the previous positions. Used by forward_step
+        self.cache_k = None
+        self.cache_v = None
 
     # fowards returns a (bs, SeqLen, d_model) tensor
     def forward(self, x, mask) -> Tensor:
@@ -100,11 +109,32 @@ class MultiHeadAttention(nn.Module):
         qkv = qkv.reshape(batch_size, sequence_length, self.num_heads, 3 * self.head_dim)
         qkv = qkv.permute(0, 2, 1, 3)
         q, k, v = qkv.chunk(3, dim=-1)
-        values, attention = scaled_dot_product(q, k, v, mask)
+        values, attention = scaled_dot_product(q, k, v, mask, self.causal, self.attention_backend)
         values = values.permute(0, 2, 1, 3).reshape(batch_size, sequence_length, self.num_heads * self.head_dim)
         out = self.linear_layer(values)  # (bs, SeqLen, d_model)
         return out
 
+    # forward_step returns a (bs, T, d_model) tensor. x only contains the T new positions.
+    # Every new position is the last one so far: no mask is needed to hide the future.
+    def forward_step(self, x: Tensor, start: int) -> Tensor:
+        batch_size, sequence_length, d_model = x.size()
+        qkv = self.qkv_layer(x)
+        qkv = qkv.reshape(batch_size, sequence_length, self.num_heads, 3 * self.head_dim)
+        qkv = qkv.permute(0, 2, 1, 3)
+        q, k, v = qkv.chunk(3, dim=-1)  # (bs, h, T, head_dim)
+        if start == 0:
+            self.cache_k, self.cache_v = k, v
+        else:
+            self.cache_k = torch.cat([self.cache_k, k], dim=2)
+            self.cache_v = torch.cat([self.cache_v, v], dim=2)
+        values, attention = scaled_dot_product(q, self.cache_k, self.cache_v, None, self.causal, self.attention_backend)
+        values = values.permute(0, 2, 1, 3).reshape(batch_size, sequence_length, self.num_heads * self.head_dim)
+        return self.linear_layer(values)
+
+    def clear_cache(self):
+        self.cache_k = None
+        self.cache_v = None
+
 
 class LayerNormalization(nn.Module):
     def __init__(self, parameters_shape, eps=1e-5):
@@ -114,10 +144,15 @@ class LayerNormalization(nn.Module):
         self.eps = eps
         self.gamma = nn.Parameter(torch.ones(parameters_shape))
         self.beta = nn.Parameter(torch.zeros(parameters_shape))
+        # Use the fused F.layer_norm kernel. Same formula (biased variance, eps under the sqrt), so it is exact.
+        # See normalization.configure_norms
+        self.fast_norm = False
 
     # fowards returns a (bs, SeqLen, d_model) tensor
     def forward(self, inputs: Tensor) -> Tensor:
         # inputs has shape (bs, SeqLen, d_model)
+        if self.fast_norm:
+            return F.layer_norm(inputs, tuple(self.parameters_shape), self.gamma, self.beta, self.eps)
         # JEB: Need to come back to that dims computation
         dims = [-(i + 1) for i in range(len(self.parameters_shape))]
         mean = inputs.mean(dim=dims, keepdim=True)
@@ -127,6 +162,14 @@ class LayerNormalization(nn.Module):
         out = self.gamma * y + self.beta
         return out
 
+    def to_layer_norm(self) -> nn.LayerNorm:
+        # Equivalent nn.LayerNorm
+        layer_norm = nn.LayerNorm(self.parameters_shape, eps=self.eps, device=self.gamma.device, dtype=self.gamma.dtype)
+        with torch.no_grad():
+            layer_norm.weight.copy_(self.gamma)
+            layer_norm.bias.copy_(self.beta)
+        return layer_norm
+
 
 class PositionwiseFeedForward(nn.Module):
     def __init__(self, d_model: int, hidden: int, drop_prob: float = 0.1):
@@ -201,7 +244,7 @@ class Encoder(nn.Module):
         self.layers = SequentialEncoder(*[EncoderLayer(d_model, ffn_hidden, num_heads, drop_prob) for _ in range(num_layers)])
 
     # forward returns a (bs, SeqLen, d_model) Tensor
-    def forward(self, encoder_batched_sentences: tuple[str], self_attention_mask: Tensor, start_token: bool, end_token: bool) -> Tensor:
+    def forward(self, encoder_batched_sentences: tuple[str] | Tensor, self_attention_mask: Tensor, start_token: bool, end_token: bool) -> Tensor:
         # attention_mask shape is (bs, SeqLen, SeqLen)
         x = self.sentence_embedding(encoder_batched_sentences, start_token, end_token)  # (bs, SeqLen, d_model)
         x = self.layers(x, self_attention_mask)  # (bs, SeqLen, d_model)
@@ -217,32 +260,57 @@ class MultiHeadCrossAttention(nn.Module):
         self.kv_layer = nn.Linear(d_model, 2 * d_model)
         self.q_layer = nn.Linear(d_model, d_model)
         self.linear_layer = nn.Linear(d_model, d_model)
-
-    # forward returns a (bs, SeqLen, d_model) Tensor
-    def forward(self, x: Tensor, y: Tensor, mask: Tensor) -> Tensor:
-        # The x shape is (bs, SeqLen, d_model)
-        # The y shape is (bs, SeqLen, d_model)
-        # The mask shape is (bs, SeqLen, SeqLen)
-        # in practice, this is the same for both languages...so we can technically combine with normal attention
-        batch_size, sequence_length, d_model = x.size()
+        # See attention.scaled_dot_product
+        self.attention_backend = "naive"
+        # Keys and values of the encoder output. Used by forward_step
+        self.cache_k = None
+        self.cache_v = None
+
+    def split_kv(self, x: Tensor):
+        # (bs, SrcLen, d_model) -> 2 x (bs, h, SrcLen, head_dim)
+        batch_size, src_length, d_model = x.size()
         kv = self.kv_layer(x)
-        q = self.q_layer(y)
-        kv = kv.reshape(batch_size, sequence_length, self.num_heads, 2 * self.head_dim)
-        q = q.reshape(batch_size, sequence_length, self.num_heads, self.head_dim)
+        kv = kv.reshape(batch_size, src_length, self.num_heads, 2 * self.head_dim)
         kv = kv.permute(0, 2, 1, 3)
+        return kv.chunk(2, dim=-1)
+
+    def attend(self, k: Tensor, v: Tensor, y: Tensor, mask: Tensor) -> Tensor:
+        batch_size, tgt_length, d_model = y.size()
+        q = self.q_layer(y)
+        q = q.reshape(batch_size, tgt_length, self.num_heads, self.head_dim)
         q = q.permute(0, 2, 1, 3)
-        k, v = kv.chunk(2, dim=-1)
         # We don't need the mask for cross attention, removing in outer function!
-        values, attention = scaled_dot_product(q, k, v, mask)
-        values = values.permute(0, 2, 1, 3).reshape(batch_size, sequence_length, d_model)
+        values, attention = scaled_dot_product(q, k, v, mask, backend=self.attention_backend)
+        values = values.permute(0, 2, 1, 3).reshape(batch_size, tgt_length, d_model)
         out = self.linear_layer(values)
         return out
 
+    # forward returns a (bs, TgtLen, d_model) Tensor
+    def forward(self, x: Tensor, y: Tensor, mask: Tensor) -> Tensor:
+        # The x shape is (bs, SrcLen, d_model)
+        # The y shape is (bs, TgtLen, d_model)
+        # The mask shape is (bs, TgtLen, SrcLen)
+        # JEB: The source and the target used to be reshaped with the same SeqLen. They can now
+        # have different lengths, which lets the decoding run over the current prefix only.
+        k, v = self.split_kv(x)
+        return self.attend(k, v, y, mask)
+
+    def precompute_kv(self, x: Tensor):
+        # The encoder output does not change while decoding: its keys and values are computed once
+        self.cache_k, self.cache_v = self.split_kv(x)
+
+    def forward_step(self, y: Tensor, mask: Tensor) -> Tensor:
+        return self.attend(self.cache_k, self.cache_v, y, mask)
+
+    def clear_cache(self):
+        self.cache_k = None
+        self.cache_v = None
+
 
 class DecoderLayer(nn.Module):
     def __init__(self, d_model: int, ffn_hidden: int, num_heads: int, drop_prob: float):
         super(DecoderLayer, self).__init__()
-        self.self_attention = MultiHeadAttention(d_model=d_model, num_heads=num_heads)
+        self.self_attention = MultiHeadAttention(d_model=d_model, num_heads=num_heads, causal=True)
         self.layer_norm1 = LayerNormalization(parameters_shape=[d_model])
         self.dropout1 = nn.Dropout(p=drop_prob)
 
@@ -276,6 +344,21 @@ class DecoderLayer(nn.Module):
         y = self.layer_norm3(y + _y)
         return y
 
+    # forward_step returns a (bs, T, d_model) tensor. y only contains the new positions start...start+T-1
+    def forward_step(self, y: Tensor, start: int, cross_attention_mask: Tensor) -> Tensor:
+        y = self.layer_norm1(self.dropout1(self.self_attention.forward_step(y, start)) + y)
+        y = self.layer_norm2(self.dropout2(self.encoder_decoder_attention.forward_step(y, cross_attention_mask)) + y)
+        y = self.layer_norm3(self.dropout3(self.ffn(y)) + y)
+        return y
+
+    def init_cache(self, encoder_out: Tensor):
+        self.self_attention.clear_cache()
+        self.encoder_decoder_attention.precompute_kv(encoder_out)
+
+    def clear_cache(self):
+        self.self_attention.clear_cache()
+        self.encoder_decoder_attention.clear_cache()
+
 
 class SequentialDecoder(nn.Sequential):
     # SequentialDecoder is instantiate with a list of DecoderLayer
@@ -310,7 +393,7 @@ class Decoder(nn.Module):
     def forward(
         self,
         encoder_out: Tensor,
-        decoder_batched_sentences: tuple[str],
+        decoder_batched_sentences: tuple[str] | Tensor,
         self_attention_mask: Tensor,
         cross_attention_mask: Tensor,
         start_token: bool,
@@ -325,6 +408,21 @@ class Decoder(nn.Module):
         y = self.layers(encoder_out, y, self_attention_mask, cross_attention_mask)  # (bs, SeqLen, d_model)
         return y
 
+    # forward_step returns a (bs, T, d_model) Tensor for the new tokens (bs, T) at positions start...start+T-1
+    def forward_step(self, tokens: Tensor, start: int, cross_attention_mask: Tensor) -> Tensor:
+        y = self.sentence_embedding.forward_step(tokens, start)
+        for layer in self.layers:
+            y = layer.forward_step(y, start, cross_attention_mask)
+        return y
+
+    def init_cache(self, encoder_out: Tensor):
+        for layer in self.layers:
+            layer.init_cache(encoder_out)
+
+    def clear_cache(self):
+        for layer in self.layers:
+            layer.clear_cache()
+
 
 class Transformer6(nn.Module):
     def __init__(
@@ -350,13 +448,18 @@ class Transformer6(nn.Module):
             d_model, ffn_hidden, num_heads, drop_prob, num_layers, max_sequence_length, kannada_to_index, START_TOKEN, END_TOKEN, PADDING_TOKEN
         )
         self.linear = nn.Linear(d_model, kn_vocab_size)
-        self.device = get_device()  # torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+
+    @property
+    def device(self) -> torch.device:
+        # The device of the parameters. Used to be get_device(), which probes the backends and prints at every call.
+        # JEB: The embedding is used because the nn.Linear have no weight tensor once quantized
+        return self.decoder.sentence_embedding.embedding.weight.device
 
     # forward returns a (bs, SeqLen, vocab_size) Tensor
     def forward(
         self,
-        encoder_batched_sentences: tuple[str],
-        decoder_batched_sentences: tuple[str],
+        encoder_batched_sentences: tuple[str] | Tensor,
+        decoder_batched_sentences: tuple[str] | Tensor,
         encoder_self_attention_mask: Tensor = None,
         decoder_self_attention_mask: Tensor = None,
         decoder_cross_attention_mask: Tensor = None,
@@ -365,6 +468,8 @@ class Transformer6(nn.Module):
         dec_start_token: bool = False,  # JEB: ? We should make this true
         dec_end_token: bool = False,
     ) -> Tensor:
+        # The batches are either tuples of sentences or the (bs, SeqLen) tensors of their token indices
+        # (see dataset6.Collate6). The *_start_token/*_end_token flags only apply to sentences.
         encoder_out = self.encoder(
             encoder_batched_sentences, encoder_self_attention_mask, start_token=enc_start_token, end_token=enc_end_token
         )  # (bs, SeqLen, d_model)
@@ -381,19 +486,62 @@ class Transformer6(nn.Module):
         decoder_out = self.linear(decoder_out)  # (bs, SeqLen, vocab_size)
         return decoder_out
 
-    def greedy_decode(self, src_batched_sentences: tuple[str], max_len: int, index_to_tgt: dict, device) -> Tensor:
+    def encode(self, src_batched_sentences: tuple[str]) -> tuple[Tensor, Tensor]:
+        # Encode the source once. As during training, there is no sos/eos in the encoder input.
+        # JEB: The source is only padded to the longest sentence plus one. create_masks leaves the first
+        # padding position visible, so the result is identical to the seq_len padded encoding.
+        lengths = torch.tensor([len(sentence) for sentence in src_batched_sentences])
+        src_len = int(lengths.max()) + 1
+        if src_len > self.encoder.sentence_embedding.max_sequence_length:
+            raise ValueError("Sentence is too long")
+        # Key padding mask (bs, 1, SrcLen). scaled_dot_product broadcasts it over the heads and the queries
+        key_padding_mask, _, _ = Dataset6.create_masks_from_lengths(lengths, lengths, src_len, self.device, form="key_padding")
+        x = self.encoder.sentence_embedding(src_batched_sentences, start_token=False, end_token=False, pad_to=src_len)
+        encoder_out = self.encoder.layers(x, key_padding_mask)  # (bs, SrcLen, d_model)
+        return encoder_out, key_padding_mask
+
+    def greedy_decode(self, src_batched_sentences: tuple[str], max_len: int, index_to_tgt: dict, device) -> tuple[str]:
+        # The encoder runs once. The decoder only processes the newest character at each step,
+        # the keys and values of the prefix are cached in each layer.
+        encoder_out, cross_attention_mask = self.encode(src_batched_sentences)
+        self.decoder.init_cache(encoder_out)
+
+        language_to_index = self.decoder.sentence_embedding.language_to_index
+        eos_idx = language_to_index[EOS]
+        batch_size = len(src_batched_sentences)
+        # During training, model6 DOES add sos to decoder input
+        tokens = torch.full((batch_size, 1), language_to_index[SOS], dtype=torch.long, device=encoder_out.device)
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=encoder_out.device)
+        predicted = [[] for _ in range(batch_size)]
+        for word_counter in range(max_len):
+            decoder_out = self.decoder.forward_step(tokens, word_counter, cross_attention_mask)  # (bs, 1, d_model)
+            next_token_index = torch.argmax(self.linear(decoder_out[:, -1]), dim=-1)  # (bs,)
+            finished |= next_token_index == eos_idx
+            if finished.all():
+                break
+            for row, (index, done) in enumerate(zip(next_token_index.tolist(), finished.tolist())):
+                if not done:
+                    predicted[row].append(index_to_tgt[index])
+            tokens = next_token_index.unsqueeze(1)
+        self.decoder.clear_cache()
+
+        return tuple("".join(sentence) for sentence in predicted)
+
+    def greedy_decode_nocache(self, src_batched_sentences: tuple[str], max_len: int, index_to_tgt: dict, device) -> Tensor:
+        # Previous implementation: re-encodes the source and runs the decoder over max_len positions
+        # for every character. Kept to check the incremental version.
 
         predicated_batched_sentences = ("",)  # tuple[str]
         for word_counter in range(max_len):
             encoder_self_attention_mask, decoder_self_attention_mask, decoder_cross_attention_mask = Dataset6.create_masks(
-                src_batched_sentences, predicated_batched_sentences, max_len
+                src_batched_sentences, predicated_batched_sentences, max_len, device
             )
             predictions = self.forward(
                 src_batched_sentences,
                 predicated_batched_sentences,
-                encoder_self_attention_mask.to(device),
-                decoder_self_attention_mask.to(device),
-                decoder_cross_attention_mask.to(device),
+                encoder_self_attention_mask,
+                decoder_self_attention_mask,
+                decoder_cross_attention_mask,
                 enc_start_token=False,  # During training, model6 does not add sos to encoder input
                 enc_end_token=False,  # During training, model6 does not add sos to encoder input
                 dec_start_token=True,  # During training, model6 DOES add sos to decoder input
@@ -11,57 +11,199 @@ from config import get_device
 device = get_device()
 
 
-class Head(nn.Module):
-    """one head of self-attention"""
+class MultiHeadAttention(nn.Module):
+    """multiple heads of self-attention in parallel"""
 
-    def __init__(self, head_size: int, n_embd: int, block_size: int, dropout: float):
-        super().__init__()
-        self.key = nn.Linear(n_embd, head_size, bias=False)
-        self.query = nn.Linear(n_embd, head_size, bias=False)
-        self.value = nn.Linear(n_embd, head_size, bias=False)
-        self.register_buffer("tril", torch.tril(torch.ones(block_size, block_size)))
+    # JEB: The heads used to be a ModuleList of Head modules, each with its own key/query/value
+    # nn.Linear, matmul and softmax. They are now fused: one projection computes the queries, keys
+    # and values of every head, and the heads are processed together as a (B, h, T, d) batch.
 
+    def __init__(self, num_heads: int, head_size: int, n_embd: int, block_size: int, dropout: float, window: int = None, rotary: bool = False):
+        super().__init__()
+        self.num_heads = num_heads
+        self.head_size = head_size
+        self.n_embd = n_embd
+        self.block_size = block_size
+        # window: sliding window attention. Each position only looks at itself and the window - 1 previous positions
+        # rotary: rotary position embeddings applied to the queries and keys of every head
+        self.window = window
+        self.rotary = rotary
+        # Rows are the queries of every head, then the keys, then the values
+        self.qkv = nn.Linear(n_embd, 3 * num_heads * head_size, bias=False)
+        # Constants. Not saved with the weights
+        if window is None:
+            self.register_buffer("tril", torch.tril(torch.ones(block_size, block_size)), persistent=False)
+        if rotary:
+            assert head_size % 2 == 0, "rotary position embeddings need an even head_size"
+            self.register_buffer("inv_freq", 1.0 / (10000 ** (torch.arange(0, head_size, 2).float() / head_size)), persistent=False)
+        self.proj = nn.Linear(n_embd, n_embd)
+        self.attn_dropout = nn.Dropout(dropout)
         self.dropout = nn.Dropout(dropout)
 
-    def forward(self, x):
-        B, T, C = x.shape
+        # K/V cache of the last block_size positions. Used by generate_cached
+        self.cache_k = None
+        self.cache_v = None
+
+    def split_heads(self, x):
+        # (B, T, 3 * h * d) -> 3 x (B, h, T, d)
+        B, T, _ = x.shape
+        q, k, v = x.view(B, T, 3, self.num_heads, self.head_size).permute(2, 0, 3, 1, 4)
+        return q, k, v
+
+    def attention(self, q, k, v, mask, attention_mask=None):
         # Every single node is emiting a query and a key vector.
         # The Query vector is what I'm looking for.
         # The Key vector is what do I contain.
-        k = self.key(x)  # (B,T,C)
-        q = self.query(x)  # (B,T,C)
-        # compute attention scores ("affinities")
-        # The dot product between the key and the query. My query time the dot product of all the other tokens.
         # If the key and query are aligned, they will interact for a higher amount, and I'll learn about that
         # specific token.
-        # We need to transpose the key but k has three dimensions. We only want to transpose the two last
-        # dimensions.
-        wei = q @ k.transpose(-2, -1) * C**-0.5  # (B, T, C) @ (B, C, T) -> (B, T, T)
+        # JEB: The scale uses n_embd and not head_size, as the original Head did.
+        wei = q @ k.transpose(-2, -1) * self.n_embd**-0.5  # (B, h, Tq, d) @ (B, h, d, Tk) -> (B, h, Tq, Tk)
+        if attention_mask is not None:
+            # attention_mask is (B, Tk), 0 for the left padding. Nobody looks at the padding.
+            # A finite value keeps the rows of the padding tokens (which have nothing to look at) away from NaN
+            wei = wei.masked_fill(attention_mask[:, None, None, :] == 0, -1e9)
         # We apply the upper triangular mask. Remove communications with future nodes.
-        wei = wei.masked_fill(self.tril[:T, :T] == 0, float("-inf"))  # (B, T, T)
-        # We exponentiate and normalize. Each line has it sums of values . Remove communications with future nodes.
-        wei = F.softmax(wei, dim=-1)  # (B, T, T)
-        wei = self.dropout(wei)
+        wei = wei.masked_fill(mask, float("-inf"))
+        # We exponentiate and normalize. Each line has it sums of values
+        # JEB: In fp32, also under bf16 autocast
+        wei = F.softmax(wei.float(), dim=-1)
+        wei = self.attn_dropout(wei)
         # perform the weighted aggregation of the values.
-        # x is the private information to this token. v is what I will communicate if you pesk me.
-        v = self.value(x)  # (B,T,C)
-        out = wei @ v  # (B, T, T) @ (B, T, C) -> (B, T, C)
+        out = wei @ v  # (B, h, Tq, Tk) @ (B, h, Tk, d) -> (B, h, Tq, d)
+        # Concatenate the heads back: (B, h, Tq, d) -> (B, Tq, h * d)
+        out = out.transpose(1, 2).reshape(out.size(0), -1, self.num_heads * self.head_size)
+        return self.dropout(self.proj(out))
+
+    def rotate(self, x, positions):
+        # Rotary position embedding. x is (B, h, T, d), positions is (T) or (B, T).
+        # Each pair of features is rotated by an angle proportional to the position, so q.k only
+        # depends on the distance between the two positions.
+        angles = positions[..., None].float() * self.inv_freq  # (T, d/2) or (B, T, d/2)
+        if angles.dim() == 3:
+            angles = angles[:, None]  # (B, 1, T, d/2)
+        cos, sin = angles.cos().to(x.dtype), angles.sin().to(x.dtype)
+        x1, x2 = x[..., 0::2], x[..., 1::2]
+        return torch.stack((x1 * cos - x2 * sin, x1 * sin + x2 * cos), dim=-1).flatten(-2)
+
+    def local_attention(self, q, k, v, attention_mask=None):
+        # Sliding window attention at a cost linear in T. The sequence is cut in blocks of window queries.
+        # Each block only looks at its own keys and at the keys of the previous block, and the banded
+        # mask is computed on the fly. Same result as attention with the banded (T, T) mask.
+        B, h, T, d = q.shape
+        W = self.window
+        n = -(-T // W)
+        pad = n * W - T
+        q = F.pad(q, (0, 0, 0, pad)).unflatten(2, (n, W))  # (B, h, n, W, d)
+        k = blocks_with_previous(k, W, pad)  # (B, h, n, 2W, d)
+        v = blocks_with_previous(v, W, pad)  # (B, h, n, 2W, d)
+        wei = q @ k.transpose(-2, -1) * self.n_embd**-0.5  # (B, h, n, W, 2W)
+        if attention_mask is not None:
+            # Nobody looks at the left padding
+            keys_mask = blocks_with_previous(attention_mask[:, None, :, None], W, pad)[..., 0]  # (B, 1, n, 2W)
+            wei = wei.masked_fill(keys_mask[:, :, :, None, :] == 0, -1e9)
+        wei = wei.masked_fill(band_mask(n, W, q.device), float("-inf"))
+        wei = F.softmax(wei.float(), dim=-1)
+        wei = self.attn_dropout(wei)
+        out = (wei @ v).flatten(2, 3)[:, :, :T]  # (B, h, T, d)
+        out = out.transpose(1, 2).reshape(B, T, self.num_heads * self.head_size)
+        return self.dropout(self.proj(out))
+
+    def forward(self, x, attention_mask=None, positions=None):
+        # positions (T) or (B, T) are only needed by the rotary position embeddings
+        B, T, C = x.shape
+        q, k, v = self.split_heads(self.qkv(x))  # (B, h, T, d)
+        if self.rotary:
+            q, k = self.rotate(q, positions), self.rotate(k, positions)
+        if self.window is not None:
+            return self.local_attention(q, k, v, attention_mask)
+        return self.attention(q, k, v, self.tril[:T, :T] == 0, attention_mask)
+
+    def forward_step(self, x, start: int):
+        # Same as forward, but x only contains the new positions start...start+T-1.
+        # The keys and values of the previous positions are read from the cache.
+        B, T, C = x.shape
+        q, k, v = self.split_heads(self.qkv(x))  # (B, h, T, d)
+        if self.rotary:
+            positions = torch.arange(start, start + T, device=x.device)
+            q, k = self.rotate(q, positions), self.rotate(k, positions)
+        if self.window is not None:
+            return self.window_step(q, k, v, start)
+        if start == 0:
+            self.cache_k = torch.empty(B, self.num_heads, self.block_size, self.head_size, device=x.device, dtype=x.dtype)
+            self.cache_v = torch.empty(B, self.num_heads, self.block_size, self.head_size, device=x.device, dtype=x.dtype)
+        self.cache_k[:, :, start : start + T] = k
+        self.cache_v[:, :, start : start + T] = v
+        mask = self.tril[start : start + T, : start + T] == 0  # (T, start+T)
+        return self.attention(q, self.cache_k[:, :, : start + T], self.cache_v[:, :, : start + T], mask)
+
+    def window_step(self, q, k, v, start: int):
+        # forward_step of the sliding window attention. The cache only keeps the window - 1 last keys/values,
+        # which is all the next position can look at: the cost per token does not grow with the position.
+        T = q.size(2)
+        if start == 0:
+            out = self.local_attention(q, k, v)
+        else:
+            k = torch.cat((self.cache_k, k), dim=2)
+            v = torch.cat((self.cache_v, v), dim=2)
+            # The keys are at positions start+T-Tk...start+T-1
+            query_positions = torch.arange(start, start + T, device=q.device)[:, None]
+            key_positions = torch.arange(start + T - k.size(2), start + T, device=q.device)[None, :]
+            mask = (key_positions > query_positions) | (query_positions - key_positions >= self.window)  # (T, Tk)
+            out = self.attention(q, k, v, mask)
+        keep = self.window - 1
+        self.cache_k = k[:, :, k.size(2) - keep :]
+        self.cache_v = v[:, :, v.size(2) - keep :]
         return out
 
-
-class MultiHeadAttention(nn.Module):
-    """multiple heads of self-attention in parallel"""
-
-    def __init__(self, num_heads: int, head_size: int, n_embd: int, block_size: int, dropout: float):
-        super().__init__()
-        self.heads = nn.ModuleList([Head(head_size, n_embd, block_size, dropout) for _ in range(num_heads)])
-        self.proj = nn.Linear(n_embd, n_embd)
-        self.dropout = nn.Dropout(dropout)
-
-    def forward(self, x):
-        out = torch.cat([h(x) for h in self.heads], dim=-1)
-        out = self.dropout(self.proj(out))
-        return out
+    def clear_cache(self):
+        self.cache_k = None
+        self.cache_v = None
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before the heads were fused are converted on the fly
+        convert_heads_state_dict(state_dict, prefix, self.num_heads)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+def blocks_with_previous(x, window: int, pad: int):
+    # (..., T, d) -> (..., n, 2 * window, d). Block i holds the positions of the blocks i-1 and i.
+    # The sequence is zero padded by window positions in front (the block before the first one) and by pad at the end.
+    x = F.pad(x, (0, 0, window, pad))
+    return torch.cat((x[..., :-window, :].unflatten(-2, (-1, window)), x[..., window:, :].unflatten(-2, (-1, window))), dim=-2)
+
+
+def band_mask(n: int, window: int, device) -> torch.Tensor:
+    # (n, window, 2 * window) mask of blocks_with_previous. True for the keys a query must not look at:
+    # the future and the positions window or more steps in the past
+    rows = torch.arange(window, device=device)[:, None]
+    cols = torch.arange(2 * window, device=device)[None, :]
+    distance = rows + window - cols
+    mask = ((distance < 0) | (distance >= window)).expand(n, window, 2 * window).clone()
+    # The first block has no previous block
+    mask[0, :, :window] = True
+    return mask
+
+
+def convert_heads_state_dict(state_dict: dict, prefix: str, num_heads: int) -> dict:
+    # Convert, in place, the per Head weights found under prefix (e.g. "blocks.0.sa.") to the fused layout:
+    # heads.{i}.query/key/value.weight (d, n_embd) -> qkv.weight (3 * h * d, n_embd)
+    if f"{prefix}heads.0.query.weight" not in state_dict:
+        return state_dict
+    weights = []
+    for name in ("query", "key", "value"):
+        weights.extend(state_dict.pop(f"{prefix}heads.{i}.{name}.weight") for i in range(num_heads))
+    state_dict[f"{prefix}qkv.weight"] = torch.cat(weights, dim=0)
+    for i in range(num_heads):
+        state_dict.pop(f"{prefix}heads.{i}.tril", None)
+    return state_dict
+
+
+def convert_state_dict8(state_dict: dict, num_heads: int) -> dict:
+    # Convert a whole Transformer8 state_dict saved with the per Head layout to the fused layout
+    prefixes = {key[: key.index("heads.")] for key in state_dict if ".sa.heads." in key}
+    for prefix in prefixes:
+        convert_heads_state_dict(state_dict, prefix, num_heads)
+    return state_dict
 
 
 class FeedFoward(nn.Module):
@@ -84,19 +226,26 @@ class FeedFoward(nn.Module):
 class Block(nn.Module):
     """Transformer block: communication followed by computation"""
 
-    def __init__(self, n_embd: int, n_head: int, block_size: int, dropout: float):
+    def __init__(self, n_embd: int, n_head: int, block_size: int, dropout: float, window: int = None, rotary: bool = False):
         # n_embd: embedding dimension, n_head: the number of heads we'd like
         super().__init__()
         head_size = n_embd // n_head
-        self.sa = MultiHeadAttention(num_heads=n_head, head_size=head_size, n_embd=n_embd, block_size=block_size, dropout=dropout)
+        self.sa = MultiHeadAttention(
+            num_heads=n_head, head_size=head_size, n_embd=n_embd, block_size=block_size, dropout=dropout, window=window, rotary=rotary
+        )
         self.ffwd = FeedFoward(n_embd=n_embd, dropout=dropout)
         self.ln1 = nn.LayerNorm(n_embd)
         self.ln2 = nn.LayerNorm(n_embd)
 
-    def forward(self, x):
+    def forward(self, x, attention_mask=None, positions=None):
         # JEB: This is one of the only that changed compared to the original
         # paper. The normalization is made first in this model.
-        x = x + self.sa(self.ln1(x))
+        x = x + self.sa(self.ln1(x), attention_mask, positions)
+        x = x + self.ffwd(self.ln2(x))
+        return x
+
+    def forward_step(self, x, start: int):
+        x = x + self.sa.forward_step(self.ln1(x), start)
         x = x + self.ffwd(self.ln2(x))
         return x
 
@@ -106,25 +255,64 @@ class Block(nn.Module):
 
 class Transformer8(nn.Module):
 
-    def __init__(self, vocab_size: int, n_embd: int, n_layer: int, n_head: int, block_size: int, dropout: float):
+    def __init__(
+        self,
+        vocab_size: int,
+        n_embd: int,
+        n_layer: int,
+        n_head: int,
+        block_size: int,
+        dropout: float,
+        attention_window: int = None,
+        position_encoding: str = "learned",
+    ):
         super().__init__()
+        # position_encoding: "learned" (absolute, limited to block_size positions) or "rotary" (relative, no limit)
+        # attention_window: sliding window attention, linear in T. See MultiHeadAttention.local_attention
+        assert position_encoding in ("learned", "rotary"), f"{position_encoding} position encoding is not supported"
+        self.position_encoding = position_encoding
+        self.attention_window = attention_window
         # each token directly reads off the logits for the next token from a lookup table
         self.token_embedding_table = nn.Embedding(vocab_size, n_embd)
-        self.position_embedding_table = nn.Embedding(block_size, n_embd)
-        self.blocks = nn.Sequential(*[Block(n_embd=n_embd, n_head=n_head, block_size=block_size, dropout=dropout) for _ in range(n_layer)])
+        if position_encoding == "learned":
+            self.position_embedding_table = nn.Embedding(block_size, n_embd)
+        rotary = position_encoding == "rotary"
+        self.blocks = nn.Sequential(
+            *[Block(n_embd=n_embd, n_head=n_head, block_size=block_size, dropout=dropout, window=attention_window, rotary=rotary) for _ in range(n_layer)]
+        )
         self.ln_f = nn.LayerNorm(n_embd)  # final layer norm
         self.lm_head = nn.Linear(n_embd, vocab_size)
         self.block_size = block_size
 
-    def forward(self, idx, targets=None):
+    @property
+    def context_size(self) -> int:
+        # Number of tokens the generation keeps as context.
+        # With rotary positions and a sliding window, a token only depends on the n_layer * (window - 1) previous
+        # tokens and nothing depends on the absolute position: the context is not limited by block_size.
+        if self.position_encoding == "rotary" and self.attention_window is not None:
+            return len(self.blocks) * (self.attention_window - 1) + 1
+        return self.block_size
+
+    def forward(self, idx, targets=None, attention_mask=None):
         B, T = idx.shape
         # idx and targets are both (B,T) tensor of integers
+        # attention_mask is an optional (B,T) tensor, 0 for the left padding of a batch of prompts
         tok_emb = self.token_embedding_table(idx)  # (B,T,C)
-        pos_emb = self.position_embedding_table(torch.arange(T, device=device))  # (T,C)
-        # JEB: Broadcasting. pos_emb gets right-aligned, a new dimension is added
-        # and it gets added accross batch.
-        x = tok_emb + pos_emb  # (B,T,C)
-        x = self.blocks(x)  # (B,T,C)
+        if attention_mask is None:
+            positions = torch.arange(T, device=device)  # (T)
+        else:
+            # The first real token of each row is at position 0
+            positions = torch.clamp(attention_mask.long().cumsum(dim=-1) - 1, min=0)  # (B,T)
+        if self.position_encoding == "learned":
+            pos_emb = self.position_embedding_table(positions)  # (T,C) or (B,T,C)
+            # JEB: Broadcasting. pos_emb gets right-aligned, a new dimension is added
+            # and it gets added accross batch.
+            x = tok_emb + pos_emb  # (B,T,C)
+        else:
+            # The rotary positions are applied to the queries and keys of each attention layer
+            x = tok_emb
+        for block in self.blocks:
+            x = block(x, attention_mask, positions)  # (B,T,C)
         x = self.ln_f(x)  # (B,T,C)
         logits = self.lm_head(x)  # (B,T,vocab_size)
 
@@ -136,34 +324,329 @@ class Transformer8(nn.Module):
             B, T, C = logits.shape
             logits = logits.view(B * T, C)
             targets = targets.view(B * T)
-            loss = F.cross_entropy(logits, targets)
+            # The loss is computed in fp32, also under bf16 autocast
+            loss = F.cross_entropy(logits.float(), targets)
 
         return logits, loss
 
-    def generate(self, idx, max_new_tokens):
+    def generate(self, idx, max_new_tokens, temperature: float = 1.0, top_k: int = None, top_p: float = None):
         # idx is (B, T) array of indices in the current context
         for _ in range(max_new_tokens):
-            # crop idx to the last block_size tokens
-            idx_cond = idx[:, -self.block_size :]
+            # crop idx to the last context_size tokens
+            idx_cond = idx[:, -self.context_size :]
             # get the predictions. (We invoke forward here with a target)
             logits, loss = self(idx_cond)
             # focus only on the last time step
             logits = logits[:, -1, :]  # becomes (B, C)
-            # apply softmax to get probabilities
-            probs = F.softmax(logits, dim=-1)  # (B, C)
             # sample from the distribution
-            idx_next = torch.multinomial(probs, num_samples=1)  # (B, 1)
+            idx_next = sample_next_token(logits, temperature, top_k, top_p)  # (B, 1)
             # append sampled index to the running sequence
             idx = torch.cat((idx, idx_next), dim=1)  # (B, T+1)
         return idx
 
+    def forward_step(self, idx, start: int):
+        # idx (B,T) only contains the new tokens, at positions start...start+T-1 of the window.
+        # start == 0 (re)fills the caches. Returns the (B, vocab_size) logits of the last position only.
+        B, T = idx.shape
+        x = self.token_embedding_table(idx)  # (B,T,C)
+        if self.position_encoding == "learned":
+            x = x + self.position_embedding_table(torch.arange(start, start + T, device=idx.device))  # (T,C)
+        for block in self.blocks:
+            x = block.forward_step(x, start)  # (B,T,C)
+        # Only the newest token goes through the final layer norm and the head
+        x = self.ln_f(x[:, -1, :])  # (B,C)
+        return self.lm_head(x)  # (B,vocab_size)
+
+    def clear_cache(self):
+        for block in self.blocks:
+            block.sa.clear_cache()
+
+    @torch.no_grad()
+    def generate_cached(self, idx, max_new_tokens, temperature: float = 1.0, top_k: int = None, top_p: float = None, stride: int = None):
+        # Same as generate but the keys/values of the window are cached, so each new token only costs
+        # one position instead of block_size.
+        # The position embeddings are absolute: when the window slides every token changes position and
+        # the cached keys/values are no longer valid. Once the cache is full, it is rebuilt (one forward)
+        # from the last block_size - stride + 1 tokens, and stride new tokens are then added one by one.
+        # stride = 1 (the default) gives exactly the same result as generate. Larger values (kv_cache_stride)
+        # are an approximation: a shorter context right after each rebuild for a lower cost per token.
+        # With rotary positions and a sliding window, the cache is never rebuilt: it only holds the
+        # window - 1 last keys/values of each layer and the positions keep growing.
+        stride = stride or 1
+        assert 1 <= stride <= self.block_size, "stride must be between 1 and block_size"
+        unbounded = self.context_size != self.block_size
+
+        # idx is (B, T) array of indices in the current context
+        idx_cond = idx[:, -self.context_size :]
+        logits = self.forward_step(idx_cond, 0)
+        cache_len = idx_cond.size(1)
+        for step in range(max_new_tokens):
+            idx_next = sample_next_token(logits, temperature, top_k, top_p)  # (B, 1)
+            idx = torch.cat((idx, idx_next), dim=1)  # (B, T+1)
+            if step == max_new_tokens - 1:
+                break
+            if cache_len == self.block_size and not unbounded:
+                # The window slides. Rebuild the cache with positions starting at 0 again
+                idx_cond = idx[:, -(self.block_size - stride + 1) :]
+                logits = self.forward_step(idx_cond, 0)
+                cache_len = idx_cond.size(1)
+            else:
+                logits = self.forward_step(idx_next, cache_len)
+                cache_len += 1
+        self.clear_cache()
+        return idx
+
+    @torch.no_grad()
+    def generate_batch(
+        self,
+        prompts: list[list[int]],
+        max_new_tokens: int,
+        pad_idx: int = 0,
+        temperature: float = 1.0,
+        top_k: int = None,
+        top_p: float = None,
+        stop_tokens: list = None,
+        stop_strings: list = None,
+        decode=None,
+    ) -> list[list[int]]:
+        # Generate from many prompts at once. The prompts are left padded into a (B, T) batch with an
+        # attention mask. A row is retired as soon as it samples one of its stop_tokens, or its decoded
+        # text (decode is typically tokenizer.decode) ends with one of its stop_strings.
+        # stop_tokens and stop_strings are one list per prompt, aligned with prompts. A single shared list
+        # (e.g. [eos]) is a shorthand for the same list for every prompt. See per_prompt
+        # Returns the prompt followed by the generated tokens for each prompt.
+        B = len(prompts)
+        T = max(len(prompt) for prompt in prompts)
+        idx = torch.full((B, T), pad_idx, dtype=torch.long, device=device)
+        attention_mask = torch.zeros((B, T), dtype=torch.long, device=device)
+        for row, prompt in enumerate(prompts):
+            idx[row, T - len(prompt) :] = torch.tensor(prompt, dtype=torch.long, device=device)
+            attention_mask[row, T - len(prompt) :] = 1
+
+        # (B, S) table of the stop tokens of each prompt, padded with -1 which is never sampled
+        stop_tokens = per_prompt(stop_tokens, B)
+        stop_table = torch.full((B, max(1, max(len(tokens) for tokens in stop_tokens))), -1, dtype=torch.long, device=device)
+        for row, tokens in enumerate(stop_tokens):
+            stop_table[row, : len(tokens)] = torch.tensor(tokens, dtype=torch.long, device=device)
+        # Only the new token of each active row is decoded, and appended to the last tail_lens[prompt]
+        # characters generated for its prompt: its stop strings are never longer than that.
+        # JEB: Assumes decode of a single token is the text it adds, as with the character tokenizer of model8
+        stop_strings = per_prompt(stop_strings, B)
+        tail_lens = [max((len(stop_string) for stop_string in strings), default=0) for strings in stop_strings]
+        tails = [""] * B
+
+        # active contains the index in prompts of the rows still being generated
+        active = torch.arange(B, device=device)
+        results = [None] * B
+        for step in range(max_new_tokens):
+            # JEB: Not cached. forward_step has no per-row padding mask nor per-row positions, the rows are retired
+            # mid-generation and the left padding moves the absolute positions of every row differently.
+            # Use generate_cached (kv_cache_stride) when all the samples share the same prompt.
+            idx_cond = idx[:, -self.context_size :]
+            mask_cond = attention_mask[:, -self.context_size :]
+            logits, _ = self(idx_cond, attention_mask=mask_cond)
+            idx_next = sample_next_token(logits[:, -1, :], temperature, top_k, top_p)  # (A, 1)
+            idx = torch.cat((idx, idx_next), dim=1)
+            attention_mask = torch.cat((attention_mask, torch.ones_like(idx_next)), dim=1)
+
+            # Each active row against the stop tokens of its own prompt
+            finished = (stop_table[active] == idx_next).any(dim=1)
+            if step == max_new_tokens - 1:
+                finished[:] = True
+            elif any(tail_lens):
+                for row, (prompt, token) in enumerate(zip(active.tolist(), idx_next.squeeze(1).tolist())):
+                    if tail_lens[prompt] == 0:
+                        continue
+                    tail = tails[prompt] + decode([token])
+                    if any(stop_string in tail for stop_string in stop_strings[prompt]):
+                        finished[row] = True
+                    tails[prompt] = tail[-tail_lens[prompt] :]
+
+            if finished.any():
+                for row in finished.nonzero().squeeze(1).tolist():
+                    results[active[row].item()] = idx[row][attention_mask[row] == 1].tolist()
+                keep = (~finished).nonzero().squeeze(1)
+                if keep.numel() == 0:
+                    break
+                active = active[keep]
+                idx = idx[keep]
+                attention_mask = attention_mask[keep]
+                # Drop the columns which are padding for every remaining row
+                first = int(attention_mask.argmax(dim=1).min())
+                idx = idx[:, first:]
+                attention_mask = attention_mask[:, first:]
+        return results
+
+    def window_logits(self, idx, num_positions: int):
+        # Logits predicting the token which follows each of the last num_positions positions of idx.
+        # They are identical to what generate computes: each prediction only sees the last context_size tokens.
+        B, T = idx.shape
+        context_size = self.context_size
+        if T <= context_size:
+            # Thanks to the causal mask, a single forward gives every prediction
+            logits, _ = self(idx)
+            return logits[:, -num_positions:, :]
+        ends = list(range(T - num_positions + 1, T + 1))
+        short_ends = [end for end in ends if end < context_size]
+        full_ends = [end for end in ends if end >= context_size]
+        out = []
+        if short_ends:
+            logits, _ = self(idx[:, :context_size])
+            out.append(logits[:, [end - 1 for end in short_ends], :])
+        # Every other prediction has its own window of context_size tokens. The windows are stacked
+        # into the batch dimension so they all go through the model in one forward pass
+        windows = torch.cat([idx[:, end - context_size : end] for end in full_ends], dim=0)  # (n * B, context_size)
+        logits, _ = self(windows)
+        out.append(logits[:, -1, :].view(len(full_ends), B, -1).transpose(0, 1))
+        return torch.cat(out, dim=1)  # (B, num_positions, vocab_size)
+
+    @torch.no_grad()
+    def speculative_generate(
+        self,
+        idx,
+        max_new_tokens: int,
+        draft_model: "Transformer8",
+        num_draft_tokens: int = 4,
+        temperature: float = 1.0,
+        top_k: int = None,
+        top_p: float = None,
+    ):
+        # Speculative sampling. The small draft_model proposes num_draft_tokens tokens, the model checks
+        # them all at once and keeps each one with probability min(1, p / q). The first rejected token is
+        # replaced by a sample of norm(max(0, p - q)). The result has the same distribution as generate
+        # with the same temperature, top_k and top_p, which are applied to both p and q.
+        # The draft model steps with its K/V cache (forward_step). After the verification, the cache is
+        # rolled back to the accepted prefix: the next forward_step overwrites the rejected positions.
+        # idx is (1, T) array of indices in the current context
+        assert idx.size(0) == 1, "Speculative decoding only supports a batch size of 1"
+        target_len = idx.size(1) + max_new_tokens
+        # The draft cache holds the tokens idx[:, cached_from:cached_to] at the positions 0...cache_len-1
+        cache_len = 0
+        cached_to = 0
+        # With a sliding window and rotary positions, the draft cache only keeps the last keys/values and
+        # cannot be rolled back: it is rebuilt at every round instead
+        rollback = draft_model.context_size == draft_model.block_size
+        while idx.size(1) < target_len:
+            start = idx.size(1)
+            num_draft = min(num_draft_tokens, target_len - start)
+
+            # Feed the draft model the tokens it has not seen yet. The cache is rebuilt when the new tokens
+            # and the drafted ones would not fit in the block_size positions of the draft model.
+            # The shorter draft context only changes the acceptance rate, never the distribution
+            new_tokens = idx[:, cached_to:]
+            if not rollback or cached_to == 0 or cache_len + new_tokens.size(1) + num_draft - 1 > draft_model.block_size:
+                context = idx[:, -max(1, draft_model.context_size - num_draft + 1) :]
+                logits = draft_model.forward_step(context, 0)
+                cache_len = context.size(1)
+            else:
+                logits = draft_model.forward_step(new_tokens, cache_len)
+                cache_len += new_tokens.size(1)
+            cached_to = start
+
+            # The draft model proposes num_draft tokens, one at a time
+            drafted = []
+            draft_probs = []
+            for i in range(num_draft):
+                probs = next_token_probs(logits, temperature, top_k, top_p)  # (1, C)
+                draft_probs.append(probs)
+                drafted.append(torch.multinomial(probs, num_samples=1))
+                if i < num_draft - 1:
+                    logits = draft_model.forward_step(drafted[-1], cache_len)
+                    cache_len += 1
+            drafted = torch.cat(drafted, dim=1)  # (1, num_draft)
+            q = torch.stack(draft_probs, dim=1)  # (1, num_draft, C)
+
+            # The model scores the num_draft proposals plus one extra position
+            logits = self.window_logits(torch.cat((idx, drafted), dim=1), num_draft + 1)  # (1, num_draft + 1, C)
+            p = next_token_probs(logits[0], temperature, top_k, top_p).unsqueeze(0)  # (1, num_draft + 1, C)
+            p_tok = p[:, :num_draft].gather(-1, drafted.unsqueeze(-1)).squeeze(-1)
+            q_tok = q.gather(-1, drafted.unsqueeze(-1)).squeeze(-1)
+            accepted = torch.rand_like(p_tok) < p_tok / q_tok  # (1, num_draft)
+            num_accepted = int(accepted[0].long().cumprod(dim=0).sum())
+
+            if num_accepted < num_draft:
+                # Resample the rejected position from the residual distribution
+                residual = torch.clamp(p[:, num_accepted] - q[:, num_accepted], min=0)
+                residual_sum = residual.sum(dim=-1, keepdim=True)
+                probs = torch.where(residual_sum > 0, residual / residual_sum, p[:, num_accepted])
+            else:
+                # Every proposal was accepted. The extra position gives one more token for free
+                probs = p[:, num_draft]
+            idx_next = torch.multinomial(probs, num_samples=1)  # (1, 1)
+            idx = torch.cat((idx, drafted[:, :num_accepted], idx_next), dim=1)
+
+            # Roll the draft cache back: of the num_draft - 1 drafted tokens it saw, only the accepted ones stay
+            kept = min(num_accepted, num_draft - 1)
+            cache_len -= num_draft - 1 - kept
+            cached_to = start + kept
+        draft_model.clear_cache()
+        return idx[:, :target_len]
+
+
+def per_prompt(values: list, num_prompts: int) -> list[list]:
+    # One list per prompt for generate_batch. None or a single shared list (e.g. [eos] or ["\n\n"])
+    # is broadcast to every prompt. A list of lists is already one list per prompt
+    if not values:
+        return [[] for _ in range(num_prompts)]
+    if isinstance(values[0], (list, tuple)):
+        assert len(values) == num_prompts, "One list of stop tokens/strings per prompt is expected"
+        return [list(value) for value in values]
+    return [list(values) for _ in range(num_prompts)]
+
+
+def next_token_probs(logits, temperature: float = 1.0, top_k: int = None, top_p: float = None):
+    # logits is (B, C). Returns the (B, C) distribution sample_next_token draws from. Every row is processed at once.
+    if temperature == 0:
+        # Greedy
+        return F.one_hot(torch.argmax(logits, dim=-1), logits.size(-1)).to(logits.dtype)
+    logits = logits / temperature
+    if top_k is not None:
+        # Only keep the top_k most likely tokens
+        values, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+        logits = logits.masked_fill(logits < values[:, [-1]], float("-inf"))
+    if top_p is not None and top_p < 1.0:
+        # Nucleus sampling. Keep the smallest set of tokens whose cumulated probability reaches top_p
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        sorted_probs = F.softmax(sorted_logits, dim=-1)
+        # The token crossing the top_p threshold is kept
+        sorted_remove = (sorted_probs.cumsum(dim=-1) - sorted_probs) > top_p
+        sorted_logits = sorted_logits.masked_fill(sorted_remove, float("-inf"))
+        logits = torch.full_like(logits, float("-inf")).scatter(-1, sorted_indices, sorted_logits)
+    # apply softmax to get probabilities
+    return F.softmax(logits, dim=-1)  # (B, C)
+
+
+def sample_next_token(logits, temperature: float = 1.0, top_k: int = None, top_p: float = None):
+    # logits is (B, C). Returns (B, 1) sampled indices. See next_token_probs
+    if temperature == 0:
+        # Greedy
+        return torch.argmax(logits, dim=-1, keepdim=True)
+    return torch.multinomial(next_token_probs(logits, temperature, top_k, top_p), num_samples=1)  # (B, 1)
+
 
 def build_transformer8(
-    tgt_vocab_size: int, d_model: int = 64, N: int = 4, h: int = 4, block_size: int = 32, dropout: float = 0.0, d_ff: int = 256
+    tgt_vocab_size: int,
+    d_model: int = 64,
+    N: int = 4,
+    h: int = 4,
+    block_size: int = 32,
+    dropout: float = 0.0,
+    d_ff: int = 256,
+    attention_window: int = None,
+    position_encoding: str = "learned",
 ) -> Transformer8:
 
     # Create the transformer
-    transformer = Transformer8(vocab_size=tgt_vocab_size, n_embd=d_model, n_head=h, n_layer=N, block_size=block_size, dropout=dropout)
+    transformer = Transformer8(
+        vocab_size=tgt_vocab_size,
+        n_embd=d_model,
+        n_head=h,
+        n_layer=N,
+        block_size=block_size,
+        dropout=dropout,
+        attention_window=attention_window,
+        position_encoding=position_encoding,
+    )
 
     # When computing the loss, we are ignoring cases when the label is the padding token
     # for params in transformer.parameters():
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# Fast layer normalization for model1, model3 and model6.
+# The custom normalization modules keep their parameters (hence their checkpoints) but, with fast_norm,
+# their output comes from the fused F.layer_norm kernel instead of separate mean / std / elementwise passes.
+
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+
+
+def std_layer_norm(x: Tensor, alpha: Tensor, bias: Tensor, eps: float) -> Tensor:
+    # F.layer_norm version of alpha * (x - mean) / (x.std() + eps) + bias (model1.LayerNormalization, model3.Norm).
+    # F.layer_norm divides by the biased sqrt(var + eps'). The unbiased std, sqrt(n / (n - 1)) * sqrt(var), is folded
+    # exactly into the weight. eps cannot be folded exactly: eps' turns the denominator into sqrt(std**2 + eps**2)
+    # instead of std + eps. Both are std as soon as std >> eps, and both give bias for a constant row.
+    n = x.shape[-1]
+    return F.layer_norm(x, (n,), alpha * math.sqrt((n - 1) / n), bias, eps * eps * (n - 1) / n)
+
+
+def configure_norms(model: nn.Module, fast_norm: bool = False) -> nn.Module:
+    # Select the implementation of every normalization module of model which supports fast_norm
+    for module in model.modules():
+        if hasattr(module, "fast_norm"):
+            module.fast_norm = fast_norm
+    return model
+
+
+@torch.no_grad()
+def check_norm_equivalence(model: nn.Module, batch_size: int = 8, seq_len: int = 64, atol: float = 1e-4) -> dict:
+    # Compare, with the current parameters of model, the reference output of every normalization module with
+    # its fast_norm output and with its to_layer_norm conversion. Returns the max abs difference per module.
+    # Raises ValueError when a difference is above atol.
+    differences = {}
+    for name, module in model.named_modules():
+        if not hasattr(module, "fast_norm"):
+            continue
+        layer_norm = module.to_layer_norm()
+        fast_norm = module.fast_norm
+        weight = next(module.parameters())
+        x = torch.randn(batch_size, seq_len, *layer_norm.normalized_shape, dtype=weight.dtype, device=weight.device)
+        # Activations are not centered nor of unit variance. The scale is also where eps matters
+        x = x * torch.logspace(-1, 2, seq_len, dtype=weight.dtype, device=weight.device)[:, None] + 3
+        module.fast_norm = False
+        expected = module(x)
+        module.fast_norm = True
+        difference = max((module(x) - expected).abs().max().item(), (layer_norm(x) - expected).abs().max().item())
+        module.fast_norm = fast_norm
+        differences[name] = difference
+        if difference > atol:
+            raise ValueError(f"{name} fast norm differs from the reference by {difference}")
+    return differences
+
+
+if __name__ == "__main__":
+    from model1 import LayerNormalization as LayerNormalization1
+    from model3 import Norm as Norm3
+    from model6 import LayerNormalization as LayerNormalization6
+
+    norms = nn.ModuleDict({"model1": LayerNormalization1(512), "model3": Norm3(512), "model6": LayerNormalization6(parameters_shape=[512])})
+    # Trained parameters are not 1 and 0
+    for parameter in norms.parameters():
+        nn.init.normal_(parameter, mean=parameter.mean().item(), std=0.5)
+    for name, difference in check_norm_equivalence(norms).items():
+        print(f"{name:>8}: max abs difference {difference:.3g}")
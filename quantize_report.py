@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+import io
+import sys
+import getopt
+import time
+
+import torch
+
+from config import EOS, SOS, get_config, get_model_folder
+from dataset1 import get_ds1
+from dataset6 import get_ds6
+from tutorial1 import build_model1
+from tutorial6 import build_model6
+from utils import compute_translation_metrics, load_trained_model, skip_weight_init
+
+# Compare the float model with its dynamically quantized int8 version on the validation set:
+# latency per sentence, size of the weights and translation metrics.
+# Everything runs on cpu since dynamic quantization is a cpu only feature.
+
+
+def get_model_size(model) -> float:
+    # Size in MB of the serialized state_dict
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 1024**2
+
+
+def translate_ds1(model, val_dataloader, tokenizer_tgt, config: dict, num_sentences: int):
+    eos_idx = tokenizer_tgt.token_to_id(EOS)
+    sos_idx = tokenizer_tgt.token_to_id(SOS)
+    predicted = []
+    expected = []
+    for batch in val_dataloader:
+        model_outs = model.batch_greedy_decode(
+            batch["encoder_input"], batch["encoder_mask"], eos_idx, sos_idx, config["seq_len"], "cpu", max_len_factor=config.get("max_len_factor", None)
+        )
+        predicted.extend(tokenizer_tgt.decode(model_out.numpy()) for model_out in model_outs)
+        expected.extend(batch["tgt_text"])
+        if len(predicted) >= num_sentences:
+            break
+    return predicted[:num_sentences], expected[:num_sentences]
+
+
+def translate_ds6(model, val_dataloader, index_to_tgt: dict, config: dict, num_sentences: int):
+    predicted = []
+    expected = []
+    for src_batched_sentences, tgt_batched_sentences in val_dataloader:
+        predicted.append(model.greedy_decode(src_batched_sentences, config["seq_len"], index_to_tgt, "cpu")[0])
+        expected.append(tgt_batched_sentences[0])
+        if len(predicted) >= num_sentences:
+            break
+    return predicted, expected
+
+
+def quantize_report(config: dict, num_sentences: int):
+    model_folder = get_model_folder(config)
+
+    match config["alt_model"]:
+        case "model1":
+            _, val_dataloader, tokenizer_src, tokenizer_tgt = get_ds1(config, model_folder)
+
+            def build_model():
+                return build_model1(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size())
+
+            def translate(model):
+                return translate_ds1(model, val_dataloader, tokenizer_tgt, config, num_sentences)
+
+        case "model6":
+            _, val_dataloader, src_vocab_size, tgt_vocab_size, src_to_index, tgt_to_index, index_to_tgt = get_ds6(config, model_folder)
+
+            def build_model():
+                return build_model6(config, src_vocab_size, tgt_vocab_size, src_to_index, tgt_to_index)
+
+            def translate(model):
+                return translate_ds6(model, val_dataloader, index_to_tgt, config, num_sentences)
+
+        case _:
+            raise ValueError(f"{config['alt_model']} quantization report is not supported")
+
+    results = {}
+    for quantize in (None, "int8"):
+        with skip_weight_init():
+            model = build_model()
+        model = load_trained_model(dict(config, quantize=quantize), model)
+        model.eval()
+
+        # The same sentences are used for both models
+        torch.manual_seed(0)
+        start_time = time.time()
+        with torch.no_grad():
+            predicted, expected = translate(model)
+        elapsed = time.time() - start_time
+
+        metrics = compute_translation_metrics(predicted, expected)
+        results[quantize or "float"] = {
+            "size": get_model_size(model),
+            "latency": elapsed * 1000 / max(len(predicted), 1),
+            "BLEU": float(metrics["BLEU"]),
+            "cer": float(metrics["cer"]),
+        }
+
+    print(f"{config['alt_model']} {config['lang_src']}-{config['lang_tgt']} on {num_sentences} validation sentences")
+    print(f"{'model':>8} | {'size MB':>8} | {'ms/sentence':>11} | {'BLEU':>6} | {'cer':>6}")
+    for name, result in results.items():
+        print(f"{name:>8} | {result['size']:8.2f} | {result['latency']:11.2f} | {result['BLEU']:6.4f} | {result['cer']:6.4f}")
+    return results
+
+
+def main(argv):
+    config_filename = None
+    model_folder = None
+    num_sentences = 100
+    try:
+        opts, args = getopt.getopt(argv, "hc:m:n:", ["config=", "modelfolder=", "num_sentences="])
+    except getopt.GetoptError:
+        print("quantize_report.py -c <config_file> -m <model_folder> -n <num_sentences>")
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == "-h":
+            print("quantize_report.py -c <config_file> -m <model_folder> -n <num_sentences>")
+            sys.exit()
+        elif opt in ("-c", "--config"):
+            config_filename = arg
+        elif opt in ("-m", "--modelfolder"):
+            model_folder = arg
+        elif opt in ("-n", "--num_sentences"):
+            num_sentences = int(arg)
+
+    config = get_config(config_filename, model_folder)
+    quantize_report(config, num_sentences)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+# Pre-tokenized corpus for Dataset1, Dataset2 and Dataset3.
+# The datasets call tokenizer.encode on both sentences of every pair at every epoch. get_token_cache tokenizes
+# the corpus once and writes the ids into the model folder. The training then only slices the memory maps.
+
+import hashlib
+import os
+import shutil
+from pathlib import Path
+from typing import Callable, Tuple
+
+import numpy as np
+import torch
+from torch import Tensor
+from tokenizers import Tokenizer
+
+# Sentences tokenized together by encode_batch
+ENCODE_BATCH_SIZE = 1000
+
+
+class TokenCache:
+    """Token ids of the source and target sentences of every pair of a dataset.
+    The ids of all the sentences are concatenated in src_ids.npy and tgt_ids.npy (uint16, or uint32 for larger vocabularies)
+    and sentence i is ids[offsets[i]:offsets[i + 1]]. The files are opened with np.load(mmap_mode="r"): a pair is a view of
+    the memory map and concurrent runs on the same host share the page cache."""
+
+    def __init__(self, folder: Path, indices: list[int] = None):
+        self.folder = Path(folder)
+        # Positions of the pairs in the full dataset. Set by subset for the random_split subsets
+        self.indices = indices
+        self.open()
+
+    def open(self):
+        self.src_ids = np.load(self.folder / "src_ids.npy", mmap_mode="r")
+        self.tgt_ids = np.load(self.folder / "tgt_ids.npy", mmap_mode="r")
+        self.src_offsets = np.load(self.folder / "src_offsets.npy", mmap_mode="r")
+        self.tgt_offsets = np.load(self.folder / "tgt_offsets.npy", mmap_mode="r")
+
+    def subset(self, indices: list[int]) -> "TokenCache":
+        return TokenCache(self.folder, list(indices))
+
+    def __len__(self):
+        return len(self.indices) if self.indices is not None else len(self.src_offsets) - 1
+
+    def __getitem__(self, idx: int) -> Tuple[Tensor, Tensor]:
+        if self.indices is not None:
+            idx = self.indices[idx]
+        src = self.src_ids[self.src_offsets[idx] : self.src_offsets[idx + 1]]
+        tgt = self.tgt_ids[self.tgt_offsets[idx] : self.tgt_offsets[idx + 1]]
+        # The slices are views of the memory maps. Only the int64 conversion for nn.Embedding copies the sentence
+        return torch.from_numpy(src.astype(np.int64)), torch.from_numpy(tgt.astype(np.int64))
+
+    def src_lengths(self) -> np.ndarray:
+        lengths = np.diff(self.src_offsets)
+        return lengths if self.indices is None else lengths[self.indices]
+
+    def tgt_lengths(self) -> np.ndarray:
+        lengths = np.diff(self.tgt_offsets)
+        return lengths if self.indices is None else lengths[self.indices]
+
+    def __getstate__(self):
+        # DataLoader workers reopen the memory maps instead of receiving a copy of the arrays
+        return {"folder": self.folder, "indices": self.indices}
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.open()
+
+
+def dataset_files_id(ds_raw) -> str:
+    # Path, size and modification time of the arrow files backing the dataset (Dataset.cache_files).
+    # They change whenever the dataset is downloaded or loaded again from modified data files
+    files = []
+    for cache_file in ds_raw.cache_files:
+        stat = os.stat(cache_file["filename"])
+        files.append(f"{cache_file['filename']}:{stat.st_size}:{stat.st_mtime_ns}")
+    # In memory datasets have no files
+    return "|".join(files) or f"{ds_raw.info.dataset_name}:{ds_raw.info.config_name}:{ds_raw.split}:{len(ds_raw)}"
+
+
+def token_cache_key(ds_raw, tokenizer_src: Tokenizer, tokenizer_tgt: Tokenizer, src_lang: str, tgt_lang: str) -> str:
+    # The tokenizers are hashed through their json serialization
+    digest = hashlib.sha256()
+    for part in (dataset_files_id(ds_raw), src_lang, tgt_lang, tokenizer_src.to_str(), tokenizer_tgt.to_str()):
+        digest.update(part.encode())
+    return digest.hexdigest()[:16]
+
+
+def token_dtype(tokenizer: Tokenizer):
+    return np.uint16 if tokenizer.get_vocab_size() <= np.iinfo(np.uint16).max + 1 else np.uint32
+
+
+def encode_sentences(tokenizer: Tokenizer, sentences: list[str]) -> Tuple[np.ndarray, np.ndarray]:
+    dtype = token_dtype(tokenizer)
+    ids = []
+    lengths = [0]
+    for start in range(0, len(sentences), ENCODE_BATCH_SIZE):
+        for encoding in tokenizer.encode_batch(sentences[start : start + ENCODE_BATCH_SIZE]):
+            ids.append(np.asarray(encoding.ids, dtype=dtype))
+            lengths.append(len(encoding.ids))
+    ids = np.concatenate(ids) if ids else np.zeros(0, dtype=dtype)
+    return ids, np.cumsum(lengths, dtype=np.int64)
+
+
+def get_token_cache(
+    config: dict, model_folder: str, ds_raw, tokenizer_src: Tokenizer, tokenizer_tgt: Tokenizer, get_texts: Callable[[dict], Tuple[str, str]]
+) -> TokenCache:
+    # get_texts returns the (source, target) sentences of a dataset item
+    key = token_cache_key(ds_raw, tokenizer_src, tokenizer_tgt, config["lang_src"], config["lang_tgt"])
+    folder = Path(model_folder) / "token_cache" / key
+    if not folder.exists():
+        print(f"Tokenizing the dataset into {folder}")
+        sources, targets = zip(*(get_texts(item) for item in ds_raw))
+        src_ids, src_offsets = encode_sentences(tokenizer_src, list(sources))
+        tgt_ids, tgt_offsets = encode_sentences(tokenizer_tgt, list(targets))
+
+        # Written next to the final folder then renamed, so a concurrent run never opens a partial cache
+        tmp_folder = folder.with_name(f"{key}.{os.getpid()}.tmp")
+        tmp_folder.mkdir(parents=True, exist_ok=True)
+        np.save(tmp_folder / "src_ids.npy", src_ids)
+        np.save(tmp_folder / "tgt_ids.npy", tgt_ids)
+        np.save(tmp_folder / "src_offsets.npy", src_offsets)
+        np.save(tmp_folder / "tgt_offsets.npy", tgt_offsets)
+        try:
+            tmp_folder.rename(folder)
+        except OSError:
+            # Another run wrote the same cache first
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+    return TokenCache(folder)
@@ -18,14 +18,16 @@ def main(argv):
     config_filename = None
     model_folder = None
     sentence = "I am not a very good a student."
+    quantize = None
+    draft_model_folder = None
     try:
-        opts, args = getopt.getopt(argv, "hc:m:s:", ["config=", "modelfolder=", "sentence="])
+        opts, args = getopt.getopt(argv, "hc:m:s:q:d:", ["config=", "modelfolder=", "sentence=", "quantize=", "draftfolder="])
     except getopt.GetoptError:
-        print("translate.py -c <config_file> -m <model_folder> -s <sentence>")
+        print("translate.py -c <config_file> -m <model_folder> -s <sentence> -q <int8> -d <draft_model_folder>")
         sys.exit(2)
     for opt, arg in opts:
         if opt == "-h":
-            print("translate.py -c <config_file> -m <model_folder> -s <sentence>")
+            print("translate.py -c <config_file> -m <model_folder> -s <sentence> -q <int8> -d <draft_model_folder>")
             sys.exit()
         elif opt in ("-c", "--config"):
             config_filename = arg
@@ -33,9 +35,17 @@ def main(argv):
             model_folder = arg
         elif opt in ("-s", "--sentence"):
             sentence = arg
+        elif opt in ("-q", "--quantize"):
+            quantize = arg
+        elif opt in ("-d", "--draftfolder"):
+            draft_model_folder = arg
 
     # warnings.filterwarnings('ignore')
     config = get_config(config_filename, model_folder)
+    if quantize:
+        config["quantize"] = quantize
+    if draft_model_folder:
+        config["draft_model_folder"] = draft_model_folder
 
     match config["alt_model"]:
         case "model1":
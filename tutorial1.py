@@ -10,10 +10,25 @@ from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
+from attention import configure_attention
+from bucketing import set_epoch
+from checkpointing import configure_checkpointing
 from config import EOS, PAD, SOS, get_console_width, get_device, get_model_folder, get_config
 from dataset1 import get_ds1, get_testing_ds1
-from model1 import Transformer1, build_transformer1
-from utils import collect_training_metrics, reload_model, save_model, load_trained_model
+from model1 import Transformer1, build_transformer1, EncoderBlock, DecoderBlock, FeedForwardBlock
+from normalization import configure_norms
+from utils import (
+    collect_training_metrics,
+    reload_model,
+    save_model,
+    load_trained_model,
+    skip_weight_init,
+    compile_model,
+    autocast,
+    configure_precision,
+    GradientAccumulator,
+    StepStats,
+)
 
 
 def build_model1(config: dict, vocab_src_len: int, vocab_tgt_len: int) -> Transformer1:
@@ -28,6 +43,12 @@ def build_model1(config: dict, vocab_src_len: int, vocab_tgt_len: int) -> Transf
         dropout=config["dropout"],
         d_ff=config["d_ff"],
     )
+    # Attention backend and fused QKV projections. See attention.configure_attention
+    configure_attention(model, config.get("attention_backend", "naive"), config.get("fused_qkv", False), config.get("attention_chunk_size", 128))
+    # Activation checkpointing of the encoder/decoder layers. See checkpointing.configure_checkpointing
+    configure_checkpointing(model, config.get("checkpoint_layers", None), (EncoderBlock, DecoderBlock), (FeedForwardBlock,))
+    # F.layer_norm for the normalization layers. See normalization.configure_norms
+    configure_norms(model, config.get("fast_norm", False))
     return model
 
 
@@ -42,6 +63,9 @@ def evaluate_model1(
     global_step: int,
     writer,
     num_examples: int = 2,
+    max_len_factor: float = None,
+    beam_size: int = 1,
+    length_penalty: float = 0.6,
 ):
     model.eval()
     count = 0
@@ -52,37 +76,52 @@ def evaluate_model1(
 
     console_width = get_console_width()
 
+    eos_idx = tokenizer_tgt.token_to_id(EOS)
+    sos_idx = tokenizer_tgt.token_to_id(SOS)
+
     with torch.no_grad():
         for batch in validation_ds:
-            count += 1
-            encoder_input = batch["encoder_input"].to(device)
-            encoder_mask = batch["encoder_mask"].to(device)
-
-            assert encoder_input.size(0) == 1, "Batch size must be 1 for validation"
-
-            eos_idx = tokenizer_tgt.token_to_id(EOS)
-            sos_idx = tokenizer_tgt.token_to_id(SOS)
-            # JEB: Not sure this is really consistent
-            # encoder_input has shape (bs=1, SeqLen)
-            # encoder_mask has shape (bs=1, 1, 1, SeqLen)
-            # model_out has shape (SeqLen)
-            model_out = model.greedy_decode(encoder_input, encoder_mask, sos_idx, eos_idx, max_len, device)
-
-            source_text = batch["src_text"][0]
-            target_text = batch["tgt_text"][0]
-            model_out_text = tokenizer_tgt.decode(model_out.detach().cpu().numpy())
-
-            source_texts.append(source_text)
-            expected.append(target_text)
-            predicted.append(model_out_text)
-
-            # Print the message to the console without interfering with the progress bar
-            print_msg("-" * console_width)
-            print_msg(f"{'Source: ':>15}{source_text}")
-            print_msg(f"{'Target: ':>15}{target_text}")
-            print_msg(f"{'Prediction: ':>15}{model_out_text}")
-
-            if count == num_examples:
+            # Only the sentences which are reported and scored are decoded
+            remaining = num_examples - count
+            encoder_input = batch["encoder_input"][:remaining].to(device)
+            encoder_mask = batch["encoder_mask"][:remaining].to(device)
+
+            # encoder_input has shape (bs, SeqLen)
+            # encoder_mask has shape (bs, 1, 1, SeqLen)
+            # model_outs is a list of bs Tensor of shape (CurDecLen)
+            if beam_size > 1:
+                model_outs = model.beam_search_decode(
+                    encoder_input,
+                    encoder_mask,
+                    eos_idx,
+                    sos_idx,
+                    max_len,
+                    device,
+                    beam_size=beam_size,
+                    length_penalty=length_penalty,
+                    max_len_factor=max_len_factor,
+                )
+            else:
+                model_outs = model.batch_greedy_decode(encoder_input, encoder_mask, eos_idx, sos_idx, max_len, device, max_len_factor=max_len_factor)
+
+            for source_text, target_text, model_out in zip(batch["src_text"], batch["tgt_text"], model_outs):
+                count += 1
+                model_out_text = tokenizer_tgt.decode(model_out.detach().cpu().numpy())
+
+                source_texts.append(source_text)
+                expected.append(target_text)
+                predicted.append(model_out_text)
+
+                # Print the message to the console without interfering with the progress bar
+                print_msg("-" * console_width)
+                print_msg(f"{'Source: ':>15}{source_text}")
+                print_msg(f"{'Target: ':>15}{target_text}")
+                print_msg(f"{'Prediction: ':>15}{model_out_text}")
+
+                if count == num_examples:
+                    break
+
+            if count >= num_examples:
                 print_msg("-" * console_width)
                 break
     if writer:
@@ -106,16 +145,27 @@ def train_model1(config: dict):
     initial_epoch = 0
     global_step = 0
     model, initial_epoch, optimizer, global_step = reload_model(config, model, optimizer, initial_epoch, global_step)
+    # fp32 normalization layers when training in bf16. See utils.autocast
+    model = configure_precision(config, model)
+    # torch.compile when the compile config key is set. See utils.compile_model
+    model = compile_model(config, model, ("encode", "decode", "project"))
 
-    loss_fn = nn.CrossEntropyLoss(ignore_index=tokenizer_src.token_to_id(PAD), label_smoothing=0.1).to(device)
+    # Summed over the tokens. See utils.GradientAccumulator
+    loss_fn = nn.CrossEntropyLoss(ignore_index=tokenizer_src.token_to_id(PAD), label_smoothing=0.1, reduction="sum").to(device)
+    accumulator = GradientAccumulator(config, model, optimizer)
+    # Logs the step time and the peak memory. See checkpoint_layers
+    step_stats = StepStats(device)
 
     console_width = get_console_width()
 
     for epoch in range(initial_epoch, config["num_epochs"]):
+        # Bucketed batch order of this epoch. See bucketing.BucketBatchSampler
+        set_epoch(train_dataloader, epoch)
         if device == "cuda":
             torch.cuda.empty_cache()
 
         model.train()  # moved inside for run_validation at each step
+        step_stats.reset()
         batch_iterator = tqdm(train_dataloader, desc=f"Processing epoch {epoch:02d}")
         for batch_num, batch in enumerate(batch_iterator):
 
@@ -125,26 +175,28 @@ def train_model1(config: dict):
             decoder_mask = batch["decoder_mask"].to(device)  # (B, 1, SeqLen, SeqLen)
 
             # Run the tensors through the transformer
-            encoder_output = model.encode(encoder_input, encoder_mask)  # (B, SeqLen, d_model)
-            decoder_output = model.decode(encoder_output, encoder_mask, decoder_input, decoder_mask)  # (B, SeqLen, d_model)
-            proj_output = model.project(decoder_output)  # (B, SeqLen, tgt_vocab_size)
+            with autocast(config, device):
+                encoder_output = model.encode(encoder_input, encoder_mask)  # (B, SeqLen, d_model)
+                decoder_output = model.decode(encoder_output, encoder_mask, decoder_input, decoder_mask)  # (B, SeqLen, d_model)
+                proj_output = model.project(decoder_output)  # (B, SeqLen, tgt_vocab_size)
 
             # Compare the output with the label
             label = batch["label"].to(device)  # (B, SeqLen)
 
             # (B, SeqLen, tgt_vocab_size) --> (B * SeqLen, tgt_vocab_size)
-            loss = loss_fn(proj_output.view(-1, tokenizer_tgt.get_vocab_size()), label.view(-1))
+            loss_sum = loss_fn(proj_output.float().view(-1, tokenizer_tgt.get_vocab_size()), label.view(-1))
+            num_tokens = (label != tokenizer_src.token_to_id(PAD)).sum()
+            loss = loss_sum / num_tokens
             batch_iterator.set_postfix({"Loss": f"{loss.item():6.3f}"})
 
             # Log of loss
             writer.add_scalar("train loss", loss.item(), global_step)
             writer.flush()
 
-            # backpropagate the loss
-            loss.backward()
-
-            # update the weights
-            optimizer.step()
+            # backpropagate the loss and update the weights every grad_accum_steps batches
+            accumulator.backward(loss_sum, num_tokens)
+            accumulator.step(last=batch_num == len(train_dataloader) - 1)
+            step_stats.log(writer, global_step)
 
             if (batch_num > 0) and (batch_num % 100 == 0):
                 batch_iterator.write("-" * console_width)
@@ -162,15 +214,22 @@ def train_model1(config: dict):
                 batch_iterator.write(f"{'Prediction: ':>15}{predicted_sentence}")
                 batch_iterator.write("-" * console_width)
 
-            # Initialize to None instead of 0. Supposed to provide better performance.
-            # optimizer.zero_grad()
-            optimizer.zero_grad(set_to_none=True)
-
             global_step += 1
 
         # Run validation at the end of each epoch
         evaluate_model1(
-            model, val_dataloader, tokenizer_src, tokenizer_tgt, config["seq_len"], device, lambda msg: batch_iterator.write(msg), global_step, writer
+            model,
+            val_dataloader,
+            tokenizer_src,
+            tokenizer_tgt,
+            config["seq_len"],
+            device,
+            lambda msg: batch_iterator.write(msg),
+            global_step,
+            writer,
+            max_len_factor=config.get("max_len_factor", None),
+            beam_size=config.get("beam_size", 1),
+            length_penalty=config.get("length_penalty", 0.6),
         )
 
         # Save the model at the end of every epoch
@@ -185,15 +244,18 @@ def translate1(config: dict, sentence: str):
         raise ValueError(f"{model_folder} model_folder does not exist")
 
     sentence, label, tokenizer_src, tokenizer_tgt = get_testing_ds1(config, model_folder, sentence)
-    model = build_model1(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
+    # The weights are loaded right after. Skip the random initialization
+    with skip_weight_init():
+        model = build_model1(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
 
     # Load the pretrained weights
     model = load_trained_model(config, model)
+    # The cached greedy, batched and beam decoders step with decode_step. decode is only used during the training
+    model = compile_model(config, model, ("encode", "decode_step", "project"))
 
     # if the sentence is a number use it as an index to the test set
     sos_token = torch.tensor([tokenizer_tgt.token_to_id(SOS)], dtype=torch.int64)
     eos_token = torch.tensor([tokenizer_tgt.token_to_id(EOS)], dtype=torch.int64)
-    pad_token = torch.tensor([tokenizer_tgt.token_to_id(PAD)], dtype=torch.int64)
 
     model.eval()
     with torch.no_grad():
@@ -206,17 +268,22 @@ def translate1(config: dict, sentence: str):
         #     torch.tensor([tokenizer_src.token_to_id(PAD)] * (max_len - len(source.ids) - 2), dtype=torch.int64)
         # ], dim=0).to(device)
         enc_input_tokens = tokenizer_src.encode(sentence).ids
-        enc_num_padding_tokens = config["seq_len"] - len(enc_input_tokens) - 2
+        # The positional encoding buffer only covers seq_len positions
+        if len(enc_input_tokens) + 2 > config["seq_len"]:
+            raise ValueError("Sentence is too long")
+
+        # JEB: No padding to seq_len. Only the real tokens are encoded, otherwise the encoder
+        # runs a full (seq_len, seq_len) attention for a sentence of a few words.
         source = torch.cat(
             [
                 sos_token,
                 torch.tensor(enc_input_tokens, dtype=torch.int64),
                 eos_token,
-                torch.tensor([pad_token] * enc_num_padding_tokens, dtype=torch.int64),
             ],
             dim=0,
         ).to(device)
-        source_mask = (source != pad_token.to(device)).unsqueeze(0).unsqueeze(0).int().to(device)
+        # Nothing to hide. source_mask shape is (1, 1, SrcLen)
+        source_mask = torch.ones(1, 1, source.size(0), dtype=torch.int).to(device)
         # assert source.size(0) == 1, "Batch size must be 1 for validation"
 
         eos_idx = tokenizer_tgt.token_to_id(EOS)
@@ -224,7 +291,20 @@ def translate1(config: dict, sentence: str):
 
         # source shape is expected to be (bs=1, SeqLen)
         # source_mask shape is expected to be (bs=1, 1, 1, SeqLen)
-        model_out = model.greedy_decode(source.unsqueeze(0), source_mask, eos_idx, sos_idx, config["seq_len"], device)
+        beam_size = config.get("beam_size", 1)
+        if beam_size > 1:
+            model_out = model.beam_search_decode(
+                source.unsqueeze(0),
+                source_mask,
+                eos_idx,
+                sos_idx,
+                config["seq_len"],
+                device,
+                beam_size=beam_size,
+                length_penalty=config.get("length_penalty", 0.6),
+            )[0]
+        else:
+            model_out = model.greedy_decode(source.unsqueeze(0), source_mask, eos_idx, sos_idx, config["seq_len"], device)
         model_out_text = tokenizer_tgt.decode(model_out.detach().cpu().numpy())
 
     # Print the source sentence and target start prompt
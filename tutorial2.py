@@ -10,10 +10,24 @@ from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
+from attention import configure_attention
+from bucketing import set_epoch
+from checkpointing import configure_checkpointing
 from config import EOS, PAD, get_console_width, get_device, get_model_folder, get_config
 from dataset2 import get_ds2, get_testing_ds2
-from model2 import Transformer2, build_transformer2
-from utils import collect_training_metrics, reload_model, save_model, load_trained_model
+from model2 import Transformer2, build_transformer2, EncoderLayer, DecoderLayer, PositionWiseFeedForward
+from utils import (
+    collect_training_metrics,
+    reload_model,
+    save_model,
+    load_trained_model,
+    skip_weight_init,
+    compile_model,
+    autocast,
+    configure_precision,
+    GradientAccumulator,
+    StepStats,
+)
 
 
 def build_model2(config: dict, vocab_src_len: int, vocab_tgt_len: int) -> Transformer2:
@@ -27,6 +41,10 @@ def build_model2(config: dict, vocab_src_len: int, vocab_tgt_len: int) -> Transf
         dropout=config["dropout"],
         d_ff=config["d_ff"],
     )
+    # Attention backend and fused QKV projections. See attention.configure_attention
+    configure_attention(model, config.get("attention_backend", "naive"), config.get("fused_qkv", False), config.get("attention_chunk_size", 128))
+    # Activation checkpointing of the encoder/decoder layers. See checkpointing.configure_checkpointing
+    configure_checkpointing(model, config.get("checkpoint_layers", None), (EncoderLayer, DecoderLayer), (PositionWiseFeedForward,))
     return model
 
 
@@ -47,19 +65,29 @@ def train_model2(config: dict):
     initial_epoch = 0
     global_step = 0
     model, initial_epoch, optimizer, global_step = reload_model(config, model, optimizer, initial_epoch, global_step)
+    # fp32 normalization layers when training in bf16. See utils.autocast
+    model = configure_precision(config, model)
+    # torch.compile when the compile config key is set. See utils.compile_model
+    model = compile_model(config, model)
 
-    loss_fn = nn.CrossEntropyLoss(ignore_index=tokenizer_src.token_to_id(PAD)).to(device)
+    # Summed over the tokens. See utils.GradientAccumulator
+    loss_fn = nn.CrossEntropyLoss(ignore_index=tokenizer_src.token_to_id(PAD), reduction="sum").to(device)
+    accumulator = GradientAccumulator(config, model, optimizer)
+    # Logs the step time and the peak memory. See checkpoint_layers
+    step_stats = StepStats(device)
 
     console_width = get_console_width()
 
     for epoch in range(initial_epoch, config["num_epochs"]):
+        # Bucketed batch order of this epoch. See bucketing.BucketBatchSampler
+        set_epoch(train_dataloader, epoch)
         if device == "cuda":
             torch.cuda.empty_cache()
 
         model.train()
+        step_stats.reset()
         batch_iterator = tqdm(train_dataloader, desc=f"Processing epoch {epoch:02d}")
         for batch_num, batch in enumerate(batch_iterator):
-            optimizer.zero_grad()
             src_data = batch["src"].to(device)  # (B, SeqLen)
             tgt_data = batch["tgt"].to(device)  # (B, SeqLen)
             src_mask = batch["src_mask"].to(device)  # (B, 1, 1, SeqLen)
@@ -67,23 +95,25 @@ def train_model2(config: dict):
 
             # JEB: Like for Model3. Need to have the full length
             # output = model(src_data, tgt_data[:, :-1].to(device), src_mask, tgt_mask)
-            output = model(src_data, tgt_data, src_mask, tgt_mask)
+            with autocast(config, device):
+                output = model(src_data, tgt_data, src_mask, tgt_mask)
 
             # JEB: Same issue as for Model3
             # loss = loss_fn(output.contiguous().view(-1, tokenizer_tgt.get_vocab_size()),
             #                 tgt_data[:, 1:].contiguous().view(-1))
-            loss = loss_fn(output.contiguous().view(-1, tokenizer_tgt.get_vocab_size()), tgt_data.contiguous().view(-1))
+            loss_sum = loss_fn(output.float().contiguous().view(-1, tokenizer_tgt.get_vocab_size()), tgt_data.contiguous().view(-1))
+            num_tokens = (tgt_data != tokenizer_src.token_to_id(PAD)).sum()
+            loss = loss_sum / num_tokens
             batch_iterator.set_postfix({"Loss": f"{loss.item():6.3f}"})
 
             # Log of loss
             writer.add_scalar("train loss", loss.item(), global_step)
             writer.flush()
 
-            # backpropagate the loss
-            loss.backward()
-
-            # update the weights
-            optimizer.step()
+            # backpropagate the loss and update the weights every grad_accum_steps batches
+            accumulator.backward(loss_sum, num_tokens)
+            accumulator.step(last=batch_num == len(train_dataloader) - 1)
+            step_stats.log(writer, global_step)
 
             if (batch_num > 0) and (batch_num % 100 == 0):
                 batch_iterator.write("-" * console_width)
@@ -168,7 +198,9 @@ def translate2(config: dict, sentence: str):
         raise ValueError(f"{model_folder} model_folder does not exist")
 
     sentence, label, tokenizer_src, tokenizer_tgt = get_testing_ds2(config, model_folder, sentence)
-    model = build_model2(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
+    # The weights are loaded right after. Skip the random initialization
+    with skip_weight_init():
+        model = build_model2(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
 
     # Load the pretrained weights
     model = load_trained_model(config, model)
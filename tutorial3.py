@@ -9,10 +9,25 @@ from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
+from attention import configure_attention
+from bucketing import set_epoch
+from checkpointing import configure_checkpointing
 from config import EOS, PAD, get_console_width, get_device, get_model_folder, get_config
 from dataset3 import get_ds3, get_testing_ds3
-from model3 import Transformer3, build_transformer3
-from utils import collect_training_metrics, reload_model, save_model, load_trained_model
+from model3 import Transformer3, build_transformer3, EncoderLayer, DecoderLayer, FeedForward
+from normalization import configure_norms
+from utils import (
+    collect_training_metrics,
+    reload_model,
+    save_model,
+    load_trained_model,
+    skip_weight_init,
+    compile_model,
+    autocast,
+    configure_precision,
+    GradientAccumulator,
+    StepStats,
+)
 
 
 class CosineWithRestarts(torch.optim.lr_scheduler._LRScheduler):
@@ -84,6 +99,12 @@ def build_model3(config: dict, vocab_src_len: int, vocab_tgt_len: int) -> Transf
         heads=config["h"],
         dropout=config["dropout"],
     )
+    # Attention backend and fused QKV projections. See attention.configure_attention
+    configure_attention(model, config.get("attention_backend", "naive"), config.get("fused_qkv", False), config.get("attention_chunk_size", 128))
+    # Activation checkpointing of the encoder/decoder layers. See checkpointing.configure_checkpointing
+    configure_checkpointing(model, config.get("checkpoint_layers", None), (EncoderLayer, DecoderLayer), (FeedForward,))
+    # F.layer_norm for the normalization layers. See normalization.configure_norms
+    configure_norms(model, config.get("fast_norm", False))
     return model
 
 
@@ -158,16 +179,27 @@ def train_model3(config: dict):
     initial_epoch = 0
     global_step = 0
     model, initial_epoch, optimizer, global_step = reload_model(config, model, optimizer, initial_epoch, global_step)
+    # fp32 normalization layers when training in bf16. See utils.autocast
+    model = configure_precision(config, model)
+    # torch.compile when the compile config key is set. See utils.compile_model
+    model = compile_model(config, model)
 
-    loss_fn = nn.CrossEntropyLoss(ignore_index=tokenizer_src.token_to_id(PAD), label_smoothing=0.1).to(device)
+    # Summed over the tokens. See utils.GradientAccumulator
+    loss_fn = nn.CrossEntropyLoss(ignore_index=tokenizer_src.token_to_id(PAD), label_smoothing=0.1, reduction="sum").to(device)
+    accumulator = GradientAccumulator(config, model, optimizer)
+    # Logs the step time and the peak memory. See checkpoint_layers
+    step_stats = StepStats(device)
 
     console_width = get_console_width()
 
     for epoch in range(initial_epoch, config["num_epochs"]):
+        # Bucketed batch order of this epoch. See bucketing.BucketBatchSampler
+        set_epoch(train_dataloader, epoch)
         if device == "cuda":
             torch.cuda.empty_cache()
 
         model.train()  # moved inside for run_validation at each step
+        step_stats.reset()
 
         total_loss = 0
 
@@ -190,20 +222,23 @@ def train_model3(config: dict):
             # JEB: Mask computation is different. No need to remove last one
             # trg_input = trg[:, :-1]
             # preds = model(src, trg_input, src_mask, trg_mask)
-            preds = model(src, trg, src_mask, trg_mask)
+            with autocast(config, device):
+                preds = model(src, trg, src_mask, trg_mask)
 
             # JEB: Mask computation is different. No need to remove last one
             # ys = trg[:, 1:].contiguous().view(-1)
             ys = trg.contiguous().view(-1)
 
-            optimizer.zero_grad()
             # JEB: Use the torch method instead
             # loss = F.cross_entropy(preds.view(-1, preds.size(-1)), ys, ignore_index=opt.trg_pad)
-            loss = loss_fn(preds.view(-1, preds.size(-1)), ys)
+            loss_sum = loss_fn(preds.float().view(-1, preds.size(-1)), ys)
+            num_tokens = (ys != tokenizer_src.token_to_id(PAD)).sum()
+            loss = loss_sum / num_tokens
             batch_iterator.set_postfix({"Loss": f"{loss.item():6.3f}"})
 
-            loss.backward()
-            optimizer.step()
+            accumulator.backward(loss_sum, num_tokens)
+            accumulator.step(last=batch_num == len(train_dataloader) - 1)
+            step_stats.log(writer, global_step)
             # if opt.SGDR == True:
             #    opt.sched.step()
 
@@ -237,7 +272,9 @@ def translate3(config: dict, sentence: str):
         raise ValueError(f"{model_folder} model_folder does not exist")
 
     sentence, label, tokenizer_src, tokenizer_tgt = get_testing_ds3(config, model_folder, sentence)
-    model = build_model3(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
+    # The weights are loaded right after. Skip the random initialization
+    with skip_weight_init():
+        model = build_model3(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
 
     # Load the pretrained weights
     model = load_trained_model(config, model)
@@ -6,7 +6,7 @@ from pathlib import Path
 from config import get_device, get_model_folder, get_config
 from dataset3 import get_ds3, get_testing_ds3
 from model4 import Transformer4, build_transformer4
-from utils import load_trained_model
+from utils import load_trained_model, skip_weight_init
 
 
 def build_model4(config: dict, vocab_src_len: int, vocab_tgt_len: int) -> Transformer4:
@@ -43,7 +43,9 @@ def translate4(config: dict, sentence: str):
         raise ValueError(f"{model_folder} model_folder does not exist")
 
     sentence, label, tokenizer_src, tokenizer_tgt = get_testing_ds3(config, model_folder, sentence)
-    model = build_model4(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
+    # The weights are loaded right after. Skip the random initialization
+    with skip_weight_init():
+        model = build_model4(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
 
     # Load the pretrained weights
     model = load_trained_model(config, model)
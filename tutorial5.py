@@ -5,7 +5,7 @@ from config import get_device, get_model_folder, get_config
 from dataset3 import get_ds3, get_testing_ds3
 from model5 import Transformer5, build_transformer5
 
-from utils import load_trained_model
+from utils import load_trained_model, skip_weight_init
 
 
 def build_model5(config: dict, vocab_src_len: int, vocab_tgt_len: int) -> Transformer5:
@@ -42,7 +42,9 @@ def translate5(config: dict, sentence: str):
         raise ValueError(f"{model_folder} model_folder does not exist")
 
     sentence, label, to5enizer_src, tokenizer_tgt = get_testing_ds3(config, model_folder, sentence)
-    model = build_model5(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
+    # The weights are loaded right after. Skip the random initialization
+    with skip_weight_init():
+        model = build_model5(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
 
     # Load the pretrained weights
     model = load_trained_model(config, model)
@@ -9,10 +9,24 @@ from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
+from attention import configure_attention
+from checkpointing import configure_checkpointing
 from config import EOS, PAD, get_console_width, get_device, get_model_folder, get_config
 from dataset6 import Dataset6, get_ds6, get_testing_ds6
-from model6 import Transformer6, build_transformer6
-from utils import collect_training_metrics, reload_model, save_model, load_trained_model
+from model6 import Transformer6, build_transformer6, EncoderLayer, DecoderLayer, PositionwiseFeedForward
+from normalization import configure_norms
+from utils import (
+    collect_training_metrics,
+    reload_model,
+    save_model,
+    load_trained_model,
+    skip_weight_init,
+    compile_model,
+    autocast,
+    configure_precision,
+    GradientAccumulator,
+    StepStats,
+)
 
 
 def build_model6(config: dict, vocab_src_len: int, vocab_tgt_len: int, src_to_index: dict, tgt_to_index: dict) -> Transformer6:
@@ -30,6 +44,12 @@ def build_model6(config: dict, vocab_src_len: int, vocab_tgt_len: int, src_to_in
         d_ff=config["d_ff"],
     )
 
+    # Attention backend and fused QKV projections. See attention.configure_attention
+    configure_attention(model, config.get("attention_backend", "naive"), config.get("fused_qkv", False), config.get("attention_chunk_size", 128))
+    # Activation checkpointing of the encoder/decoder layers. See checkpointing.configure_checkpointing
+    configure_checkpointing(model, config.get("checkpoint_layers", None), (EncoderLayer, DecoderLayer), (PositionwiseFeedForward,))
+    # F.layer_norm for the normalization layers. See normalization.configure_norms
+    configure_norms(model, config.get("fast_norm", False))
     return model
 
 
@@ -52,8 +72,15 @@ def train_model6(config: dict):
     global_step = 0
 
     transformer, initial_epoch, optimizer, global_step = reload_model(config, transformer, optimizer, initial_epoch, global_step)
+    # fp32 normalization layers when training in bf16. See utils.autocast
+    transformer = configure_precision(config, transformer)
+    # torch.compile when the compile config key is set. See utils.compile_model
+    transformer = compile_model(config, transformer)
     # loss_fn = nn.CrossEntropyLoss(ignore_index=tokenizer_tgt.token_to_id(PAD), reduction='none')
     loss_fn = nn.CrossEntropyLoss(ignore_index=tgt_to_index[PAD], reduction="none")
+    accumulator = GradientAccumulator(config, transformer, optimizer)
+    # Logs the step time and the peak memory. See checkpoint_layers
+    step_stats = StepStats(device)
 
     console_width = get_console_width()
 
@@ -62,39 +89,39 @@ def train_model6(config: dict):
             torch.cuda.empty_cache()
 
         transformer.train()  # moved inside for run_validation at each step
+        step_stats.reset()
         batch_iterator = tqdm(train_dataloader, desc=f"Processing epoch {epoch:02d}")
         for batch_num, batch in enumerate(batch_iterator):
 
-            # src_batched_sentences: tuple[str], tgt_batched_sentences: tuple[str]
-            src_batched_sentences, tgt_batched_sentences = batch
-            encoder_self_attention_mask, decoder_self_attention_mask, decoder_cross_attention_mask = Dataset6.create_masks(
-                src_batched_sentences, tgt_batched_sentences, config["seq_len"]
+            # The sentences are tokenized by the collate function. See dataset6.Collate6
+            src_batched_sentences, tgt_batched_sentences = batch["src_text"], batch["tgt_text"]
+            encoder_self_attention_mask, decoder_self_attention_mask, decoder_cross_attention_mask = Dataset6.create_masks_from_lengths(
+                batch["src_len"], batch["tgt_len"], config["seq_len"], device, config.get("mask_form", "float")
             )
-            optimizer.zero_grad()
-            predicted_tokens = transformer(
-                src_batched_sentences,
-                tgt_batched_sentences,
-                encoder_self_attention_mask.to(device),
-                decoder_self_attention_mask.to(device),
-                decoder_cross_attention_mask.to(device),
-                enc_start_token=False,  # During training, model6 does not add sos to encoder input
-                enc_end_token=False,  # During training, model6 does not add sos to encoder input
-                dec_start_token=True,  # During training, model6 DOES add sos to decoder input
-                dec_end_token=True,
-            )  # During training, model6 DOES add eos to decoder input
-            expected_tokens = transformer.decoder.sentence_embedding.batch_tokenize(tgt_batched_sentences, start_token=False, end_token=True)
-            loss = loss_fn(predicted_tokens.view(-1, tgt_vocab_size).to(device), expected_tokens.view(-1).to(device)).to(device)
+            with autocast(config, device):
+                predicted_tokens = transformer(
+                    batch["encoder_input"].to(device),  # During training, model6 does not add sos/eos to encoder input
+                    batch["decoder_input"].to(device),  # During training, model6 DOES add sos and eos to decoder input
+                    encoder_self_attention_mask,
+                    decoder_self_attention_mask,
+                    decoder_cross_attention_mask,
+                )
+            expected_tokens = batch["label"].to(device)
+            loss = loss_fn(predicted_tokens.float().view(-1, tgt_vocab_size), expected_tokens.view(-1))
 
             valid_indicies = torch.where(expected_tokens.view(-1) == tgt_to_index[PAD], False, True)
-            loss = loss.sum() / valid_indicies.sum()
+            # Summed over the tokens. See utils.GradientAccumulator
+            loss_sum = loss.sum()
+            loss = loss_sum / valid_indicies.sum()
             batch_iterator.set_postfix({"Loss": f"{loss.item():6.3f}"})
 
             # Log of loss
             writer.add_scalar("train loss", loss, global_step)
             writer.flush()
 
-            loss.backward()
-            optimizer.step()
+            accumulator.backward(loss_sum, valid_indicies.sum())
+            accumulator.step(last=batch_num == len(train_dataloader) - 1)
+            step_stats.log(writer, global_step)
 
             # train_losses.append(loss.item())
             if (batch_num > 0) and (batch_num % 100 == 0):
@@ -169,7 +196,9 @@ def translate6(config: dict, sentence: str):
         raise ValueError(f"{model_folder} model_folder does not exist")
 
     sentence, label, vocab_src_len, vocab_tgt_len, src_to_index, tgt_to_index, index_to_tgt = get_testing_ds6(config, model_folder, sentence)
-    model = build_model6(config, vocab_src_len, vocab_tgt_len, src_to_index, tgt_to_index).to(device)
+    # The weights are loaded right after. Skip the random initialization
+    with skip_weight_init():
+        model = build_model6(config, vocab_src_len, vocab_tgt_len, src_to_index, tgt_to_index).to(device)
 
     # Load the pretrained weights
     model = load_trained_model(config, model)
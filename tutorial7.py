@@ -14,7 +14,7 @@ from tqdm import tqdm
 from config import get_console_width, get_device, get_model_folder, get_config
 from dataset7 import get_ds7
 from model7 import Transformer7, build_transformer7
-from utils import reload_model, save_model
+from utils import reload_model, save_model, compile_model, autocast, configure_precision, GradientAccumulator
 
 
 def build_model7(config: dict, vocab_tgt_len: int) -> Transformer7:
@@ -45,7 +45,13 @@ def train_model7(config: dict):
     log_interval = 200
 
     transformer, initial_epoch, optimizer, global_step = reload_model(config, transformer, optimizer, initial_epoch, global_step)
-    loss_fn = nn.CrossEntropyLoss()
+    # fp32 normalization layers when training in bf16. See utils.autocast
+    transformer = configure_precision(config, transformer)
+    # torch.compile when the compile config key is set. See utils.compile_model
+    transformer = compile_model(config, transformer)
+    # Summed over the tokens. See utils.GradientAccumulator
+    loss_fn = nn.CrossEntropyLoss(reduction="sum")
+    accumulator = GradientAccumulator(config, transformer, optimizer, max_grad_norm=0.5)
 
     console_width = get_console_width()
 
@@ -66,19 +72,20 @@ def train_model7(config: dict):
             # data: Tensor, shape ``[seq_len, batch_size]``
             # src_mask: Tensor, shape ``[seq_len, seq_len]``
             # output Tensor of shape ``[seq_len, batch_size, ntoken]``
-            output = transformer(data)
-            output_flat = output.view(-1, tokenizer_tgt.get_vocab_size())
-            loss = loss_fn(output_flat, targets)
+            with autocast(config, device):
+                output = transformer(data)
+            output_flat = output.float().view(-1, tokenizer_tgt.get_vocab_size())
+            loss_sum = loss_fn(output_flat, targets)
+            loss = loss_sum / targets.numel()
             batch_iterator.set_postfix({"Loss": f"{loss.item():6.3f}"})
 
             # Log of loss
             writer.add_scalar("train loss", loss.item(), global_step)
             writer.flush()
 
-            optimizer.zero_grad()
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(transformer.parameters(), 0.5)
-            optimizer.step()
+            # The gradient is clipped once per update, after the accumulation
+            accumulator.backward(loss_sum, targets.numel())
+            accumulator.step(last=batch_num == num_batches - 1)
 
             total_loss += loss.item()
             if batch_num % log_interval == 0 and batch_num > 0:
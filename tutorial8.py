@@ -11,12 +11,20 @@ from tqdm import tqdm
 from config import get_config, get_device, get_model_folder
 from dataset8 import get_ds8, get_testing_ds8, Dataset8
 from model8 import Transformer8, build_transformer8
-from utils import reload_model, save_model, load_trained_model
+from utils import reload_model, save_model, load_trained_model, skip_weight_init, compile_model, autocast, configure_precision, GradientAccumulator
 
 
 def build_model8(config: dict, vocab_tgt_len: int) -> Transformer8:
     model = build_transformer8(
-        vocab_tgt_len, d_model=config["d_model"], N=config["N"], h=config["h"], block_size=config["block_size"], dropout=config["dropout"], d_ff=config["d_ff"]
+        vocab_tgt_len,
+        d_model=config["d_model"],
+        N=config["N"],
+        h=config["h"],
+        block_size=config["block_size"],
+        dropout=config["dropout"],
+        d_ff=config["d_ff"],
+        attention_window=config.get("attention_window", None),
+        position_encoding=config.get("position_encoding", "learned"),
     )
     return model
 
@@ -47,6 +55,11 @@ def train_model8(config: dict):
     optimizer = torch.optim.AdamW(transformer.parameters(), lr=config["lr"])
 
     transformer, initial_epoch, optimizer, global_step = reload_model(config, transformer, optimizer, initial_epoch, global_step)
+    accumulator = GradientAccumulator(config, transformer, optimizer)
+    # fp32 normalization layers when training in bf16. See utils.autocast
+    transformer = configure_precision(config, transformer)
+    # torch.compile when the compile config key is set. See utils.compile_model
+    transformer = compile_model(config, transformer)
 
     for epoch in range(initial_epoch, config["num_epochs"]):
         if device == "cuda":
@@ -70,10 +83,11 @@ def train_model8(config: dict):
             xb, yb = train_ds.get_batch()
 
             # evaluate the loss
-            logits, loss = transformer(xb.to(device), yb.to(device))
-            optimizer.zero_grad(set_to_none=True)
-            loss.backward()
-            optimizer.step()
+            with autocast(config, device):
+                logits, loss = transformer(xb.to(device), yb.to(device))
+            # Every token is real: the mean loss times the number of tokens is the sum. See utils.GradientAccumulator
+            accumulator.backward(loss * yb.numel(), yb.numel())
+            accumulator.step(last=iter == max_iters - 1)
 
         # Save the model at the end of every epoch
         save_model(config, transformer, optimizer, epoch, global_step)
@@ -119,14 +133,67 @@ def translate8(config: dict, sentence: str):
         raise ValueError(f"{model_folder} model_folder does not exist")
 
     tokenizer = get_testing_ds8(config, model_folder)
-    model = build_model8(config, tokenizer.get_vocab_size()).to(device)
+    # The weights are loaded right after. Skip the random initialization
+    with skip_weight_init():
+        model = build_model8(config, tokenizer.get_vocab_size()).to(device)
 
     # Load the pretrained weights
     model = load_trained_model(config, model)
+    model = compile_model(config, model)
 
     # generate from the model
     context = torch.zeros((1, 1), dtype=torch.long, device=device)
-    print(tokenizer.decode(model.generate(context, max_new_tokens=2000)[0].tolist()))
+    model.eval()
+    draft_model_folder = config.get("draft_model_folder", None)
+    if draft_model_folder:
+        # The draft model is a smaller model8 (fewer layers or smaller d_model) trained with the same tokenizer
+        # get_config falls back silently to the default config, whose model folder is not the draft one
+        if not Path.exists(Path(draft_model_folder + "/" + "config.yaml")):
+            raise ValueError(f"{draft_model_folder} draft_model_folder has no config.yaml")
+        draft_config = get_config(modelfolder=draft_model_folder)
+        with skip_weight_init():
+            draft_model = build_model8(draft_config, tokenizer.get_vocab_size()).to(device)
+        # The quantize, compile and precision settings of the draft model come from its own config.yaml
+        draft_model = load_trained_model(draft_config, draft_model)
+        # The draft model only steps through its K/V cache. See Transformer8.speculative_generate
+        draft_model = compile_model(draft_config, draft_model, ("forward_step",))
+        draft_model.eval()
+        output = model.speculative_generate(
+            context,
+            max_new_tokens=2000,
+            draft_model=draft_model,
+            num_draft_tokens=config.get("num_draft_tokens", 4),
+            temperature=config.get("temperature", 1.0),
+            top_k=config.get("top_k", None),
+            top_p=config.get("top_p", None),
+        )
+        print(tokenizer.decode(output[0].tolist()))
+    elif config.get("kv_cache_stride", None):
+        # All the samples start from the same context, no padding needed
+        context = torch.zeros((config.get("num_samples", 1), 1), dtype=torch.long, device=device)
+        outputs = model.generate_cached(
+            context,
+            max_new_tokens=2000,
+            temperature=config.get("temperature", 1.0),
+            top_k=config.get("top_k", None),
+            top_p=config.get("top_p", None),
+            stride=config["kv_cache_stride"],
+        )
+        for output in outputs:
+            print(tokenizer.decode(output.tolist()))
+    else:
+        # All the samples are generated together as one batch
+        outputs = model.generate_batch(
+            [[0]] * config.get("num_samples", 1),
+            max_new_tokens=2000,
+            temperature=config.get("temperature", 1.0),
+            top_k=config.get("top_k", None),
+            top_p=config.get("top_p", None),
+            stop_strings=config.get("stop_strings", None),
+            decode=tokenizer.decode,
+        )
+        for output in outputs:
+            print(tokenizer.decode(output))
 
 
 def debug_code_model8(config: dict, device):
@@ -1,32 +1,43 @@
 #!/usr/bin/env python3
 
+import os
+import resource
+import time
+from contextlib import contextmanager
+
 import torch
 import torchmetrics
 import torchmetrics.text
 
 
-from config import get_weights_file_path, latest_weights_file_path, get_best_model_params_path
+from pathlib import Path
 
+import torch.nn as nn
 
-def collect_training_metrics(writer, predicted, expected, global_step):
-    if writer:
-        # Evaluate the character error rate
-        # Compute the char error rate
-        metric = torchmetrics.text.CharErrorRate()
-        cer = metric(predicted, expected)
-        writer.add_scalar("validation cer", cer, global_step)
-        writer.flush()
+from config import get_weights_file_path, latest_weights_file_path, get_best_model_params_path, get_quantized_weights_file_path, get_model_folder
 
-        # Compute the word error rate
-        metric = torchmetrics.text.WordErrorRate()
-        wer = metric(predicted, expected)
-        writer.add_scalar("validation wer", wer, global_step)
-        writer.flush()
 
-        # Compute the BLEU metric
-        metric = torchmetrics.text.BLEUScore()
-        bleu = metric(predicted, expected)
-        writer.add_scalar("validation BLEU", bleu, global_step)
+def compute_translation_metrics(predicted, expected) -> dict:
+    # Evaluate the character error rate
+    # Compute the char error rate
+    metric = torchmetrics.text.CharErrorRate()
+    cer = metric(predicted, expected)
+
+    # Compute the word error rate
+    metric = torchmetrics.text.WordErrorRate()
+    wer = metric(predicted, expected)
+
+    # Compute the BLEU metric
+    metric = torchmetrics.text.BLEUScore()
+    bleu = metric(predicted, expected)
+    return {"cer": cer, "wer": wer, "BLEU": bleu}
+
+
+def collect_training_metrics(writer, predicted, expected, global_step):
+    if writer:
+        metrics = compute_translation_metrics(predicted, expected)
+        for name, value in metrics.items():
+            writer.add_scalar(f"validation {name}", value, global_step)
         writer.flush()
 
 
@@ -36,10 +47,18 @@ def reload_model(config, model, optimizer, initial_epoch, global_step):
     if model_filename:
         print(f"Preloading model {model_filename}")
         state = torch.load(model_filename)
+        # Checkpoints of model8 saved before its heads were fused. See model8.convert_heads_state_dict
+        unfused_heads = any(".sa.heads." in key for key in state["model_state_dict"])
         model.load_state_dict(state["model_state_dict"])  # JEB: This was not in the vide
         initial_epoch = state["epoch"] + 1
-        optimizer.load_state_dict(state["optimizer_state_dict"])
+        if unfused_heads:
+            # The weights are converted but the optimizer state of the per Head parameters cannot be
+            print("Checkpoint was saved before the model8 heads were fused, starting with a fresh optimizer")
+        else:
+            optimizer.load_state_dict(state["optimizer_state_dict"])
         global_step = state["global_step"]
+        if state.get("precision", "fp32") != config.get("precision", "fp32"):
+            print(f"Checkpoint was trained with {state.get('precision', 'fp32')} precision, continuing with {config.get('precision', 'fp32')}")
     else:
         print("No model to preload, starting from scratch")
     return model, initial_epoch, optimizer, global_step
@@ -47,26 +66,244 @@ def reload_model(config, model, optimizer, initial_epoch, global_step):
 
 def save_model(config, model, optimizer, epoch: int, global_step: int, best_model_yet: bool = False):
     # Save the model at the end of every epoch
+    # The weights are always fp32. precision records how they were trained
+    state = {
+        "epoch": epoch,
+        "model_state_dict": model.state_dict(),
+        "optimizer_state_dict": optimizer.state_dict(),
+        "global_step": global_step,
+        "precision": config.get("precision", "fp32"),
+    }
     model_filename = get_weights_file_path(config, f"{epoch:02d}")
-    torch.save(
-        {"epoch": epoch, "model_state_dict": model.state_dict(), "optimizer_state_dict": optimizer.state_dict(), "global_step": global_step}, model_filename
-    )
+    torch.save(state, model_filename)
 
     if best_model_yet:
         best_model_filename = get_best_model_params_path(config, f"{epoch:02d}")
-        torch.save(
-            {"epoch": epoch, "model_state_dict": model.state_dict(), "optimizer_state_dict": optimizer.state_dict(), "global_step": global_step},
-            best_model_filename,
-        )
+        torch.save(state, best_model_filename)
+
+
+class GradientAccumulator:
+    """Accumulate the gradients of several micro-batches before each optimizer step.
+    The step happens after grad_accum_steps micro-batches or, when tokens_per_update is set, once that many real
+    tokens have been seen. The micro-batch losses are summed over their tokens, and the gradients are divided by
+    the number of real (non PAD) tokens of the whole update: every token has the same weight, whatever the
+    padding of its micro-batch."""
+
+    def __init__(self, config: dict, model: nn.Module, optimizer, max_grad_norm: float = None):
+        self.grad_accum_steps = config.get("grad_accum_steps", 1)
+        self.tokens_per_update = config.get("tokens_per_update", None)
+        self.model = model
+        self.optimizer = optimizer
+        self.max_grad_norm = max_grad_norm
+        self.num_batches = 0
+        self.num_tokens = 0
+        optimizer.zero_grad(set_to_none=True)
+
+    def backward(self, loss_sum: torch.Tensor, num_tokens) -> None:
+        # loss_sum is the loss summed (not averaged) over the num_tokens real tokens of the micro-batch
+        loss_sum.backward()
+        self.num_batches += 1
+        self.num_tokens += int(num_tokens)
+
+    def step(self, last: bool = False) -> bool:
+        # last forces the step with the micro-batches already accumulated (end of the epoch)
+        if self.tokens_per_update:
+            ready = self.num_tokens >= self.tokens_per_update
+        else:
+            ready = self.num_batches >= self.grad_accum_steps
+        if self.num_batches == 0 or not (ready or last):
+            return False
+        for parameter in self.model.parameters():
+            if parameter.grad is not None:
+                parameter.grad.div_(max(self.num_tokens, 1))
+        if self.max_grad_norm:
+            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.max_grad_norm)
+        self.optimizer.step()
+        # Gradients are only reset once per update. set_to_none: no memset, the next backward allocates them
+        self.optimizer.zero_grad(set_to_none=True)
+        self.num_batches = 0
+        self.num_tokens = 0
+        return True
+
+
+class StepStats:
+    """Time per training step and peak memory, logged to tensorboard.
+    Used to compare the checkpoint_layers policies (less memory, more time)."""
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.reset()
+
+    def reset(self):
+        # Called at the beginning of each epoch: the validation is not part of the next step,
+        # and the cuda peak memory is the peak of this epoch
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.start = time.perf_counter()
+
+    def log(self, writer, global_step: int) -> float:
+        now = time.perf_counter()
+        step_time = now - self.start
+        self.start = now
+        writer.add_scalar("step time", step_time, global_step)
+        writer.add_scalar("peak memory MB", self.peak_memory(), global_step)
+        return step_time
+
+    def peak_memory(self) -> float:
+        if self.device.type == "cuda":
+            return torch.cuda.max_memory_allocated(self.device) / 1024**2
+        # Peak resident set size of the process. ru_maxrss is in KB on linux.
+        # JEB: It is the high-water mark of the whole process lifetime and cannot be reset: compare the
+        # checkpoint_layers policies on cpu with separate runs.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def autocast(config: dict, device):
+    # Mixed precision of the forward pass. With precision: bf16 the matmuls (nn.Linear, attention) run in bfloat16,
+    # the weights and the optimizer stay fp32. The loss is computed on .float() logits outside of the block.
+    precision = config.get("precision", "fp32")
+    if precision not in ("fp32", "bf16"):
+        raise ValueError(f"{precision} precision is not supported")
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=precision == "bf16")
+
+
+def configure_precision(config: dict, model: nn.Module) -> nn.Module:
+    # With precision: bf16, the normalization layers (nn.LayerNorm and the custom norms of model1, model3 and model6)
+    # run in fp32 on fp32 inputs. Their mean/variance are too sensitive for bfloat16.
+    if config.get("precision", "fp32") != "bf16":
+        return model
+    for module in model.modules():
+        if isinstance(module, nn.LayerNorm) or hasattr(module, "fast_norm"):
+            module.forward = float32_forward(module.forward)
+    return model
+
+
+def float32_forward(forward):
+    def call(x, *args, **kwargs):
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            return forward(x.float(), *args, **kwargs)
+
+    return call
+
+
+def quantize_model(model, quantize: str):
+    # Dynamic quantization: the weights of every nn.Linear (attention projections, feed forward and
+    # vocabulary projection) are stored in int8 and the activations are quantized on the fly
+    if quantize != "int8":
+        raise ValueError(f"{quantize} quantization is not supported")
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+
+@contextmanager
+def skip_weight_init():
+    # Build a model whose weights are about to be overwritten by load_trained_model.
+    # The random initializations (nn.Linear/nn.Embedding reset_parameters, the xavier loops of the
+    # build_transformer* functions) are replaced by a cheap zero fill for the duration of the block.
+    names = ("uniform_", "normal_", "trunc_normal_", "constant_", "ones_", "zeros_", "xavier_uniform_", "xavier_normal_", "kaiming_uniform_", "kaiming_normal_")
+    saved = {name: getattr(nn.init, name) for name in names}
+
+    def zero_init(tensor, *args, **kwargs):
+        with torch.no_grad():
+            return tensor.zero_()
+
+    try:
+        for name in names:
+            setattr(nn.init, name, zero_init)
+        yield
+    finally:
+        for name, function in saved.items():
+            setattr(nn.init, name, function)
 
 
 def load_trained_model(config, model):
     preload = config["preload"]
     model_filename = latest_weights_file_path(config) if preload == "latest" else get_weights_file_path(config, preload) if preload else None
     print(f"Preloading model {model_filename}")
-    if model_filename:
+    if not model_filename:
+        raise ValueError(f"{model_filename} Pretrained Model does not exist")
+
+    quantize = config.get("quantize", None)
+    if quantize and next(model.parameters()).device.type != "cpu":
+        print(f"{quantize} quantization is only supported on cpu. Using the float model")
+        quantize = None
+
+    if not quantize:
         state = torch.load(model_filename)
         model.load_state_dict(state["model_state_dict"])  # JEB: This was not in the video
+        return model
+
+    quantized_filename = get_quantized_weights_file_path(model_filename, quantize)
+    if Path(quantized_filename).exists() and Path(quantized_filename).stat().st_mtime >= Path(model_filename).stat().st_mtime:
+        # The structure needs to be quantized before the quantized weights can be loaded
+        print(f"Preloading quantized model {quantized_filename}")
+        model = quantize_model(model, quantize)
+        state = torch.load(quantized_filename)
+        model.load_state_dict(state["model_state_dict"])
     else:
-        raise ValueError(f"{model_filename} Pretrained Model does not exist")
+        state = torch.load(model_filename)
+        model.load_state_dict(state["model_state_dict"])
+        model = quantize_model(model, quantize)
+        print(f"Saving quantized model {quantized_filename}")
+        torch.save({"epoch": state["epoch"], "model_state_dict": model.state_dict(), "quantize": quantize}, quantized_filename)
     return model
+
+
+def compile_model(config: dict, model: nn.Module, names: tuple = ("forward",)) -> nn.Module:
+    # torch.compile the methods names of model (e.g. encode, decode and project for model1) when the compile
+    # config key is set to a torch.compile mode (default, reduce-overhead, max-autotune).
+    # The methods are replaced on the instance: model stays the same nn.Module and its state_dict keys do not
+    # get the _orig_mod. prefix of torch.compile(model), so checkpoints are unchanged.
+    mode = config.get("compile", None)
+    if not mode:
+        return model
+    # Only loaded when compile is set
+    import torch._inductor.config
+
+    # The compiled kernels are cached in the model folder. The next runs start warm.
+    # Set once, before the first compilation: inductor reads TORCHINDUCTOR_CACHE_DIR when it compiles
+    cache_dir = Path(get_model_folder(config)) / "compile_cache"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = str(cache_dir)
+    torch._inductor.config.fx_graph_cache = True
+    for name in names:
+        eager = getattr(model, name)
+        # dynamic=True: the batch size and the sequence length change (last batch, decoding, generation).
+        # The graphs are compiled with symbolic shapes once instead of being recompiled for each new shape.
+        compiled = torch.compile(eager, mode=mode, dynamic=True)
+        setattr(model, name, timed_compile(model, name, eager, compiled))
+    return model
+
+
+def timed_compile(model: nn.Module, name: str, eager, compiled):
+    # Logs the compile time and the speedup, without any extra call:
+    # the first call runs eager (a regular step, timed), the second one compiles, the third one is timed against
+    # the first. compiled then replaces the wrapper on model, so the next calls have no overhead.
+    label = f"{type(model).__name__}.{name}"
+    calls = 0
+    eager_time = 0.0
+
+    def timed(function, *args, **kwargs):
+        start = time.perf_counter()
+        output = function(*args, **kwargs)
+        if torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+        return output, time.perf_counter() - start
+
+    def call(*args, **kwargs):
+        nonlocal calls, eager_time
+        calls += 1
+        if calls == 1:
+            output, eager_time = timed(eager, *args, **kwargs)
+        elif calls == 2:
+            output, compile_time = timed(compiled, *args, **kwargs)
+            print(f"torch.compile {label}: compiled in {compile_time:.1f}s")
+        else:
+            output, compiled_time = timed(compiled, *args, **kwargs)
+            print(
+                f"torch.compile {label}: {compiled_time * 1000:.1f}ms per call instead of {eager_time * 1000:.1f}ms, "
+                f"speedup {eager_time / compiled_time:.2f}x"
+            )
+            setattr(model, name, compiled)
+        return output
+
+    return call